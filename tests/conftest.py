@@ -0,0 +1,287 @@
+"""Shared fixtures, including a local paramiko SSH server stand-in."""
+
+import os
+import select
+import socket
+import subprocess
+import threading
+import time
+
+# Must be imported before fabric for monkey patching to work
+import xefab.ssh_client  # isort: skip
+
+import paramiko
+import pytest
+from fabric import Connection
+
+from xefab import cache
+from xefab.pool import pool
+
+PASSWORD = "secret"
+
+
+class LocalSFTPServer(paramiko.SFTPServerInterface):
+    """Serves the local filesystem."""
+
+    def list_folder(self, path):
+        try:
+            return [
+                paramiko.SFTPAttributes.from_stat(
+                    os.lstat(os.path.join(path, name)), name
+                )
+                for name in os.listdir(path)
+            ]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags | getattr(os, "O_BINARY", 0), 0o666)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = paramiko.SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(path, attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class StubServer(paramiko.ServerInterface):
+    """Accepts password logins, answers a few canned commands and
+    runs anything else with the local shell.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.forwards = {}
+        self.sessions = []
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        self.stats["auths"] += 1
+        if password == PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.forwards[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def accept_forwards(self, transport):
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is None:
+                continue
+            destination = self.forwards.pop(channel.get_id(), None)
+            if destination is None:
+                # Session channels are closed once garbage collected
+                self.sessions = [c for c in self.sessions if not c.closed]
+                self.sessions.append(channel)
+            else:
+                threading.Thread(
+                    target=self.forward, args=(channel, destination), daemon=True
+                ).start()
+
+    def forward(self, channel, destination):
+        sock = socket.create_connection(destination)
+        with sock, channel:
+            while True:
+                readable, _, _ = select.select([sock, channel], [], [])
+                if sock in readable:
+                    data = sock.recv(1024)
+                    if not data:
+                        break
+                    channel.sendall(data)
+                if channel in readable:
+                    data = channel.recv(1024)
+                    if not data:
+                        break
+                    sock.sendall(data)
+
+    def check_channel_exec_request(self, channel, command):
+        self.stats["execs"] += 1
+        threading.Thread(target=self.run, args=(channel, command)).start()
+        return True
+
+    def run(self, channel, command):
+        # Let the server reply to the exec request first
+        time.sleep(0.05)
+        if command == b"echo hello":
+            channel.sendall(b"hello\n")
+            channel.sendall_stderr(b"warning\n")
+            channel.send_exit_status(3)
+        elif command == b"cat":
+            data = b""
+            while True:
+                chunk = channel.recv(1024)
+                if not chunk:
+                    break
+                data += chunk
+            channel.sendall(data)
+            channel.send_exit_status(0)
+        else:
+            # Streamed both ways, e.g. for tar pipes
+            process = subprocess.Popen(
+                ["/bin/sh", "-c", command.decode()],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=dict(os.environ, **self.stats["env"]),
+            )
+            threading.Thread(
+                target=self.feed, args=(channel, process.stdin), daemon=True
+            ).start()
+            stderr = threading.Thread(
+                target=self.pump, args=(process.stderr, channel.sendall_stderr)
+            )
+            stderr.start()
+            self.pump(process.stdout, channel.sendall)
+            stderr.join()
+            channel.send_exit_status(process.wait())
+        channel.close()
+
+    @staticmethod
+    def feed(channel, stdin):
+        try:
+            while True:
+                chunk = channel.recv(32768)
+                if not chunk:
+                    break
+                stdin.write(chunk)
+            stdin.close()
+        except (OSError, EOFError):
+            pass
+
+    @staticmethod
+    def pump(stream, send):
+        for chunk in iter(lambda: stream.read1(32768), b""):
+            send(chunk)
+
+
+@pytest.fixture(scope="session")
+def ssh_server():
+    host_key = paramiko.RSAKey.generate(2048)
+    stats = {"auths": 0, "transports": 0, "execs": 0, "env": {}}
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(10)
+
+    def serve():
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            stats["transports"] += 1
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler(
+                "sftp", paramiko.SFTPServer, LocalSFTPServer
+            )
+            server = StubServer(stats)
+            transport.start_server(server=server)
+            threading.Thread(
+                target=server.accept_forwards, args=(transport,), daemon=True
+            ).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield listener.getsockname()[1], stats
+    listener.close()
+
+
+@pytest.fixture(autouse=True)
+def empty_pool():
+    """Start every test without pooled transports."""
+    pool.close()
+    yield
+    pool.close()
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """A cache directory of the test's own."""
+    path = tmp_path / "cache"
+    monkeypatch.setattr(cache, "CACHE_DIR", str(path))
+    return path
+
+
+@pytest.fixture
+def connect_kwargs():
+    return {"password": PASSWORD, "look_for_keys": False, "allow_agent": False}
+
+
+@pytest.fixture
+def connect(ssh_server, connect_kwargs):
+    """Factory of connections to the local SSH server."""
+    port, _ = ssh_server
+
+    def connect(password=PASSWORD):
+        return Connection(
+            "127.0.0.1",
+            port=port,
+            user="tester",
+            connect_kwargs=dict(connect_kwargs, password=password),
+        )
+
+    return connect
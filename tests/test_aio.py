@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""Tests for async tasks and the async connection API."""
+
+# Must be imported before fabric for monkey patching to work
+import xefab.ssh_client  # isort: skip
+
+import asyncio
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+from xefab.aio import AsyncConnection
+from xefab.tasks.batchq import wait_for_log
+from xefab.tasks.main import task
+from xefab.tasks.squeue import wait_for_job, wait_for_jobs
+
+N_WAITS = 200
+
+FAKE_SQUEUE = """#!/bin/sh
+echo "JOBID PARTITION NAME USER ST TIME NODES NODELIST(REASON)"
+echo "42 xenon1t job tester R 0:01 1 node01"
+"""
+
+
+@pytest.fixture
+def c(connect):
+    c = connect()
+    yield AsyncConnection(c)
+    c.close()
+
+
+def test_concurrent_remote_waits(connect):
+    c = AsyncConnection(connect(), max_sessions=N_WAITS)
+
+    async def main():
+        await c.open()
+        return await asyncio.gather(
+            *(c.run(f"sleep 1; echo {i}", hide=True) for i in range(N_WAITS))
+        )
+
+    start = time.perf_counter()
+    results = asyncio.run(main())
+    elapsed = time.perf_counter() - start
+    assert [r.stdout for r in results] == [f"{i}\n" for i in range(N_WAITS)]
+    # The waits overlap, sequential runs would take N_WAITS seconds
+    assert elapsed < N_WAITS / 10
+    c.close()
+
+
+def test_sessions_per_transport_are_capped(connect):
+    with connect() as conn:
+
+        async def main():
+            # Connections on one transport share the cap
+            first = AsyncConnection(conn, max_sessions=3)
+            second = AsyncConnection(conn, max_sessions=3)
+            await first.open()
+            return await asyncio.gather(
+                *(
+                    (first if i % 2 else second).run(f"sleep 0.3; echo {i}", hide=True)
+                    for i in range(9)
+                )
+            )
+
+        start = time.perf_counter()
+        results = asyncio.run(main())
+        # Three at a time
+        assert time.perf_counter() - start >= 0.9
+    assert [r.stdout for r in results] == [f"{i}\n" for i in range(9)]
+
+
+def test_results_keep_streams_and_exit_code(c):
+    result = asyncio.run(c.run("echo out; echo err >&2; exit 5", hide=True, warn=True))
+    assert (result.stdout, result.stderr, result.exited) == ("out\n", "err\n", 5)
+
+
+def test_cancellation(c):
+    async def main():
+        run = asyncio.create_task(c.run("sleep 10", hide=True))
+        await asyncio.sleep(0.5)
+        run.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await run
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    assert time.perf_counter() - start < 5
+
+
+def test_async_tasks(connect):
+    @task
+    async def echo(c, text="hello"):
+        result = await c.run(f"echo {text}", hide=True)
+        return result.stdout.strip()
+
+    with connect() as c:
+        assert echo(c, text="async") == "async"
+
+
+def test_put_and_get(c, tmp_path):
+    local = tmp_path / "local.txt"
+    local.write_text("data")
+
+    async def main():
+        await c.put(str(local), remote=str(tmp_path / "remote.txt"))
+        await c.get(str(tmp_path / "remote.txt"), local=str(tmp_path / "back.txt"))
+
+    asyncio.run(main())
+    assert (tmp_path / "back.txt").read_text() == "data"
+
+
+def test_forward_local(c):
+    async def echo(reader, writer):
+        writer.write(await reader.read(100))
+        await writer.drain()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(echo, "127.0.0.1", 0)
+        remote_port = server.sockets[0].getsockname()[1]
+        async with c.forward_local(0, remote_port, remote_host="127.0.0.1") as forward:
+            local_port = forward.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", local_port)
+            writer.write(b"ping")
+            await writer.drain()
+            data = await reader.read(100)
+            writer.close()
+        server.close()
+        return data
+
+    assert asyncio.run(main()) == b"ping"
+
+
+def test_wait_helpers(ssh_server, c, tmp_path, monkeypatch):
+    _, stats = ssh_server
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    squeue = bin_dir / "squeue"
+    squeue.write_text(FAKE_SQUEUE)
+    squeue.chmod(squeue.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setitem(stats["env"], "PATH", f"{bin_dir}:{os.environ['PATH']}")
+    log = tmp_path / "job.log"
+
+    async def write_log():
+        await asyncio.sleep(0.3)
+        log.write_text("starting\nJob done.\n")
+
+    async def main():
+        state = await wait_for_job(c, 42, timeout=5)
+        _, output = await asyncio.gather(
+            write_log(), wait_for_log(c, str(log), "Job done.", interval=0.1, timeout=5)
+        )
+        return state, output
+
+    assert asyncio.run(main()) == ("R", "starting\nJob done.\n")
+
+
+QUEUE_SQUEUE = """#!/bin/sh
+echo "$2" >> "$QUEUE.calls"
+# The controller is unreachable as many times as there are lines in .down
+if [ -s "$QUEUE.down" ]; then
+    sed -i 1d "$QUEUE.down"
+    echo "slurm_load_jobs error: Socket timed out on send/recv operation" >&2
+    exit 1
+fi
+found=
+for id in $(echo "$2" | tr , ' '); do
+    grep -qx "$id" "$QUEUE" && found="$found $id"
+done
+if [ -z "$found" ]; then
+    echo "slurm_load_jobs error: Invalid job id specified" >&2
+    exit 1
+fi
+echo "JOBID PARTITION NAME USER ST TIME NODES NODELIST(REASON)"
+for id in $found; do
+    echo "$id xenon1t job tester R 0:01 1 node01"
+done
+"""
+
+
+def test_wait_for_jobs_polls_all_jobs_at_once(
+    ssh_server, connect, tmp_path, monkeypatch
+):
+    _, stats = ssh_server
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    squeue = bin_dir / "squeue"
+    squeue.write_text(QUEUE_SQUEUE)
+    squeue.chmod(squeue.stat().st_mode | stat.S_IEXEC)
+    queue = tmp_path / "queue"
+    job_ids = list(range(100, 115))
+    queue.write_text("".join(f"{i}\n" for i in job_ids))
+    monkeypatch.setitem(stats["env"], "PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setitem(stats["env"], "QUEUE", str(queue))
+
+    # Jobs leave the queue one by one
+    def drain_queue():
+        for i in range(len(job_ids)):
+            time.sleep(0.05)
+            queue.write_text("".join(f"{j}\n" for j in job_ids[i + 1 :]))
+
+    drainer = threading.Thread(target=drain_queue)
+    drainer.start()
+    with connect() as conn:
+        wait_for_jobs(conn, ",".join(map(str, job_ids)), interval=0.1, hide=True)
+    drainer.join()
+    calls = (tmp_path / "queue.calls").read_text().split()
+    assert calls[0] == ",".join(map(str, job_ids))
+    # Finished jobs are no longer polled
+    assert all(len(b.split(",")) <= len(a.split(",")) for a, b in zip(calls, calls[1:]))
+
+    queue.write_text("100\n")
+    with connect() as conn:
+        with pytest.raises(RuntimeError, match="Timeout"):
+            wait_for_jobs(conn, "100", timeout=0.3, interval=0.1, hide=True)
+    timeout = {a.name: a for a in wait_for_jobs.get_arguments()}["timeout"]
+    timeout.set_value("600", cast=True)
+    assert timeout.value == 600.0
+
+
+def test_squeue_failures_are_not_taken_as_finished_jobs(
+    ssh_server, connect, tmp_path, monkeypatch
+):
+    _, stats = ssh_server
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    squeue = bin_dir / "squeue"
+    squeue.write_text(QUEUE_SQUEUE)
+    squeue.chmod(squeue.stat().st_mode | stat.S_IEXEC)
+    queue = tmp_path / "queue"
+    queue.write_text("100\n")
+    down = tmp_path / "queue.down"
+    monkeypatch.setitem(stats["env"], "PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setitem(stats["env"], "QUEUE", str(queue))
+
+    # A few failures are retried while the job keeps running
+    down.write_text("x\nx\n")
+    with connect() as conn:
+        c = AsyncConnection(conn)
+        assert asyncio.run(wait_for_job(c, 100, interval=0.05, timeout=5)) == "R"
+    assert down.read_text() == ""
+
+    # Persistent failures raise instead of reporting the jobs finished
+    down.write_text("x\n" * 100)
+    with connect() as conn:
+        with pytest.raises(RuntimeError, match="squeue failed"):
+            wait_for_jobs(conn, "100", interval=0.05, hide=True)
+        with pytest.raises(RuntimeError, match="squeue failed"):
+            asyncio.run(
+                wait_for_job(AsyncConnection(conn), 100, states=(), interval=0.05)
+            )
+
+    # Rejected job ids have left the queue
+    down.write_text("")
+    queue.write_text("")
+    with connect() as conn:
+        wait_for_jobs(conn, "100", interval=0.05, hide=True)
+        assert asyncio.run(wait_for_job(AsyncConnection(conn), 100, states=())) == ""
+
+    # A missing squeue is not retried
+    monkeypatch.setitem(stats["env"], "PATH", "/nonexistent")
+    with connect() as conn:
+        with pytest.raises(RuntimeError, match="not available"):
+            wait_for_jobs(conn, "100", interval=0.05, hide=True)
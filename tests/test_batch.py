@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Tests for batched remote commands, counting exec channels per task."""
+
+# Must be imported before fabric for monkey patching to work
+import xefab.ssh_client  # isort: skip
+
+import os
+import stat
+
+import pytest
+from invoke.exceptions import UnexpectedExit
+
+from xefab.batch import RemoteBatch
+from xefab.tasks.batchq import sbatch
+from xefab.tasks.shell import which
+
+FAKE_SBATCH = """#!/bin/sh
+out=$(sed -n 's/^#SBATCH --output=//p' "$1")
+err=$(sed -n 's/^#SBATCH --error=//p' "$1")
+sh "$1" >"$out" 2>"$err"
+echo "Submitted batch job 42"
+"""
+
+FAKE_SQUEUE = """#!/bin/sh
+echo "JOBID PARTITION NAME USER ST TIME NODES NODELIST(REASON)"
+echo "42 xenon1t job tester R 0:01 1 node01"
+"""
+
+
+@pytest.fixture
+def c(connect):
+    c = connect()
+    c.config.run.in_stream = False
+    yield c
+    c.close()
+
+
+def test_results_are_demultiplexed(ssh_server, c):
+    _, stats = ssh_server
+    execs = stats["execs"]
+    with RemoteBatch(c) as batch:
+        first = batch.run("echo one; echo err >&2; exit 4", hide=True, warn=True)
+        second = batch.run("printf 'no newline'", hide=True)
+        third = batch.run("cd /; pwd", hide=True)
+
+    assert stats["execs"] - execs == 1
+    assert (first.stdout, first.stderr, first.exited) == ("one\n", "err\n", 4)
+    assert (second.stdout, second.stderr, second.exited) == ("no newline", "", 0)
+    assert third.stdout == "/\n"
+    assert first.command == "echo one; echo err >&2; exit 4"
+
+
+def test_failure_stops_the_batch(c):
+    batch = RemoteBatch(c)
+    failing = batch.run("false", hide=True)
+    skipped = batch.run("echo never", hide=True)
+    with pytest.raises(UnexpectedExit):
+        batch.execute()
+    assert failing.exited == 1
+    with pytest.raises(RuntimeError):
+        skipped.stdout
+
+
+def test_which_uses_one_channel(ssh_server, c):
+    _, stats = ssh_server
+    execs = stats["execs"]
+    assert which(c, "sh", hide=True).endswith("/sh")
+    assert stats["execs"] - execs == 1
+
+
+def test_sbatch_channels(ssh_server, c, tmp_path, monkeypatch):
+    _, stats = ssh_server
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, content in [("sbatch", FAKE_SBATCH), ("squeue", FAKE_SQUEUE)]:
+        path = bin_dir / name
+        path.write_text(content)
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setitem(stats["env"], "PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setitem(stats["env"], "SCRATCH", str(tmp_path))
+
+    execs = stats["execs"]
+    sbatch(c, "echo hi from the job", job_name="test", container="", hours=1)
+
+    # $SCRATCH, workdir, submission, squeue, tail and output batches
+    assert stats["execs"] - execs == 6
+    output = tmp_path / "xefab_jobs" / "test" / "test.out"
+    assert "hi from the job" in output.read_text()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""Tests for the SSH connection broker against a local paramiko server."""
+
+import asyncio
+import os
+import tempfile
+import threading
+
+# Must be imported before fabric for monkey patching to work
+from xefab import broker  # isort: skip
+
+import paramiko
+import pytest
+
+from xefab.aio import AsyncConnection
+from xefab.pool import pool
+
+
+@pytest.fixture
+def broker_server(monkeypatch):
+    # Unix socket paths are limited in length, keep it short
+    directory = tempfile.mkdtemp(prefix="xefab")
+    path = os.path.join(directory, "broker.sock")
+    monkeypatch.setenv("XEFAB_BROKER_SOCKET", path)
+    server = broker.BrokerServer(path, ttl=60)
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+
+
+def test_invocations_share_one_authenticated_transport(
+    ssh_server, broker_server, connect
+):
+    port, stats = ssh_server
+    auths, transports = stats["auths"], stats["transports"]
+
+    for _ in range(3):
+        # Each invocation starts with its own process-wide pool
+        pool.close()
+        with connect() as c:
+            result = c.run("echo hello", hide=True, warn=True, in_stream=False)
+            assert isinstance(c.transport, broker.BrokerTransport)
+            assert result.stdout == "hello\n"
+            assert result.stderr == "warning\n"
+            assert result.exited == 3
+
+    assert stats["auths"] - auths == 1
+    assert stats["transports"] - transports == 1
+    assert list(broker.ping()["hosts"]) == [f"tester@127.0.0.1:{port}"]
+
+
+def test_stdin_is_relayed(broker_server, connect):
+    with connect() as c:
+        c.open()
+        session = c.transport.open_session()
+        session.exec_command("cat")
+        session.sendall(b"some input")
+        session.shutdown_write()
+        assert session.recv(1024) == b"some input"
+        assert session.recv_exit_status() == 0
+
+
+def test_sftp_is_relayed(broker_server, connect):
+    with connect() as c:
+        assert c.sftp().normalize("/tmp/../tmp") == "/tmp"
+
+
+def test_idle_transports_are_closed(broker_server, connect):
+    with connect() as c:
+        c.run("echo hello", hide=True, warn=True, in_stream=False)
+    assert broker_server.transports
+    broker_server.ttl = 0
+    broker_server.reap()
+    assert not broker_server.transports
+
+
+def test_bad_password_is_rejected(broker_server, connect):
+    with pytest.raises(paramiko.AuthenticationException):
+        connect(password="wrong").open()
+
+
+def test_direct_connection_without_broker(monkeypatch, tmp_path, connect):
+    monkeypatch.setenv("XEFAB_BROKER_SOCKET", str(tmp_path / "missing.sock"))
+    with connect() as c:
+        result = c.run("echo hello", hide=True, warn=True, in_stream=False)
+        assert isinstance(c.transport, paramiko.Transport)
+        assert result.stdout == "hello\n"
+
+
+def test_async_run_is_relayed(broker_server, connect):
+    with connect() as c:
+        result = asyncio.run(AsyncConnection(c).run("echo hello", hide=True, warn=True))
+        assert isinstance(c.transport, broker.BrokerTransport)
+        assert (result.stdout, result.stderr, result.exited) == ("hello\n", "warning\n", 3)
+
+
+def test_untrusted_broker_gets_no_credentials(
+    ssh_server, broker_server, connect, monkeypatch
+):
+    port, stats = ssh_server
+    directory = os.path.dirname(broker_server.server_address)
+    auths = stats["auths"]
+
+    # A directory others can write to could hold anyone's socket
+    os.chmod(directory, 0o755)
+    with connect() as c:
+        c.run("echo hello", hide=True, warn=True, in_stream=False)
+        assert isinstance(c.transport, paramiko.Transport)
+    os.chmod(directory, 0o700)
+
+    # As could a socket served by another user
+    pool.close()
+    monkeypatch.setattr(broker, "peer_uid", lambda sock: os.getuid() + 1)
+    with connect() as c:
+        c.run("echo hello", hide=True, warn=True, in_stream=False)
+        assert isinstance(c.transport, paramiko.Transport)
+    assert stats["auths"] - auths == 2
+    assert not broker_server.transports
+    with pytest.raises(broker.UntrustedBrokerError):
+        broker.request({"op": "ping"})
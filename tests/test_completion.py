@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Tests for the completion index and the xefab-complete hook."""
+
+import os
+
+import pytest
+
+from xefab import completion
+from xefab.completion import (complete, read_completion_index,
+                              write_completion_index)
+
+CORE_FLAGS = {"--help": False, "-h": False, "--list": False, "--trace-file": True}
+
+SNAPSHOT = {
+    "default": None,
+    "tasks": {
+        "show-context": {"aliases": [], "flags": {"--hide": False}},
+    },
+    "collections": {
+        "midway": {
+            "default": None,
+            "tasks": {
+                "squeue": {
+                    "aliases": ["job-queue"],
+                    "flags": {"--user": True, "-u": True, "--hide": False},
+                },
+                "sbatch": {"aliases": [], "flags": {"--partition": True}},
+            },
+            "collections": {},
+        },
+        "sh": {
+            "default": "shell",
+            "tasks": {"shell": {"aliases": [], "flags": {}}},
+            "collections": {},
+        },
+    },
+}
+
+INDEX = {
+    "collection_name": "tasks",
+    "core_flags": CORE_FLAGS,
+    "tree": completion.completion_tree(SNAPSHOT),
+}
+
+
+@pytest.mark.parametrize(
+    "words, expected",
+    [
+        (
+            ["xefab", ""],
+            [
+                "midway",
+                "sh",
+                "show-context",
+                "midway.sbatch",
+                "midway.squeue",
+                "midway.job-queue",
+                "sh",
+                "sh.shell",
+            ],
+        ),
+        # A host collection selects its tasks
+        (["xefab", "midway", ""], ["sbatch", "squeue", "job-queue"]),
+        (["xefab", "midway", "squeue", "--"], ["--user", "--hide"]),
+        (["xefab", "midway.job-queue", "-"], ["--user", "-u", "--hide"]),
+        (["xefab", "midway", "squeue", "--hide"], ["sbatch", "squeue", "job-queue"]),
+        # Flag values are left to the shell
+        (["xefab", "midway", "squeue", "--user", ""], []),
+        (["xefab", "--trace-file", ""], []),
+        (["xefab", "--"], ["--help", "--list", "--trace-file"]),
+    ],
+)
+def test_complete(words, expected):
+    assert complete(INDEX, words) == expected
+
+
+def test_stale_index_is_detected(cache_dir, tmp_path, monkeypatch):
+    site_packages = tmp_path / "site-packages"
+    site_packages.mkdir()
+    monkeypatch.setattr(completion.site, "getsitepackages", lambda: [str(site_packages)])
+    monkeypatch.setattr(completion.site, "ENABLE_USER_SITE", False)
+
+    assert read_completion_index() is None
+    write_completion_index(SNAPSHOT, CORE_FLAGS, "tasks")
+    assert read_completion_index() == INDEX
+
+    # Installing a package touches site-packages
+    stat = site_packages.stat()
+    os.utime(site_packages, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert read_completion_index() is None
+
+    write_completion_index(SNAPSHOT, CORE_FLAGS, "tasks")
+    monkeypatch.setattr(completion, "__version__", "0.0.0.dev-upgraded")
+    assert read_completion_index() is None
+
+
+def test_hook_falls_back_to_the_program(cache_dir, tmp_path, monkeypatch, capsys):
+    fallbacks = []
+    monkeypatch.setattr(completion, "complete_with_program", fallbacks.append)
+    monkeypatch.chdir(tmp_path)
+
+    # Without an index
+    completion.main(["--", "xefab", "midway", ""])
+    assert fallbacks == [["xefab", "midway", ""]]
+
+    write_completion_index(SNAPSHOT, CORE_FLAGS, "tasks")
+    completion.main(["--", "xefab", "midway", ""])
+    assert capsys.readouterr().out.split() == ["sbatch", "squeue", "job-queue"]
+    assert len(fallbacks) == 1
+
+    # Flags selecting other collections
+    completion.main(["--", "xefab", "--collection=other", ""])
+    assert fallbacks[-1] == ["xefab", "--collection=other", ""]
+
+    # A local task collection
+    (tmp_path / "tasks.py").write_text("")
+    completion.main(["--", "xefab", ""])
+    assert fallbacks[-1] == ["xefab", ""]
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Tests for the indexed and cached ssh config lookups."""
+
+import getpass
+import json
+import os
+
+from paramiko.config import SSHConfig
+
+from xefab.cache import cache_path
+from xefab.config import SSH_CONFIG_CACHE, SSHConfigIndex
+
+SSH_CONFIG = """
+Host midway
+    HostName midway2.rcc.uchicago.edu
+    User {user}
+
+Host dali dali-login
+    HostName dali-login2.rcc.uchicago.edu
+    ForwardAgent yes
+
+Host %-jump
+    HostName %h.example.org
+
+Match localuser {localuser}
+    IdentityFile ~/.ssh/id_%u
+
+Host *.rcc.uchicago.edu
+    ServerAliveInterval 30
+
+Host *
+    ControlPath ~/.ssh/cm-%r@%h:%p
+"""
+
+
+def write_config(path, user="xenon", localuser=None):
+    path.write_text(
+        SSH_CONFIG.format(user=user, localuser=localuser or getpass.getuser())
+    )
+    return str(path)
+
+
+def paramiko_lookup(path, host):
+    ssh_config = SSHConfig()
+    with open(path) as f:
+        ssh_config.parse(f)
+    return dict(ssh_config.lookup(host))
+
+
+def test_aliases_and_hostnames_resolve(cache_dir, tmp_path):
+    path = write_config(tmp_path / "config")
+    index = SSHConfigIndex.for_paths([path])
+
+    assert index.resolve("midway")["hostname"] == "midway2.rcc.uchicago.edu"
+    # HostNames of a Host block resolve to its alias
+    assert index.resolve("dali-login2.rcc.uchicago.edu") == index.resolve("dali")
+    assert index.resolve("dali-login")["forwardagent"] == "yes"
+    assert index.resolve("unknown") is None
+
+    # Parity with paramiko's own lookups
+    for host in ("midway", "dali", "dali-login", "midway2.rcc.uchicago.edu"):
+        assert index.resolve(host) == paramiko_lookup(path, index.hostnames[host])
+
+
+def test_index_is_cached_until_the_file_changes(cache_dir, tmp_path):
+    path = write_config(tmp_path / "config")
+    index = SSHConfigIndex.for_paths([path])
+    index.resolve("midway")
+    assert SSHConfigIndex.for_paths([path]) is index
+
+    # Only the parsed rules are persisted, resolved configs depend on
+    # the local user and environment
+    with open(cache_path(SSH_CONFIG_CACHE)) as f:
+        cached = json.load(f)["data"]
+    assert set(cached) == {"rules", "hostnames"}
+
+    # A new process loads the index from the cache
+    SSHConfigIndex._instances.clear()
+    reloaded = SSHConfigIndex.for_paths([path])
+    assert reloaded is not index
+    assert reloaded.rules == index.rules
+    assert reloaded.resolve("midway") == index.resolve("midway")
+
+    write_config(tmp_path / "config", user="someone-else")
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10**9))
+    changed = SSHConfigIndex.for_paths([path])
+    assert changed.resolve("midway")["user"] == "someone-else"
+    assert changed.resolve("midway") == paramiko_lookup(path, "midway")
+
+
+def test_user_dependent_lookups_are_not_shared(cache_dir, tmp_path, monkeypatch):
+    path = write_config(tmp_path / "config")
+    user = getpass.getuser()
+    resolved = SSHConfigIndex.for_paths([path]).resolve("midway")
+    assert resolved["identityfile"] == [os.path.expanduser(f"~/.ssh/id_{user}")]
+
+    # Another local user reading the same cache resolves for itself
+    SSHConfigIndex._instances.clear()
+    for name in ("LOGNAME", "USER", "LNAME", "USERNAME"):
+        monkeypatch.setenv(name, "other")
+    resolved = SSHConfigIndex.for_paths([path]).resolve("midway")
+    assert "identityfile" not in resolved
+    assert resolved == paramiko_lookup(path, "midway")
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""Tests for the optionally remote file helpers."""
+
+# Must be imported before fabric for monkey patching to work
+import xefab.ssh_client  # isort: skip
+
+import os
+import stat
+
+import pytest
+from invoke.context import Context
+
+from xefab.cache import ContentCache, content_cache
+from xefab.file_access import (MappedReader, MultiPathFile, SFTPReader,
+                               TemplateFile, deploy_templates)
+from xefab.instrumentation import recorder
+
+
+def test_multi_path_file_resolution_is_cached(ssh_server, connect, cache_dir, tmp_path):
+    port, stats = ssh_server
+    first, second = tmp_path / "first.txt", tmp_path / "second.txt"
+    second.write_text("second")
+    f = MultiPathFile(paths=[str(tmp_path / "missing.txt"), str(first), str(second)])
+
+    with connect() as c:
+        execs = stats["execs"]
+        assert f.read_text(c) == "second"
+        # All candidates are probed in one command
+        assert stats["execs"] - execs == 1
+        assert f.cached_path(c) == ("remote", str(second))
+
+        assert f.read_text(c) == "second"
+        assert f.read_bytes(c) == b"second"
+        assert stats["execs"] - execs == 1
+
+        # A failed read of the cached path probes again
+        first.write_text("first")
+        second.unlink()
+        assert f.read_text(c) == "first"
+        assert stats["execs"] - execs == 2
+
+        first.unlink()
+        with pytest.raises(FileNotFoundError):
+            f.read_text(c)
+        assert f.cached_path(c) is None
+
+
+def test_remote_reads_use_the_content_cache(ssh_server, connect, cache_dir, tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text("{}")
+    f = MultiPathFile(path=str(path))
+    recorder.clear()
+
+    with connect() as c:
+        assert f.read_text(c) == "{}"
+        assert f.read_text(c) == "{}"
+        assert recorder.counters == {"content cache misses": 1, "content cache hits": 1}
+
+        path.write_text('{"changed": true}')
+        assert f.read_bytes(c) == b'{"changed": true}'
+        assert recorder.counters["content cache misses"] == 2
+
+    # Copies may hold credentials, only the user can read them
+    entry = content_cache.entry_path(c.host, str(path))
+    for file in (entry, f"{entry}.json"):
+        assert stat.S_IMODE(os.stat(file).st_mode) == 0o600
+    for directory in (cache_dir, os.path.dirname(entry)):
+        assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    for name in os.listdir(cache_dir):
+        if os.path.isfile(cache_dir / name):
+            assert stat.S_IMODE(os.stat(cache_dir / name).st_mode) == 0o600
+
+
+def test_content_cache_evicts_least_recently_used(ssh_server, connect, cache_dir, tmp_path):
+    content = ContentCache(max_size=250)
+    paths = []
+    for name in "abc":
+        path = tmp_path / name
+        path.write_bytes(name.encode() * 100)
+        paths.append(str(path))
+
+    with connect() as c:
+        sftp = c.sftp()
+        content.read(c.host, paths[0], sftp)
+        os.utime(content.entry_path(c.host, paths[0]), (0, 0))
+        content.read(c.host, paths[1], sftp)
+        content.read(c.host, paths[2], sftp)
+    assert not os.path.exists(content.entry_path(c.host, paths[0]))
+    assert os.path.exists(content.entry_path(c.host, paths[1]))
+    assert os.path.exists(content.entry_path(c.host, paths[2]))
+
+
+def test_open_streams_files(ssh_server, connect, cache_dir, tmp_path):
+    path = tmp_path / "big.log"
+    lines = [f"line {i}\n" for i in range(200000)]
+    path.write_text("".join(lines))
+    data = path.read_bytes()
+    f = MultiPathFile(path=str(path))
+
+    with connect() as c:
+        with f.open(c) as remote:
+            assert isinstance(remote.buffer.raw, SFTPReader)
+            assert next(iter(remote)) == lines[0]
+            assert sum(1 for _ in remote) == len(lines) - 1
+        with f.open(c, "rb") as remote:
+            remote.seek(len(data) - 10)
+            assert remote.read() == data[-10:]
+            raw = remote.raw
+            assert len(raw._window) <= raw.chunk_size * raw.read_ahead
+            assert raw.read_ranges([(0, 5), (len(data), 5), (100, 10)]) == [
+                data[:5],
+                b"",
+                data[100:110],
+            ]
+
+    local = Context()
+    with f.open(local, "rb") as mapped:
+        assert isinstance(mapped.raw, MappedReader)
+        mapped.seek(1000)
+        assert mapped.read(20) == data[1000:1020]
+        assert mapped.raw.read_range(5, 5) == data[5:10]
+    with f.open(local) as mapped:
+        assert list(mapped) == lines
+
+
+class Greeting(TemplateFile):
+    __TEMPLATE__ = "Hello {name}!\n"
+
+    name: str
+
+
+def test_deploy_templates_uploads_changed_files(ssh_server, connect, tmp_path):
+    port, stats = ssh_server
+    path = str(tmp_path / "deployed")
+    templates = [
+        Greeting(filename=f"{name}.txt", name=name) for name in ("ann", "bob", "cid")
+    ]
+
+    with connect() as c:
+        execs = stats["execs"]
+        report = deploy_templates(c, templates, path, hide=True)
+        assert report == {
+            "deployed": ["ann.txt", "bob.txt", "cid.txt"],
+            "skipped": [],
+            "failed": {},
+        }
+        assert (tmp_path / "deployed" / "bob.txt").read_text() == "Hello bob!\n"
+
+        templates[1] = Greeting(filename="bob.txt", name="bobby")
+        report = deploy_templates(c, templates, path, hide=True)
+        assert report["deployed"] == ["bob.txt"]
+        assert report["skipped"] == ["ann.txt", "cid.txt"]
+        assert (tmp_path / "deployed" / "bob.txt").read_text() == "Hello bobby!\n"
+        # One command per deploy, the uploads go over SFTP
+        assert stats["execs"] - execs == 2
+    assert sorted(os.listdir(path)) == ["ann.txt", "bob.txt", "cid.txt"]
+
+    local = str(tmp_path / "local")
+    assert deploy_templates(Context(), templates, local, hide=True)["deployed"] == [
+        "ann.txt",
+        "bob.txt",
+        "cid.txt",
+    ]
+    assert templates[0].deploy(Context(), local, hide=True)["skipped"] == ["ann.txt"]
+
+
+def test_redeploying_keeps_the_file_mode(ssh_server, connect, tmp_path):
+    for name in ("remote", "local"):
+        (tmp_path / name).mkdir()
+        script = tmp_path / name / "run.txt"
+        script.write_text("#!/bin/sh\n")
+        script.chmod(0o750)
+    template = Greeting(filename="run.txt", name="ann")
+
+    with connect() as c:
+        assert template.deploy(c, str(tmp_path / "remote"), hide=True)["deployed"]
+    assert template.deploy(Context(), str(tmp_path / "local"), hide=True)["deployed"]
+    for name in ("remote", "local"):
+        deployed = tmp_path / name / "run.txt"
+        assert deployed.read_text() == "Hello ann!\n"
+        assert stat.S_IMODE(deployed.stat().st_mode) == 0o750
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Tests for the cached task tree used by --list and --help."""
+
+from types import SimpleNamespace
+
+import pytest
+
+from xefab import cache, entrypoints, main
+from xefab.cache import entry_points_key, read_cache
+from xefab.main import CachedCollection, XeFab
+
+
+def run(*args):
+    program = main.make_program()
+    try:
+        program.run(["xefab", *args], exit=False)
+    except SystemExit:
+        pass
+    return program
+
+
+@pytest.fixture
+def key_calls(monkeypatch):
+    """Calls of entry_points_key."""
+    calls = []
+    key = main.entry_points_key
+
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return key(*args, **kwargs)
+
+    monkeypatch.setattr(main, "entry_points_key", counted)
+    return calls
+
+
+def with_plugin(version):
+    """get_all_entry_points with an extra plugin distribution of a version."""
+    get_all_entry_points = entrypoints.get_all_entry_points
+
+    def patched(prefix="xefab"):
+        yield from get_all_entry_points(prefix)
+        dist = SimpleNamespace(name="xefab-fake", version=version)
+        yield "xefab.fake", SimpleNamespace(name="fake", value="fake:x", dist=dist)
+
+    return patched
+
+
+def test_listing_uses_and_rebuilds_the_cache(cache_dir, monkeypatch, capsys):
+    run("--list")
+    listing = capsys.readouterr().out
+    assert "show-context" in listing
+    assert read_cache(XeFab.HELP_CACHE_NAME, entry_points_key()) is not None
+    assert isinstance(run("--list").collection, CachedCollection)
+    assert capsys.readouterr().out == listing
+
+    # Upgrading xefab, or installing or upgrading a plugin, rebuilds it
+    get_all_entry_points = entrypoints.get_all_entry_points
+    for target, name, value in [
+        (cache, "__version__", "0.0.0.dev-upgraded"),
+        (entrypoints, "get_all_entry_points", with_plugin("1.0")),
+        (entrypoints, "get_all_entry_points", with_plugin("1.1")),
+    ]:
+        monkeypatch.setattr(entrypoints, "get_all_entry_points", get_all_entry_points)
+        monkeypatch.setattr(target, name, value)
+        assert read_cache(XeFab.HELP_CACHE_NAME, entry_points_key()) is None
+        assert not isinstance(run("--list").collection, CachedCollection)
+        assert capsys.readouterr().out == listing
+        assert read_cache(XeFab.HELP_CACHE_NAME, entry_points_key()) is not None
+        assert isinstance(run("--list").collection, CachedCollection)
+        capsys.readouterr()
+
+
+def test_running_tasks_skips_the_cache(cache_dir, key_calls, capsys):
+    run("--list")
+    key_calls.clear()
+    program = run("show-context")
+    assert not isinstance(program.collection, CachedCollection)
+    assert key_calls == []
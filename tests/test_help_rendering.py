@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Help rendering benchmark for large plugin trees."""
+
+import io
+import os
+import time
+
+from invoke.collection import Collection
+from invoke.parser import Parser
+from invoke.tasks import Task
+from rich.console import Console
+
+from xefab.main import XeFab
+
+# Budget for rendering the usage help of the synthetic tree, in seconds.
+HELP_BUDGET_S = float(os.getenv("XEFAB_HELP_BUDGET_S", 5))
+
+N_COLLECTIONS = 50
+N_TASKS = 1000
+
+
+def make_task(index):
+    def body(c, option=None, flag=False):
+        pass
+
+    body.__name__ = body.__qualname__ = f"task_{index}"
+    body.__doc__ = f"Synthetic task number {index}."
+    return Task(body, help={"option": "An option", "flag": "A flag"})
+
+
+def make_tree():
+    """Root collection with N_COLLECTIONS host collections sharing
+    N_TASKS unique tasks, each task added to two collections.
+    """
+    tasks = [make_task(i) for i in range(N_TASKS)]
+    per_collection = 2 * N_TASKS // N_COLLECTIONS
+    root = Collection("main")
+    for i in range(N_COLLECTIONS):
+        collection = Collection(f"host{i}")
+        for j in range(per_collection):
+            task = tasks[(i * per_collection // 2 + j) % N_TASKS]
+            collection.add_task(task)
+        root.add_collection(collection)
+    return root
+
+
+def render_usage(collection):
+    program = XeFab(name="xefab")
+    program.parser = Parser(contexts=collection.to_contexts())
+    file = io.StringIO()
+    console = Console(file=file, width=100)
+    console.print(program.collection_panel(collection))
+    return file.getvalue()
+
+
+def test_task_index_is_complete():
+    collection = make_tree()
+    index = XeFab(name="xefab").task_index(collection)
+    assert len(index) == N_TASKS
+    for entry in index.values():
+        assert len(entry["paths"]) == 2
+        assert len(entry["contexts"]) == 2
+
+
+def test_usage_help_rendering_time():
+    collection = make_tree()
+    start = time.perf_counter()
+    output = render_usage(collection)
+    elapsed = time.perf_counter() - start
+    assert output.count("Synthetic task number") == N_TASKS
+    assert output.count("An option") == N_TASKS
+    assert elapsed < HELP_BUDGET_S, (
+        f"Rendering help for {N_TASKS} tasks in {N_COLLECTIONS} collections "
+        f"took {elapsed:.1f}s (budget {HELP_BUDGET_S:.0f}s)"
+    )
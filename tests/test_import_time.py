@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Import-time budget for the xefab CLI startup path."""
+
+import json
+import os
+import subprocess
+import sys
+
+# Budget for the total import time of `xefab --version`, in milliseconds.
+IMPORT_BUDGET_MS = float(os.getenv("XEFAB_IMPORT_BUDGET_MS", 500))
+
+# Libraries that should only be imported by the tasks that need them
+DEFERRED_MODULES = [
+    "pandas",
+    "fsspec",
+    "pydantic",
+    "decopatch",
+    "makefun",
+    "rich.progress",
+    "xefab.tasks",
+    "xefab.hosts",
+]
+
+VERSION_SCRIPT = """
+import json, sys
+from xefab.main import program
+program.run(["xefab", "--version"], exit=False)
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+def run_version(*python_flags):
+    return subprocess.run(
+        [sys.executable, *python_flags, "-c", VERSION_SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def parse_importtime(stderr):
+    """Parse `python -X importtime` output into
+    {module: cumulative microseconds} for top-level imports.
+    """
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        # Nested imports are indented below the module importing them
+        if name.startswith("  ") or not cumulative.strip().isdigit():
+            continue
+        timings[name.strip()] = int(cumulative)
+    return timings
+
+
+def test_version_does_not_import_deferred_modules():
+    result = run_version()
+    modules = set(json.loads(result.stdout.splitlines()[-1]))
+    loaded = [name for name in DEFERRED_MODULES if name in modules]
+    assert not loaded, f"xefab --version imported {loaded}"
+
+
+def test_version_import_time_budget():
+    # Warm up the bytecode cache so only import time is measured
+    run_version()
+    result = run_version("-X", "importtime")
+    timings = parse_importtime(result.stderr)
+    total_ms = sum(timings.values()) / 1000
+    slowest = sorted(timings.items(), key=lambda x: -x[1])[:5]
+    assert total_ms < IMPORT_BUDGET_MS, (
+        f"xefab --version imports took {total_ms:.0f}ms "
+        f"(budget {IMPORT_BUDGET_MS:.0f}ms). Slowest: {slowest}"
+    )
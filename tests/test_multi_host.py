@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Tests for running a task on several host collections concurrently."""
+
+# Must be imported before fabric for monkey patching to work
+import xefab.ssh_client  # isort: skip
+
+import time
+
+import pandas as pd
+import paramiko
+from fabric.tasks import task
+from invoke.parser import Argument, ParseResult, ParserContext
+
+from xefab.collection import XefabCollection
+from xefab.config import Config
+from xefab.executor import MultiHostExecutor
+
+HOSTS = ["midway", "midway3", "dali"]
+
+
+@task
+def queue(c, hide=False):
+    result = c.run("sleep 0.5 && echo 42", hide=True)
+    if not hide:
+        print(result.stdout)
+    return pd.DataFrame({"JOBID": [result.stdout.strip()], "USER": [c.user]})
+
+
+def make_executor(port, connect_kwargs):
+    ssh_config = paramiko.SSHConfig.from_text(
+        f"Host {' '.join(HOSTS)}\n"
+        "    HostName 127.0.0.1\n"
+        f"    Port {port}\n"
+        "    User tester\n"
+    )
+    config = Config(
+        ssh_config=ssh_config,
+        overrides={
+            "connect_kwargs": connect_kwargs,
+            "run": {"in_stream": False},
+        },
+    )
+    host_collections = {}
+    for host in HOSTS:
+        collection = XefabCollection(host)
+        collection.configure({"hostnames": ["127.0.0.1"]})
+        collection.add_task(queue)
+        host_collections[host] = collection
+
+    core = ParseResult(
+        [ParserContext(args=[Argument(names=("hosts", "H"), default=",".join(HOSTS))])]
+    )
+    core.remainder = ""
+    return MultiHostExecutor(
+        host_collections[HOSTS[0]], config, core, host_collections=host_collections
+    )
+
+
+def test_dataframes_are_merged_with_host_column(ssh_server, connect_kwargs):
+    port, _ = ssh_server
+    executor = make_executor(port, connect_kwargs)
+
+    start = time.perf_counter()
+    results = executor.execute("queue")
+    elapsed = time.perf_counter() - start
+
+    df = results[queue]
+    assert list(df.columns) == ["host", "JOBID", "USER"]
+    assert list(df["host"]) == HOSTS
+    assert list(df["JOBID"]) == ["42"] * len(HOSTS)
+    # Latency of the slowest host, not the sum
+    assert elapsed < 0.5 * len(HOSTS)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Tests for the process-wide SSH connection pool."""
+
+# Must be imported before fabric for monkey patching to work
+import xefab.ssh_client  # isort: skip
+
+import paramiko
+
+from xefab import link
+from xefab.tasks.transfer import bench_link
+from xefab.utils import filesystem
+
+
+def test_connections_share_transport_and_sftp(ssh_server, connect):
+    port, stats = ssh_server
+    transports = stats["transports"]
+
+    first, second = connect(), connect()
+    first.open()
+    second.open()
+    assert first.transport is second.transport
+    assert first.sftp()._sftp is second.sftp()._sftp
+
+    first.close()
+    assert second.transport.is_active()
+    result = second.run("echo hello", hide=True, warn=True, in_stream=False)
+    assert result.stdout == "hello\n"
+    second.close()
+    assert stats["transports"] - transports == 1
+
+
+def test_fsspec_clients_use_the_pool(ssh_server, connect):
+    port, _ = ssh_server
+    c = connect()
+    c.open()
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect("127.0.0.1", port=port, username="tester")
+    assert client.get_transport() is c.transport
+    assert client.open_sftp()._sftp is c.sftp()._sftp
+
+
+def test_dead_transports_are_replaced(ssh_server, connect):
+    with connect() as c:
+        c.open()
+        transport = c.transport
+    transport.close()
+    with connect() as c:
+        c.run("echo hello", hide=True, warn=True, in_stream=False)
+        assert c.transport is not transport
+
+
+def test_link_settings_apply_to_new_transports(ssh_server, connect):
+    link.configure(["127.0.0.1"], {"window_size": 8 * 2**20, "prefetch": False})
+    try:
+        with connect() as c:
+            c.open()
+            assert c.transport.default_window_size == 8 * 2**20
+            assert c.sftp()._settings["prefetch"] is False
+    finally:
+        link.configure(["127.0.0.1"], {})
+
+
+def test_bench_link(connect, tmp_path):
+    with connect() as c:
+        df = bench_link(
+            c,
+            size_mb=1,
+            profiles="default,compressed",
+            remote_dir=str(tmp_path),
+            hide=True,
+        )
+    assert list(df["profile"]) == ["default", "compressed"]
+    assert (df["upload_MBps"] > 0).all() and (df["download_MBps"] > 0).all()
+    assert not list(tmp_path.iterdir())
+
+    # Fractional sizes parse from the command line
+    size_mb = {a.name: a for a in bench_link.get_arguments()}["size_mb"]
+    size_mb.set_value("0.5", cast=True)
+    assert size_mb.value == 0.5
+
+
+def test_remote_filesystem_uses_the_connection(ssh_server, connect, tmp_path):
+    port, stats = ssh_server
+    with connect() as c:
+        c.open()
+        auths, transports = stats["auths"], stats["transports"]
+        fs = filesystem(c)
+        assert filesystem(c) is fs
+        assert fs.ftp is c.sftp()
+
+        path = str(tmp_path / "sub" / "file.txt")
+        fs.makedirs(str(tmp_path / "sub"), exist_ok=True)
+        fs.write_text(path, "hello")
+        assert fs.isfile(path)
+        assert fs.cat_file(path) == b"hello"
+        assert fs.ls(str(tmp_path / "sub"), detail=False) == [path]
+
+        assert (stats["auths"], stats["transports"]) == (auths, transports)
+        assert filesystem(connect()) is not fs
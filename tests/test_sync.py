@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Tests for the rsync-free sync task."""
+
+# Must be imported before fabric for monkey patching to work
+import xefab.ssh_client  # isort: skip
+
+import os
+
+from xefab.tasks.transfer import sync
+
+
+def write(path, data, mtime=1_600_000_000):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    os.utime(path, (mtime, mtime))
+
+
+def test_sync_transfers_only_changes(ssh_server, connect, cache_dir, tmp_path):
+    port, stats = ssh_server
+    source = tmp_path / "analysis"
+    for i in range(20):
+        write(source / f"run{i // 5}" / f"part{i}.csv", f"{i}\n".encode() * 100)
+    write(source / "scratch" / "tmp.bin", b"skip me")
+    target = tmp_path / "remote"
+
+    with connect() as c:
+        report = sync(c, str(source), str(target), exclude="scratch", hide=True)
+        assert len(report["uploaded"]) == 20
+        synced = target / "analysis" / "run1" / "part7.csv"
+        assert synced.read_bytes() == b"7\n" * 100
+        assert synced.stat().st_mtime == 1_600_000_000
+        assert not (target / "analysis" / "scratch").exists()
+
+        # Unchanged trees cost the manifest command only
+        execs = stats["execs"]
+        report = sync(c, str(source), str(target), exclude="scratch", hide=True)
+        assert report == {"uploaded": [], "deleted": [], "unchanged": 20}
+        assert stats["execs"] - execs == 1
+
+        write(source / "run0" / "part1.csv", b"changed", mtime=1_700_000_000)
+        write(source / "run9" / "new.csv", b"new")
+        (source / "run2" / "part10.csv").unlink()
+        write(target / "analysis" / "scratch" / "remote.bin", b"excluded")
+        report = sync(
+            c, str(source), str(target), exclude="scratch", delete=True, dry_run=True
+        )
+        assert report["uploaded"] == ["run0/part1.csv", "run9/new.csv"]
+        assert report["deleted"] == ["run2/part10.csv"]
+        assert (target / "analysis" / "run2" / "part10.csv").exists()
+
+        sync(c, str(source), str(target), exclude="scratch", delete=True, hide=True)
+    remote = target / "analysis"
+    assert (remote / "run0" / "part1.csv").read_bytes() == b"changed"
+    assert (remote / "run9" / "new.csv").read_bytes() == b"new"
+    assert not (remote / "run2" / "part10.csv").exists()
+    # Excluded remote files are kept
+    assert (remote / "scratch" / "remote.bin").exists()
+
+
+def test_sync_with_checksum(ssh_server, connect, cache_dir, tmp_path):
+    source = tmp_path / "source"
+    write(source / "small.txt", b"a" * 10)
+    write(source / "large.raw", os.urandom(300_000))
+    target = tmp_path / "target"
+
+    with connect() as c:
+        # A trailing slash syncs the contents into the target
+        sync(c, f"{source}/", str(target), hide=True)
+        assert sorted(os.listdir(target)) == ["large.raw", "small.txt"]
+
+        # Same size and mtime, only the hash tells them apart
+        write(source / "small.txt", b"b" * 10)
+        assert sync(c, f"{source}/", str(target), hide=True)["uploaded"] == []
+        report = sync(c, f"{source}/", str(target), checksum=True, hide=True)
+        assert report["uploaded"] == ["small.txt"]
+        assert (target / "small.txt").read_bytes() == b"b" * 10
+
+        # Local and remote hashes agree for files larger than the hashed blocks
+        report = sync(c, f"{source}/", str(target), checksum=True, hide=True)
+        assert report == {"uploaded": [], "deleted": [], "unchanged": 2}
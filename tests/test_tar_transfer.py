@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Tests and benchmark of directory transfers as tar streams."""
+
+# Must be imported before fabric for monkey patching to work
+import xefab.ssh_client  # isort: skip
+
+import os
+import time
+
+import pytest
+
+from xefab import parallel_transfer, tar_transfer
+from xefab.instrumentation import recorder
+
+# Budget for moving the synthetic tree as a tar stream, in seconds.
+TAR_BUDGET_S = float(os.getenv("XEFAB_TAR_BUDGET_S", 20))
+
+N_FILES = 10000
+
+
+def make_tree(root, n_files):
+    for i in range(n_files):
+        path = root / f"job_{i % 10}" / f"out_{i % 100}" / f"file_{i}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f'{{"index": {i}}}\n')
+
+
+def files(root):
+    return {
+        str(path.relative_to(root)): path.read_bytes()
+        for path in root.rglob("*")
+        if path.is_file()
+    }
+
+
+@pytest.fixture(params=["zstd", "gzip"])
+def codec(request, monkeypatch):
+    if request.param == "gzip":
+        monkeypatch.setattr(tar_transfer, "local_zstd", lambda: None)
+    elif tar_transfer.local_zstd() is None:
+        pytest.skip("zstd is not available locally")
+    return request.param
+
+
+def test_tar_round_trip_with_globs(ssh_server, connect, tmp_path, codec):
+    source = tmp_path / "source"
+    make_tree(source, 100)
+    (source / "job_1" / "big.raw").write_bytes(os.urandom(2**20))
+    (source / "job_2" / "skip.log").write_text("log")
+    (source / "link.json").symlink_to("job_0/out_0/file_0.json")
+    (source / "empty" / "nested").mkdir(parents=True)
+
+    recorder.clear()
+    with connect() as c:
+        n_files, _, skipped = tar_transfer.download_dir(
+            c, str(source), str(tmp_path / "down"), exclude=["job_3", "*.log"]
+        )
+        expected = {
+            path: data
+            for path, data in files(source).items()
+            if not path.startswith("job_3/") and not path.endswith(".log")
+        }
+        assert files(tmp_path / "down") == expected
+        assert (tmp_path / "down" / "link.json").is_symlink()
+        assert (tmp_path / "down" / "empty" / "nested").is_dir()
+        assert not (tmp_path / "down" / "job_3").exists()
+        assert n_files == len(expected) - 1
+        assert skipped == []
+
+        n_files, _ = tar_transfer.upload_dir(
+            c, str(source), str(tmp_path / "up"), include=["*.raw", "job_0/*"]
+        )
+        assert set(files(tmp_path / "up")) == {
+            path
+            for path in files(source)
+            if path.endswith(".raw") or path.startswith("job_0/")
+        }
+        assert (tmp_path / "up" / "empty" / "nested").is_dir()
+    codecs = {r["codec"] for r in recorder.records if "codec" in r}
+    assert codecs == {"Z" if codec == "zstd" else "G"}
+
+
+@pytest.mark.parametrize("data_filter", [True, False])
+def test_unsafe_members_are_skipped(
+    ssh_server, connect, tmp_path, monkeypatch, data_filter
+):
+    if data_filter and not tar_transfer.DATA_FILTER:
+        pytest.skip("tarfile has no extraction filters")
+    monkeypatch.setattr(tar_transfer, "DATA_FILTER", data_filter)
+    source = tmp_path / "source"
+    make_tree(source, 10)
+    (source / "outside.json").symlink_to("/etc/passwd")
+    (source / "escape.json").symlink_to("../../elsewhere")
+    (source / "inside.json").symlink_to("job_1/out_1/file_1.json")
+    (source / "script.sh").write_text("#!/bin/sh\n")
+    (source / "script.sh").chmod(0o4777)
+
+    with connect() as c:
+        n_files, _, skipped = tar_transfer.download_dir(
+            c, str(source), str(tmp_path / "down")
+        )
+    down = tmp_path / "down"
+    assert sorted(name for name, _ in skipped) == ["escape.json", "outside.json"]
+    assert n_files == 11
+    assert (down / "inside.json").read_text() == '{"index": 1}\n'
+    assert not (down / "outside.json").exists()
+    assert not (down / "escape.json").exists()
+    assert (down / "script.sh").stat().st_mode & 0o7777 == 0o755
+
+
+def test_tar_is_faster_than_per_file_sftp(ssh_server, connect, tmp_path):
+    source = tmp_path / "source"
+    make_tree(source, N_FILES)
+
+    with connect() as c:
+        start = time.perf_counter()
+        n_files, _, _ = tar_transfer.download_dir(
+            c, str(source), str(tmp_path / "tar")
+        )
+        tar_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        parallel_transfer.download_dir(
+            c, str(source), str(tmp_path / "sftp"), workers=8, hide=True
+        )
+        sftp_s = time.perf_counter() - start
+
+    assert n_files == N_FILES
+    assert files(tmp_path / "tar") == files(tmp_path / "sftp")
+    assert tar_s < TAR_BUDGET_S, (
+        f"Moving {N_FILES} files as a tar stream took {tar_s:.1f}s "
+        f"(budget {TAR_BUDGET_S:.0f}s)"
+    )
+    assert tar_s < sftp_s, f"tar {tar_s:.1f}s, per-file SFTP {sftp_s:.1f}s"
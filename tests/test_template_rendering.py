@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Template rendering benchmark for per-job scripts."""
+
+import os
+import string
+import time
+
+from xefab.file_access import TemplateFile
+
+# Budget for constructing and rendering N_INSTANCES templates, in seconds.
+RENDER_BUDGET_S = float(os.getenv("XEFAB_RENDER_BUDGET_S", 10))
+
+N_INSTANCES = 100000
+
+
+class JobScript(TemplateFile):
+    __TEMPLATE__ = """#!/bin/bash
+#SBATCH --job-name={job_name}
+#SBATCH --output={log_dir}/{job_name}.log
+#SBATCH --partition={partition}
+cd {workdir}
+{command} --run {run_id:06d}
+"""
+
+    run_id: int
+    partition: str = "xenon1t"
+    # Defaults referring to fields defined after them
+    log_dir: str = "{workdir}/logs"
+    workdir: str = "/scratch/{job_name}"
+    job_name: str = "job_{run_id}"
+    command: str = "python process.py"
+
+
+def test_fields_are_interpolated_in_dependency_order():
+    order = JobScript.interpolation_order()
+    assert order.index("log_dir") > order.index("workdir") > order.index("job_name")
+    script = JobScript(filename="job.sh", run_id=7).read_text()
+    assert "#SBATCH --output=/scratch/job_7/logs/job_7.log\n" in script
+    assert "python process.py --run 000007\n" in script
+
+    script = JobScript(filename="job.sh", run_id=7, workdir="/data/{partition}")
+    script = script.read_text()
+    assert "cd /data/xenon1t\n" in script
+
+
+def test_templates_are_parsed_once(monkeypatch):
+    JobScript(filename="job.sh", run_id=1, workdir="/data/{partition}").read_text()
+
+    def parse(self, text):
+        raise AssertionError(f"{text!r} parsed again")
+
+    monkeypatch.setattr(string.Formatter, "parse", parse)
+    script = JobScript(filename="job.sh", run_id=2, workdir="/data/{partition}")
+    assert "cd /data/xenon1t\n" in script.read_text()
+    assert "--run 000002\n" in script.read_text()
+
+
+def test_rendering_time():
+    start = time.perf_counter()
+    scripts = [
+        JobScript(filename=f"job_{i}.sh", run_id=i).read_text()
+        for i in range(N_INSTANCES)
+    ]
+    elapsed = time.perf_counter() - start
+    assert f"--job-name=job_{N_INSTANCES - 1}\n" in scripts[-1]
+    assert elapsed < RENDER_BUDGET_S, (
+        f"Rendering {N_INSTANCES} templates took {elapsed:.1f}s "
+        f"(budget {RENDER_BUDGET_S:.0f}s)"
+    )
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Tests for the file transfer tasks."""
+
+# Must be imported before fabric for monkey patching to work
+import xefab.ssh_client  # isort: skip
+
+import os
+
+import pytest
+
+from xefab import parallel_transfer
+from xefab.instrumentation import recorder
+from xefab.tasks.transfer import download_file, upload_dir, upload_file
+
+CHUNK = 64 * 2**10
+
+
+@pytest.fixture
+def data():
+    return os.urandom(10 * CHUNK + 123)
+
+
+def transferred(op):
+    records = [r for r in recorder.records if r["op"] == op]
+    return sum(r["bytes_in"] + r["bytes_out"] for r in records)
+
+
+def test_parallel_download_and_upload(ssh_server, connect, cache_dir, tmp_path, data):
+    source = tmp_path / "source.raw"
+    source.write_bytes(data)
+    source.chmod(0o640)
+
+    with connect() as c:
+        local = str(tmp_path / "downloaded.raw")
+        parallel_transfer.download(c, str(source), local, streams=4, chunk_size=CHUNK)
+        assert open(local, "rb").read() == data
+        assert os.stat(local).st_mode & 0o777 == 0o640
+
+        remote = parallel_transfer.upload(
+            c, local, str(tmp_path / "uploaded.raw"), streams=4, chunk_size=CHUNK
+        )
+        assert open(remote, "rb").read() == data
+
+        download_file(c, str(source), str(tmp_path / "task.raw"), streams=3)
+        upload_file(c, str(source), str(tmp_path / "task_up.raw"), streams=3)
+    assert (tmp_path / "task.raw").read_bytes() == data
+    assert (tmp_path / "task_up.raw").read_bytes() == data
+    assert not list(tmp_path.glob("*.part"))
+    assert not list(cache_dir.glob("transfers/*.json"))
+
+
+@pytest.mark.parametrize("direction", ["download", "upload"])
+def test_interrupted_transfers_resume(
+    ssh_server, connect, cache_dir, tmp_path, data, monkeypatch, direction
+):
+    source, target = tmp_path / "source.raw", tmp_path / "target.raw"
+    source.write_bytes(data)
+    transfer = getattr(parallel_transfer, direction)
+    mark = parallel_transfer.TransferJournal.mark
+
+    def interrupt(journal, index):
+        if len(journal.done) == 3:
+            raise ConnectionError("link lost")
+        mark(journal, index)
+
+    with connect() as c:
+        monkeypatch.setattr(parallel_transfer.TransferJournal, "mark", interrupt)
+        with pytest.raises(ConnectionError):
+            transfer(c, str(source), str(target), streams=1, chunk_size=CHUNK)
+        assert not target.exists()
+
+        monkeypatch.setattr(parallel_transfer.TransferJournal, "mark", mark)
+        recorder.clear()
+        transfer(c, str(source), str(target), streams=2, resume=True, chunk_size=CHUNK)
+    assert target.read_bytes() == data
+    op = "get" if direction == "download" else "put"
+    assert transferred(op) == len(data) - 3 * CHUNK
+
+
+def make_tree(root, n_files=150):
+    for i in range(n_files):
+        path = root / f"run_{i % 7}" / f"sub_{i % 3}" / f"file_{i}.txt"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"content {i}\n" * (i + 1))
+    (root / "empty").mkdir()
+    (root / "large.raw").write_bytes(os.urandom(3 * 2**20))
+
+
+def tree(root):
+    return {
+        str(path.relative_to(root)): path.read_bytes() if path.is_file() else None
+        for path in root.rglob("*")
+    }
+
+
+def test_directory_download_and_upload(ssh_server, connect, tmp_path):
+    source = tmp_path / "source"
+    make_tree(source)
+    (source / "link.txt").symlink_to(source / "large.raw")
+
+    with connect() as c:
+        n_files, n_bytes = parallel_transfer.download_dir(
+            c, str(source), str(tmp_path / "downloaded"), workers=4, hide=True
+        )
+        assert n_files == 152
+        downloaded = tree(tmp_path / "downloaded")
+        assert downloaded == tree(source)
+
+        upload_dir(c, str(tmp_path / "downloaded"), str(tmp_path / "uploaded"), hide=True)
+    assert tree(tmp_path / "uploaded") == downloaded
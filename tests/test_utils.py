@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Tests for the xefab utilities."""
+
+# Must be imported before fabric for monkey patching to work
+import xefab.ssh_client  # isort: skip
+
+import pytest
+from fabric import Connection
+from invoke.context import Context
+
+from xefab.utils import try_local
+
+
+def test_try_local_decorator_forms(monkeypatch):
+    calls = []
+
+    def run(c, fail_with=None):
+        calls.append(type(c))
+        if fail_with is not None and not isinstance(c, Connection):
+            raise fail_with
+        return "done"
+
+    monkeypatch.setattr(Connection, "open", lambda self: None)
+    c = Connection("localhost")
+    for wrapped in (
+        try_local(run),
+        try_local()(run),
+        try_local(KeyError)(run),
+        try_local((KeyError, ValueError))(run),
+        try_local(exception=KeyError)(run),
+    ):
+        calls.clear()
+        assert wrapped(c, fail_with=KeyError()) == "done"
+        assert calls == [Context, Connection]
+
+    calls.clear()
+    assert try_local(run)(c, force_remote=True) == "done"
+    assert calls == [Connection]
+
+    # Other exceptions are not caught
+    with pytest.raises(KeyError):
+        try_local(ValueError)(run)(c, fail_with=KeyError())
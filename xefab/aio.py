@@ -0,0 +1,350 @@
+"""Async flavour of the connection API.
+
+`async def` tasks registered with `xefab.tasks.main.task` run in an
+event loop and receive an `AsyncConnection` (an `AsyncContext` for local
+tasks) wrapping the Fabric connection:
+
+    @task
+    async def wait(c, job_id: int):
+        await wait_for_job(c, job_id, states=())
+
+Remote commands run on channels of the connection's (pooled) transport
+and are awaited through the channel's file descriptor, so thousands of
+concurrent remote waits and polls share the event loop thread instead
+of needing one OS thread each. Transfers run in the loop's default
+executor. Cancelling an awaiting coroutine closes its channel.
+
+sshd caps the sessions open at once on a connection (OpenSSH's
+MaxSessions, 10 by default), so commands beyond `max_sessions` on a
+transport wait for a channel to close before opening theirs.
+"""
+
+import asyncio
+import contextlib
+import functools
+import shlex
+import sys
+import weakref
+
+from fabric.connection import Connection
+from fabric.runners import Result as RemoteResult
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result, normalize_hide
+
+from xefab.instrumentation import recorder
+
+CHUNK_SIZE = 32768
+
+# OpenSSH's default MaxSessions
+MAX_SESSIONS = 10
+
+# Semaphores capping the open sessions, by event loop and transport
+_session_limits = weakref.WeakKeyDictionary()
+
+
+async def in_thread(func, *args, **kwargs):
+    """Run a blocking call in the loop's default executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+class ChannelWatcher:
+    """Wakes the event loop when a channel has data or reached EOF."""
+
+    def __init__(self, channel):
+        self.loop = asyncio.get_running_loop()
+        self.fd = channel.fileno()
+        self.event = asyncio.Event()
+        self.loop.add_reader(self.fd, self.event.set)
+
+    async def wait(self):
+        await self.event.wait()
+        self.event.clear()
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+
+
+def drain(channel, chunks, stderr=False):
+    """Read what a channel stream has buffered without blocking,
+    returns False once the stream reached EOF.
+    """
+    if stderr:
+        ready, recv = channel.recv_stderr_ready, channel.recv_stderr
+    else:
+        ready, recv = channel.recv_ready, channel.recv
+    while ready():
+        chunks.append(recv(CHUNK_SIZE))
+    if channel.eof_received or channel.closed:
+        # Data is buffered before the EOF, read what came in meanwhile
+        while ready():
+            chunks.append(recv(CHUNK_SIZE))
+        return False
+    return True
+
+
+class AsyncContext:
+    """Async counterpart of an invoke context, commands run locally.
+    Other attributes (config, user, host, ...) are those of the
+    wrapped context.
+    """
+
+    def __init__(self, c):
+        self.c = c
+
+    def __getattr__(self, name):
+        return getattr(self.c, name)
+
+    @property
+    def encoding(self):
+        return self.c.config.run.encoding or "utf-8"
+
+    result_class = Result
+
+    def _result(self, command, stdout, stderr, exited, hide, warn, **kwargs):
+        result = self.result_class(
+            stdout=stdout.decode(self.encoding, errors="replace"),
+            stderr=stderr.decode(self.encoding, errors="replace"),
+            encoding=self.encoding,
+            command=command,
+            exited=exited,
+            hide=normalize_hide(hide),
+            **kwargs,
+        )
+        if "stdout" not in result.hide:
+            sys.stdout.write(result.stdout)
+        if "stderr" not in result.hide:
+            sys.stderr.write(result.stderr)
+        if result.failed and not warn:
+            raise UnexpectedExit(result)
+        return result
+
+    async def local(
+        self, command: str, hide=None, warn: bool = False, env=None, timeout=None
+    ):
+        """Run a command locally, returns its `Result`."""
+        process = await asyncio.create_subprocess_shell(
+            command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        return self._result(command, stdout, stderr, process.returncode, hide, warn)
+
+    run = local
+
+
+def session_limit(transport, max_sessions=MAX_SESSIONS):
+    """The semaphore capping the sessions open on a transport,
+    shared by the connections of the running loop using it.
+    """
+    limits = _session_limits.setdefault(
+        asyncio.get_running_loop(), weakref.WeakKeyDictionary()
+    )
+    limit = limits.get(transport, None)
+    if limit is None:
+        limit = limits[transport] = asyncio.Semaphore(max_sessions)
+    return limit
+
+
+class AsyncConnection(AsyncContext):
+    """Async counterpart of a Fabric `Connection`, with at most
+    max_sessions commands running at once on its transport.
+    """
+
+    def __init__(self, c, max_sessions=MAX_SESSIONS):
+        super().__init__(c)
+        self.max_sessions = max_sessions
+
+    @property
+    def result_class(self):
+        return functools.partial(RemoteResult, connection=self.c)
+
+    async def open(self):
+        if not self.c.is_connected:
+            await in_thread(self.c.open)
+
+    @contextlib.asynccontextmanager
+    async def _exec(self, command):
+        """An exec channel, closed on exit, once the transport has a
+        session to spare.
+        """
+        await self.open()
+        transport = self.c.transport
+
+        def start():
+            channel = transport.open_session()
+            channel.exec_command(command)
+            return channel
+
+        async with session_limit(transport, self.max_sessions):
+            channel = await in_thread(start)
+            try:
+                yield channel
+            finally:
+                channel.close()
+
+    async def run(
+        self, command: str, hide=None, warn: bool = False, env=None, timeout=None
+    ):
+        """Run a command on the remote host, returns its `Result`.
+        Raises `asyncio.TimeoutError` after `timeout` seconds.
+        """
+        env = dict(self.c.config.run.env or {}, **(env or {}))
+        remote_command = command
+        if env:
+            exports = " ".join(f"{k}={shlex.quote(str(v))}" for k, v in env.items())
+            remote_command = f"export {exports} && {command}"
+
+        with recorder.record(
+            "run", host=self.c.host, command=command, bytes_out=len(command), nest=False
+        ) as record:
+            result = await self._run(remote_command, command, hide, warn, timeout)
+            record["bytes_in"] = len(result.stdout) + len(result.stderr)
+            record["exited"] = result.exited
+            return result
+
+    async def _run(self, remote_command, command, hide, warn, timeout):
+        stdout, stderr = [], []
+        async with self._exec(remote_command) as channel:
+            watcher = ChannelWatcher(channel)
+
+            async def collect():
+                out, err = True, True
+                while out or err:
+                    out = out and drain(channel, stdout)
+                    err = err and drain(channel, stderr, stderr=True)
+                    if out or err:
+                        await watcher.wait()
+                # Both streams are at EOF, the exit status follows shortly
+                watcher.close()
+                if not channel.exit_status_ready():
+                    return await in_thread(channel.recv_exit_status)
+                return channel.recv_exit_status()
+
+            try:
+                exited = await asyncio.wait_for(collect(), timeout)
+            finally:
+                watcher.close()
+        return self._result(
+            command, b"".join(stdout), b"".join(stderr), exited, hide, warn
+        )
+
+    async def put(self, *args, **kwargs):
+        """Upload a file, as `Connection.put`."""
+        await self.open()
+        return await in_thread(self.c.put, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        """Download a file, as `Connection.get`."""
+        await self.open()
+        return await in_thread(self.c.get, *args, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def forward_local(
+        self,
+        local_port: int,
+        remote_port: int = None,
+        remote_host: str = "localhost",
+        local_host: str = "localhost",
+    ):
+        """Forward a local port to a port reachable from the remote host,
+        as `Connection.forward_local`, for the duration of the context.
+        """
+        if remote_port is None:
+            remote_port = local_port
+        await self.open()
+        transport = self.c.transport
+        handlers = set()
+
+        async def forward(reader, writer):
+            handlers.add(asyncio.current_task())
+            channel = None
+            try:
+                channel = await in_thread(
+                    transport.open_channel,
+                    "direct-tcpip",
+                    (remote_host, remote_port),
+                    writer.get_extra_info("peername")[:2],
+                )
+                await asyncio.gather(
+                    self._send_to_channel(reader, channel),
+                    self._recv_from_channel(channel, writer),
+                )
+            finally:
+                if channel is not None:
+                    channel.close()
+                writer.close()
+                handlers.discard(asyncio.current_task())
+
+        server = await asyncio.start_server(forward, local_host, local_port)
+        try:
+            yield server
+        finally:
+            server.close()
+            for handler in list(handlers):
+                handler.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            await server.wait_closed()
+
+    @staticmethod
+    async def _send_to_channel(reader, channel):
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                channel.shutdown_write()
+                return
+            await in_thread(channel.sendall, data)
+
+    @staticmethod
+    async def _recv_from_channel(channel, writer):
+        watcher = ChannelWatcher(channel)
+        try:
+            while True:
+                chunks = []
+                more = drain(channel, chunks)
+                for chunk in chunks:
+                    writer.write(chunk)
+                await writer.drain()
+                if not more:
+                    if writer.can_write_eof():
+                        writer.write_eof()
+                    return
+                await watcher.wait()
+        finally:
+            watcher.close()
+
+
+def async_context(c):
+    """Wrap a context for use by async tasks."""
+    if isinstance(c, Connection):
+        return AsyncConnection(c)
+    return AsyncContext(c)
+
+
+def async_task_body(f):
+    """Make a coroutine function usable as a task body. Called from
+    synchronous code the coroutine runs in a new event loop, within a
+    running loop the coroutine is returned to be awaited.
+    """
+
+    @functools.wraps(f)
+    def body(c, *args, **kwargs):
+        if not isinstance(c, AsyncContext):
+            c = async_context(c)
+        coroutine = f(c, *args, **kwargs)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coroutine)
+        return coroutine
+
+    return body
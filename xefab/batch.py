@@ -0,0 +1,181 @@
+"""Run queued commands as one remote script.
+
+Every `c.run` opens its own exec channel and waits a full round trip to
+the remote host. A `RemoteBatch` queues commands and sends them as a
+single script, each command running in its own subshell between unique
+markers, so the output can be split back into one `Result` per command
+with its own exit code, stdout and stderr.
+
+    with RemoteBatch(c) as batch:
+        scratch = batch.run("echo $SCRATCH", warn=True)
+        batch.run(f"mkdir -p {workdir}")
+    print(scratch.stdout)
+
+Results are available once the batch is executed, which happens when
+the context exits or when a result is first accessed.
+"""
+
+import re
+import sys
+import uuid
+
+from fabric.connection import Connection
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import normalize_hide
+
+
+class PendingResult:
+    """Result of a queued command, executes the batch on first access."""
+
+    def __init__(self, batch, command, warn=False, hide=None):
+        self.batch = batch
+        self.command = command
+        self.warn = warn
+        self.hide = hide
+        self.result = None
+
+    def _resolve(self):
+        if self.result is None:
+            self.batch.execute()
+        if self.result is None:
+            raise RuntimeError(
+                f"{self.command!r} was not run, an earlier command failed."
+            )
+        return self.result
+
+    def __getattr__(self, name):
+        if name in ("batch", "command", "warn", "hide", "result"):
+            raise AttributeError(name)
+        return getattr(self._resolve(), name)
+
+    def __bool__(self):
+        return bool(self._resolve())
+
+    def __repr__(self):
+        if self.result is None:
+            return f"<PendingResult cmd={self.command!r}>"
+        return repr(self.result)
+
+
+class RemoteBatch:
+    """Queue of commands executed as one script on a single channel.
+
+    Commands run in order, each in a subshell with stdin from /dev/null.
+    As with sequential `c.run` calls, a failing command queued without
+    `warn` stops the script and raises `UnexpectedExit` on execution.
+    Keyword arguments (e.g. env, timeout) are passed to the run of the
+    whole script. With `local` the script runs on the local host.
+    """
+
+    def __init__(self, c, local: bool = False, **kwargs):
+        self.c = c
+        self.local = local
+        self.kwargs = kwargs
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.execute()
+
+    def run(self, command: str, warn: bool = False, hide=None) -> PendingResult:
+        """Queue a command, returns its pending result."""
+        pending = PendingResult(self, command, warn=warn, hide=hide)
+        self.pending.append(pending)
+        return pending
+
+    @staticmethod
+    def script(pending, token):
+        """The script running the queued commands between markers."""
+        lines = []
+        for i, item in enumerate(pending):
+            lines += [
+                f"printf '%s\\n' '{token} {i}'",
+                f"printf '%s\\n' '{token} {i}' >&2",
+                "(",
+                item.command,
+                ") </dev/null",
+                "__xefab_rc=$?",
+                f"printf '\\n%s %s\\n' '{token} {i}' $__xefab_rc",
+                f"printf '\\n%s\\n' '{token} {i}' >&2",
+            ]
+            if not item.warn:
+                lines.append(
+                    '[ "$__xefab_rc" -eq 0 ] || exit "$__xefab_rc"'
+                )
+        return "\n".join(lines) + "\n"
+
+    def execute(self):
+        """Run the queued commands, returns their results."""
+        pending, self.pending = self.pending, []
+        if not pending:
+            return []
+
+        token = f"__xefab_{uuid.uuid4().hex}"
+        script = self.script(pending, token)
+
+        if self.local and isinstance(self.c, Connection):
+            runner = self.c.local
+        else:
+            runner = self.c.run
+        kwargs = dict(self.kwargs, hide=True, warn=True, in_stream=False)
+        result = runner(script, **kwargs)
+
+        stdout = {
+            int(m.group(1)): (m.group(2), int(m.group(3)))
+            for m in re.finditer(
+                rf"^{token} (\d+)\n(.*?)\n{token} \1 (\d+)\n",
+                result.stdout,
+                re.S | re.M,
+            )
+        }
+        stderr = {
+            int(m.group(1)): m.group(2)
+            for m in re.finditer(
+                rf"^{token} (\d+)\n(.*?)\n{token} \1\n",
+                result.stderr,
+                re.S | re.M,
+            )
+        }
+
+        results = []
+        for i, item in enumerate(pending):
+            if i in stdout:
+                out, exited = stdout[i]
+                err = stderr.get(i, "")
+            else:
+                # The script stopped before finishing this command
+                out, exited, err = "", result.exited or -1, result.stderr
+            item.result = self.make_result(result, item.command, out, err, exited)
+            hidden = normalize_hide(item.hide)
+            if "stdout" not in hidden:
+                sys.stdout.write(out)
+            if "stderr" not in hidden:
+                sys.stderr.write(err)
+            results.append(item.result)
+
+            if item.result.failed and not item.warn:
+                raise UnexpectedExit(item.result)
+            if i not in stdout:
+                break
+        return results
+
+    @staticmethod
+    def make_result(result, command, stdout, stderr, exited):
+        """A result of the same kind as the script's for one command."""
+        kwargs = dict(
+            stdout=stdout,
+            stderr=stderr,
+            encoding=result.encoding,
+            command=command,
+            shell=result.shell,
+            env=result.env,
+            exited=exited,
+            pty=result.pty,
+            hide=result.hide,
+        )
+        if hasattr(result, "connection"):
+            kwargs["connection"] = result.connection
+        return type(result)(**kwargs)
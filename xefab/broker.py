@@ -0,0 +1,808 @@
+"""Broker holding authenticated SSH transports between xefab invocations.
+
+Logging in to hosts with two-factor (Duo) authentication takes several
+seconds and a phone push. The broker is a local process, reachable over
+a Unix socket in the user's runtime directory, that keeps authenticated
+transports open until they have been idle for a TTL. While it runs,
+`xefab.ssh_client.SSHClient` opens its channels through the broker
+instead of connecting and authenticating itself.
+
+Each connection to the broker socket carries a single request: a json
+message, a json reply and then the data of the requested channel. Exec
+sessions are framed to carry stdin, stdout, stderr and the exit status,
+sftp and direct-tcpip channels are relayed as raw bytes.
+
+Requests carry passwords and passphrases, so clients only talk to a
+socket in a directory private to the user (mode 0o700, owned by the
+user, in a parent only the user or root can modify) and, where the
+platform reports it, served by a process of the same user. Otherwise
+they connect directly. The broker likewise only serves its own user.
+"""
+
+import argparse
+import getpass
+import json
+import os
+import select
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+from invoke.util import debug
+from paramiko.buffered_pipe import BufferedPipe, PipeTimeout
+from paramiko.pipe import make_or_pipe, make_pipe
+from paramiko.ssh_exception import AuthenticationException, SSHException
+
+from xefab.pool import DEFAULT_KEEPALIVE
+
+DEFAULT_TTL = 3600
+
+CHUNK_SIZE = 32768
+
+# Frame kinds of exec sessions
+STDIN = b"i"
+STDOUT = b"o"
+STDERR = b"e"
+EOF = b"f"
+RESIZE = b"w"
+STATUS = b"s"
+
+_FRAME = struct.Struct("!cI")
+_LENGTH = struct.Struct("!I")
+
+# Keyword arguments of SSHClient.connect that can be sent to the broker
+CONNECT_PARAMS = (
+    "port",
+    "username",
+    "password",
+    "key_filename",
+    "timeout",
+    "allow_agent",
+    "look_for_keys",
+    "compress",
+    "gss_auth",
+    "gss_kex",
+    "gss_deleg_creds",
+    "gss_host",
+    "gss_trust_dns",
+    "banner_timeout",
+    "auth_timeout",
+    "channel_timeout",
+    "passphrase",
+    "disabled_algorithms",
+)
+
+HOST_KEY_POLICIES = {
+    "AutoAddPolicy": paramiko.AutoAddPolicy,
+    "WarningPolicy": paramiko.WarningPolicy,
+    "RejectPolicy": paramiko.RejectPolicy,
+}
+
+
+class BrokerError(SSHException):
+    """The broker failed to handle a request."""
+
+
+class UntrustedBrokerError(BrokerError):
+    """The broker socket could have been set up by another user."""
+
+
+class BrokerSocket(socket.socket):
+    """Connection to the broker, usable in place of a raw channel."""
+
+    def get_name(self):
+        return "xefab-broker"
+
+
+def runtime_dir():
+    """The user's runtime directory, falls back to a private temp directory."""
+    path = os.getenv("XDG_RUNTIME_DIR")
+    if not path:
+        path = os.path.join(tempfile.gettempdir(), f"xefab-{os.getuid()}")
+    return path
+
+
+def private_dir(directory):
+    """Whether only the user can place a socket in a directory:
+    owned by the user with mode 0o700, in a parent owned by the user or root.
+    """
+    try:
+        info = os.lstat(directory)
+        parent = os.lstat(os.path.dirname(os.path.abspath(directory)))
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(info.st_mode)
+        and info.st_uid == os.getuid()
+        and stat.S_IMODE(info.st_mode) == 0o700
+        and parent.st_uid in (os.getuid(), 0)
+    )
+
+
+def peer_uid(sock):
+    """uid of the process on the other end of a Unix socket,
+    None if the platform does not report it.
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+
+def check_peer(sock):
+    uid = peer_uid(sock)
+    if uid is not None and uid != os.getuid():
+        raise UntrustedBrokerError(f"The broker socket is served by uid {uid}")
+
+
+def socket_path():
+    """Path of the broker socket."""
+    path = os.getenv("XEFAB_BROKER_SOCKET")
+    if path:
+        return path
+    return os.path.join(runtime_dir(), "xefab", "broker.sock")
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode()
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    """Read exactly size bytes, None if the connection closes first."""
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def recv_message(sock):
+    header = recv_exactly(sock, _LENGTH.size)
+    if header is None:
+        return None
+    data = recv_exactly(sock, _LENGTH.unpack(header)[0])
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+def send_frame(sock, kind, payload=b""):
+    sock.sendall(_FRAME.pack(kind, len(payload)) + payload)
+
+
+def recv_frame(sock):
+    """Read a frame, returns (None, None) once the connection is closed."""
+    header = recv_exactly(sock, _FRAME.size)
+    if header is None:
+        return None, None
+    kind, size = _FRAME.unpack(header)
+    payload = recv_exactly(sock, size) if size else b""
+    if payload is None:
+        return None, None
+    return kind, payload
+
+
+def transport_key(params):
+    return f"{params['username']}@{params['hostname']}:{params['port']}"
+
+
+def connect_params(client, hostname, **kwargs):
+    """The parameters of an SSHClient.connect call to send to the broker.
+    Returns None if the call can not go through the broker, e.g. if it
+    passes a socket or key object.
+    """
+    kwargs = {k: v for k, v in kwargs.items() if v is not None}
+    if set(kwargs) - set(CONNECT_PARAMS):
+        return None
+    params = dict(kwargs, hostname=hostname)
+    params.setdefault("port", 22)
+    params.setdefault("username", getpass.getuser())
+    params["missing_host_key_policy"] = type(client._policy).__name__
+    try:
+        json.dumps(params)
+    except (TypeError, ValueError):
+        return None
+    return params
+
+
+def request(message, path=None, timeout=None):
+    """Send a request to the broker.
+    Returns the reply and the connected socket, which carries
+    the data of the requested channel if any.
+    """
+    path = path or socket_path()
+    # Requests carry credentials, only send them to a broker of the user
+    if not private_dir(os.path.dirname(os.path.abspath(path))):
+        raise UntrustedBrokerError(
+            f"The directory of {path} is not private to the user, not using it"
+        )
+    sock = BrokerSocket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        check_peer(sock)
+        send_message(sock, message)
+        reply = recv_message(sock)
+    except BaseException:
+        sock.close()
+        raise
+    if reply is None:
+        sock.close()
+        raise BrokerError("The xefab broker closed the connection")
+    if not reply.get("ok", False):
+        sock.close()
+        if reply.get("type") == "AuthenticationException":
+            raise AuthenticationException(reply.get("error"))
+        raise BrokerError(reply.get("error"))
+    sock.settimeout(None)
+    return reply, sock
+
+
+def ping(path=None, timeout=1):
+    """Status of the running broker, None if it is not running."""
+    try:
+        reply, sock = request({"op": "ping"}, path=path, timeout=timeout)
+    except (OSError, SSHException):
+        return None
+    sock.close()
+    return reply
+
+
+def shutdown(path=None, timeout=1):
+    """Stop the running broker, returns False if it was not running."""
+    try:
+        _, sock = request({"op": "shutdown"}, path=path, timeout=timeout)
+    except (OSError, SSHException):
+        return False
+    sock.close()
+    return True
+
+
+def open_transport(client, hostname, **kwargs):
+    """Authenticate through the broker if it is running.
+    Returns a `BrokerTransport` or None if the broker can not be used.
+    """
+    if os.getenv("XEFAB_BROKER", "1") == "0":
+        return None
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    params = connect_params(client, hostname, **kwargs)
+    if params is None:
+        return None
+    try:
+        _, sock = request({"op": "connect", "params": params}, path=path)
+    except (OSError, UntrustedBrokerError) as e:
+        debug(f"xefab: broker at {path} is not usable: {e}")
+        return None
+    sock.close()
+    debug(f"xefab: using broker transport for {transport_key(params)}")
+    return BrokerTransport(path, params)
+
+
+class BrokerChannel:
+    """Session channel opened through the broker.
+    Implements the parts of `paramiko.Channel` used by Fabric.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.sock = None
+        self.pty = None
+        self.env = {}
+        self.timeout = None
+        self.combine_stderr = False
+        self.closed = False
+        self.eof_received = False
+        self.exit_status = -1
+        self.status_event = threading.Event()
+        self.in_buffer = BufferedPipe()
+        self.in_stderr_buffer = BufferedPipe()
+        self._pipe = None
+
+    @property
+    def active(self):
+        return self.sock is not None and not self.closed
+
+    def get_transport(self):
+        return self.transport
+
+    def get_pty(
+        self, term="vt100", width=80, height=24, width_pixels=0, height_pixels=0
+    ):
+        self.pty = [term, width, height, width_pixels, height_pixels]
+
+    def update_environment(self, environment):
+        self.env.update(environment)
+
+    def set_environment_variable(self, name, value):
+        self.env[name] = value
+
+    def set_combine_stderr(self, combine):
+        old, self.combine_stderr = self.combine_stderr, combine
+        return old
+
+    def request_forward_agent(self, handler):
+        raise SSHException("Agent forwarding is not supported through the broker")
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def exec_command(self, command):
+        self._start(command=command)
+
+    def invoke_shell(self):
+        self._start(shell=True)
+
+    def invoke_subsystem(self, subsystem):
+        self._start(subsystem=subsystem)
+
+    def _start(self, **message):
+        if self.sock is not None:
+            raise SSHException("Channel is already in use")
+        message.update(op="session", pty=self.pty, env=self.env)
+        self.sock = self.transport._request(message)
+        thread = threading.Thread(target=self._read_frames, daemon=True)
+        thread.start()
+
+    def _read_frames(self):
+        try:
+            while True:
+                kind, payload = recv_frame(self.sock)
+                if kind is None:
+                    break
+                if kind == STDOUT:
+                    self.in_buffer.feed(payload)
+                elif kind == STDERR:
+                    if self.combine_stderr:
+                        self.in_buffer.feed(payload)
+                    else:
+                        self.in_stderr_buffer.feed(payload)
+                elif kind == STATUS:
+                    self.exit_status = struct.unpack("!i", payload)[0]
+                    break
+        except OSError:
+            pass
+        finally:
+            self.eof_received = True
+            self.in_buffer.close()
+            self.in_stderr_buffer.close()
+            self.status_event.set()
+
+    def _read(self, buffer, nbytes):
+        try:
+            return buffer.read(nbytes, self.timeout)
+        except PipeTimeout:
+            raise socket.timeout()
+
+    def recv(self, nbytes):
+        return self._read(self.in_buffer, nbytes)
+
+    def recv_stderr(self, nbytes):
+        return self._read(self.in_stderr_buffer, nbytes)
+
+    def recv_ready(self):
+        return self.in_buffer.read_ready()
+
+    def recv_stderr_ready(self):
+        return self.in_stderr_buffer.read_ready()
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        send_frame(self.sock, STDIN, data)
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def shutdown_write(self):
+        send_frame(self.sock, EOF)
+
+    def resize_pty(self, width=80, height=24, width_pixels=0, height_pixels=0):
+        send_frame(self.sock, RESIZE, struct.pack("!II", width, height))
+
+    def exit_status_ready(self):
+        return self.status_event.is_set()
+
+    def fileno(self):
+        """A file descriptor readable when there is data or at EOF,
+        as `paramiko.Channel.fileno`.
+        """
+        if self._pipe is None:
+            self._pipe = make_pipe()
+            stdout_event, stderr_event = make_or_pipe(self._pipe)
+            self.in_buffer.set_event(stdout_event)
+            self.in_stderr_buffer.set_event(stderr_event)
+        return self._pipe.fileno()
+
+    def recv_exit_status(self):
+        self.status_event.wait()
+        return self.exit_status
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.sock is not None:
+            self.sock.close()
+        self.in_buffer.close()
+        self.in_stderr_buffer.close()
+        if self._pipe is not None:
+            self._pipe.close()
+
+
+class BrokerTransport:
+    """Stand-in for an authenticated `paramiko.Transport` held by the broker.
+    Channels opened on it are relayed through the broker socket.
+    """
+
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self.active = True
+
+    def __repr__(self):
+        return f"<BrokerTransport {transport_key(self.params)}>"
+
+    def is_active(self):
+        return self.active
+
+    def is_authenticated(self):
+        return self.active
+
+    def get_username(self):
+        return self.params["username"]
+
+    def getpeername(self):
+        return self.params["hostname"], self.params["port"]
+
+    def set_keepalive(self, interval):
+        # The broker keeps its transports alive
+        pass
+
+    def _request(self, message):
+        if not self.active:
+            raise SSHException("SSH session not active")
+        message = dict(message, params=self.params)
+        _, sock = request(message, path=self.path)
+        return sock
+
+    def open_session(self, *args, **kwargs):
+        if not self.active:
+            raise SSHException("SSH session not active")
+        return BrokerChannel(self)
+
+    def open_channel(self, kind, dest_addr=None, src_addr=None, *args, **kwargs):
+        if kind == "session":
+            return self.open_session()
+        if kind != "direct-tcpip":
+            raise SSHException(f"{kind} channels are not supported by the broker")
+        message = {
+            "op": "direct-tcpip",
+            "dest_addr": list(dest_addr),
+            "src_addr": list(src_addr or ("", 0)),
+        }
+        return self._request(message)
+
+    def open_sftp_client(self):
+        sock = self._request({"op": "session", "subsystem": "sftp", "raw": True})
+        return paramiko.SFTPClient(sock)
+
+    def request_port_forward(self, *args, **kwargs):
+        raise SSHException("Remote port forwarding is not supported by the broker")
+
+    def close(self):
+        # The authenticated transport stays open in the broker
+        self.active = False
+
+
+def relay_session(sock, channel):
+    """Relay an exec session between a broker client and its channel."""
+    while True:
+        readable, _, _ = select.select([sock, channel], [], [], 0.5)
+        while channel.recv_stderr_ready():
+            send_frame(sock, STDERR, channel.recv_stderr(CHUNK_SIZE))
+        while channel.recv_ready():
+            send_frame(sock, STDOUT, channel.recv(CHUNK_SIZE))
+        if sock in readable:
+            kind, payload = recv_frame(sock)
+            if kind is None:
+                return
+            if kind == STDIN:
+                channel.sendall(payload)
+            elif kind == EOF:
+                channel.shutdown_write()
+            elif kind == RESIZE:
+                width, height = struct.unpack("!II", payload)
+                channel.resize_pty(width=width, height=height)
+        # Data arrives before the exit status, so the buffers
+        # are only empty after the exit status if all data was sent.
+        if (
+            channel.exit_status_ready()
+            and not channel.recv_ready()
+            and not channel.recv_stderr_ready()
+        ):
+            status = channel.recv_exit_status()
+            send_frame(sock, STATUS, struct.pack("!i", status))
+            return
+
+
+def relay_raw(sock, channel):
+    """Relay raw bytes between a broker client and its channel."""
+    while True:
+        readable, _, _ = select.select([sock, channel], [], [], 0.5)
+        if sock in readable:
+            data = sock.recv(CHUNK_SIZE)
+            if not data:
+                return
+            channel.sendall(data)
+        if channel in readable:
+            data = channel.recv(CHUNK_SIZE)
+            if not data:
+                return
+            sock.sendall(data)
+
+
+class HeldTransport:
+    """An authenticated client held by the broker."""
+
+    def __init__(self, client):
+        self.client = client
+        self.channels = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def transport(self):
+        return self.client.get_transport()
+
+    def is_active(self):
+        transport = self.transport
+        return transport is not None and transport.is_active()
+
+    def idle_time(self):
+        if self.channels:
+            return 0.0
+        return time.monotonic() - self.last_used
+
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        try:
+            uid = peer_uid(sock)
+            if uid is not None and uid != os.getuid():
+                debug(f"xefab broker: refusing a request from uid {uid}")
+                return
+            message = recv_message(sock)
+        except (OSError, ValueError):
+            return
+        if message is None:
+            return
+        server = self.server
+        server.touch()
+        op = message.get("op")
+        try:
+            if op == "ping":
+                send_message(
+                    sock, {"ok": True, "pid": os.getpid(), "hosts": server.hosts()}
+                )
+            elif op == "connect":
+                server.connect(message["params"])
+                send_message(sock, {"ok": True})
+            elif op in ("session", "direct-tcpip"):
+                self.handle_channel(message)
+            elif op == "shutdown":
+                send_message(sock, {"ok": True})
+                threading.Thread(target=server.shutdown, daemon=True).start()
+            else:
+                raise BrokerError(f"Unknown broker request {op!r}")
+        except Exception as e:
+            debug(f"xefab broker: {op} request failed: {e}")
+            try:
+                reply = {"ok": False, "error": str(e), "type": type(e).__name__}
+                send_message(sock, reply)
+            except OSError:
+                pass
+
+    def handle_channel(self, message):
+        server = self.server
+        held = server.connect(message["params"])
+        with server._lock:
+            held.channels += 1
+        try:
+            transport = held.transport
+            if message["op"] == "direct-tcpip":
+                channel = transport.open_channel(
+                    "direct-tcpip",
+                    tuple(message["dest_addr"]),
+                    tuple(message["src_addr"]),
+                )
+            else:
+                channel = transport.open_session()
+                if message.get("pty"):
+                    channel.get_pty(*message["pty"])
+                if message.get("env"):
+                    channel.update_environment(message["env"])
+                if message.get("command") is not None:
+                    channel.exec_command(message["command"])
+                elif message.get("subsystem"):
+                    channel.invoke_subsystem(message["subsystem"])
+                elif message.get("shell"):
+                    channel.invoke_shell()
+            send_message(self.request, {"ok": True})
+            try:
+                if message["op"] == "direct-tcpip" or message.get("raw"):
+                    relay_raw(self.request, channel)
+                else:
+                    relay_session(self.request, channel)
+            except OSError:
+                pass
+            finally:
+                channel.close()
+        finally:
+            with server._lock:
+                held.channels -= 1
+                held.last_used = time.monotonic()
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Holds authenticated transports per (user, host, port),
+    closing them once idle for ttl seconds. The broker exits
+    after ttl seconds without transports or requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, keepalive=DEFAULT_KEEPALIVE):
+        path = path or socket_path()
+        self.ttl = ttl
+        self.keepalive = keepalive
+        self.transports = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.last_activity = time.monotonic()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        parent = os.path.dirname(directory)
+        if not os.path.isdir(parent):
+            # e.g. the fallback runtime directory in /tmp
+            os.makedirs(parent, mode=0o700, exist_ok=True)
+        try:
+            os.mkdir(directory, 0o700)
+        except FileExistsError:
+            if os.lstat(directory).st_uid == os.getuid():
+                os.chmod(directory, 0o700)
+        if not private_dir(directory):
+            raise UntrustedBrokerError(
+                f"{directory} is not private to the user, refusing to serve there"
+            )
+        if os.path.exists(path):
+            if ping(path) is not None:
+                raise BrokerError(f"A broker is already running at {path}")
+            os.remove(path)
+        super().__init__(path, BrokerHandler)
+        os.chmod(path, 0o600)
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def hosts(self):
+        with self._lock:
+            return {
+                key: {"channels": held.channels, "idle": held.idle_time()}
+                for key, held in list(self.transports.items())
+                if held.is_active()
+            }
+
+    def connect(self, params):
+        """The authenticated transport for params, connecting if needed."""
+        from xefab.ssh_client import SSHClient
+
+        key = transport_key(params)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            held = self.transports.get(key, None)
+            if held is not None and held.is_active():
+                with self._lock:
+                    held.last_used = time.monotonic()
+                return held
+
+            params = dict(params)
+            policy = params.pop("missing_host_key_policy", None)
+            client = SSHClient()
+            client.use_broker = False
+            client.use_pool = False
+            client.load_system_host_keys()
+            client.set_missing_host_key_policy(
+                HOST_KEY_POLICIES.get(policy, paramiko.RejectPolicy)()
+            )
+            debug(f"xefab broker: connecting to {key}")
+            client.connect(**params)
+            client.get_transport().set_keepalive(self.keepalive)
+            held = HeldTransport(client)
+            with self._lock:
+                self.transports[key] = held
+            return held
+
+    def reap(self):
+        """Close transports idle for longer than the ttl."""
+        # Channel counts and use times only change under the lock
+        with self._lock:
+            idle = [
+                (key, self.transports.pop(key))
+                for key, held in list(self.transports.items())
+                if not held.is_active() or held.idle_time() > self.ttl
+            ]
+        for key, held in idle:
+            debug(f"xefab broker: closing idle transport {key}")
+            held.client.close()
+
+    def _reap_loop(self, stopped):
+        interval = min(self.ttl, 30)
+        while not stopped.wait(interval):
+            self.reap()
+            idle = time.monotonic() - self.last_activity
+            if not self.transports and idle > self.ttl:
+                debug("xefab broker: idle, exiting")
+                self.shutdown()
+                return
+
+    def serve(self):
+        """Serve until shut down, then close all transports."""
+        stopped = threading.Event()
+        reaper = threading.Thread(target=self._reap_loop, args=(stopped,), daemon=True)
+        reaper.start()
+        try:
+            self.serve_forever(poll_interval=0.5)
+        finally:
+            stopped.set()
+            for held in list(self.transports.values()):
+                held.client.close()
+            self.transports.clear()
+            self.server_close()
+            if os.path.exists(self.server_address):
+                os.remove(self.server_address)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m xefab.broker",
+        description="Hold authenticated SSH transports for xefab.",
+    )
+    parser.add_argument("--socket", default=None, help="Path of the broker socket.")
+    parser.add_argument(
+        "--ttl",
+        type=float,
+        default=DEFAULT_TTL,
+        help="Seconds to keep idle transports open.",
+    )
+    parser.add_argument(
+        "--keepalive",
+        type=int,
+        default=DEFAULT_KEEPALIVE,
+        help="Seconds between transport keepalive packets.",
+    )
+    args = parser.parse_args(argv)
+    server = BrokerServer(path=args.socket, ttl=args.ttl, keepalive=args.keepalive)
+    server.serve()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+"""On-disk caches for data that is expensive to compute on every invocation.
+
+Cached files may hold credentials (e.g. copies of remote config files),
+so directories are created with mode 0o700 and files with 0o600.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import threading
+
+import appdirs
+
+from xefab import __version__
+from xefab.instrumentation import recorder
+
+dirs = appdirs.AppDirs("xefab")
+
+CACHE_DIR = os.getenv("XEFAB_CACHE_DIR", dirs.user_cache_dir)
+
+CONTENT_CACHE_DIR = "content"
+DEFAULT_CONTENT_CACHE_SIZE = 256 * 2**20
+
+
+def cache_path(name):
+    """Path to a named cache file."""
+    return os.path.join(CACHE_DIR, name)
+
+
+def makedirs_private(path):
+    """Create a directory only the user can access, tightening the
+    cache directories leading to it if created by earlier versions.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    root = os.path.abspath(CACHE_DIR)
+    path = os.path.abspath(path)
+    while True:
+        os.chmod(path, 0o700)
+        if path == root or os.path.dirname(path) == path:
+            break
+        if os.path.commonpath([root, path]) != root:
+            break
+        path = os.path.dirname(path)
+
+
+def open_private(path, mode="w"):
+    """Open a file for writing or appending ("a" modes),
+    readable only by the user.
+    """
+    flags = os.O_WRONLY | os.O_CREAT
+    flags |= os.O_APPEND if "a" in mode else os.O_TRUNC
+    fd = os.open(path, flags, 0o600)
+    # The mode only applies to new files
+    os.fchmod(fd, 0o600)
+    return os.fdopen(fd, mode)
+
+
+def read_cache(name, key):
+    """Read a json cache file, returns None if missing or stale."""
+    try:
+        with open(cache_path(name)) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get("key") != key:
+        return None
+    return cached.get("data")
+
+
+def write_cache(name, key, data):
+    """Atomically write a json cache file. Failures are ignored."""
+    path = cache_path(name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        makedirs_private(os.path.dirname(path))
+        with open_private(tmp_path) as f:
+            json.dump({"key": key, "data": data}, f)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
+
+
+def entry_points_key(prefix="xefab"):
+    """A key that changes whenever a plugin is installed, removed or upgraded."""
+    from xefab.entrypoints import get_all_entry_points
+
+    items = [("xefab", __version__)]
+    for group, ep in get_all_entry_points(prefix):
+        dist = getattr(ep, "dist", None)
+        items.append(
+            (
+                group,
+                ep.name,
+                getattr(ep, "value", str(ep)),
+                getattr(dist, "name", None),
+                getattr(dist, "version", None),
+            )
+        )
+    data = json.dumps(sorted(items, key=str))
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+class ContentCache:
+    """Copies of remote files keyed by (host, path), validated by the
+    remote size and mtime of a single stat. The least recently used
+    copies are evicted once the cache exceeds max_size bytes.
+    """
+
+    def __init__(self, name=CONTENT_CACHE_DIR, max_size=DEFAULT_CONTENT_CACHE_SIZE):
+        self.name = name
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def configure(self, max_size=None):
+        if max_size is not None:
+            self.max_size = int(max_size)
+
+    @property
+    def directory(self):
+        return cache_path(self.name)
+
+    def entry_path(self, host, path):
+        digest = hashlib.sha1(f"{host}:{path}".encode()).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def read(self, host, path, sftp):
+        """The content of a remote file, from the cache if unchanged."""
+        entry = self.entry_path(host, path)
+        attrs = sftp.stat(path)
+        meta = {
+            "host": host,
+            "path": path,
+            "size": attrs.st_size,
+            "mtime": attrs.st_mtime,
+        }
+        try:
+            with open(f"{entry}.json") as f:
+                cached = json.load(f)
+            if cached == meta:
+                with open(entry, "rb") as f:
+                    data = f.read()
+                if len(data) == meta["size"]:
+                    # Mark as recently used
+                    os.utime(entry)
+                    recorder.count("content cache hits")
+                    return data
+        except (OSError, ValueError):
+            pass
+
+        recorder.count("content cache misses")
+        with sftp.open(path, "rb") as f:
+            f.prefetch(attrs.st_size)
+            data = f.read()
+        self.write(entry, meta, data)
+        return data
+
+    def write(self, entry, meta, data):
+        """Atomically store a copy, failures are ignored."""
+        if len(data) > self.max_size:
+            return
+        tmp_path = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            makedirs_private(self.directory)
+            with open_private(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, entry)
+            with open_private(tmp_path) as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, f"{entry}.json")
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used copies above max_size."""
+        with self._lock:
+            try:
+                names = [n for n in os.listdir(self.directory) if len(n) == 40]
+            except OSError:
+                return
+            entries = []
+            for name in names:
+                entry = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(entry)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry))
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total <= self.max_size:
+                    break
+                for path in (entry, f"{entry}.json"):
+                    with contextlib.suppress(OSError):
+                        os.remove(path)
+                total -= size
+
+
+content_cache = ContentCache()
@@ -1,9 +1,10 @@
 from invoke.collection import Collection
 from invoke.config import merge_dicts
 from invoke.tasks import Task
-from invoke.util import debug
+from invoke.util import debug, helpline
 from paramiko.config import SSHConfig
 
+from xefab.profiling import profiler
 from xefab.utils import console
 
 from .entrypoints import get_entry_points
@@ -18,6 +19,7 @@ class XefabCollection(Collection):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._lazy_entry_points = {}
 
     def task_with_config(self, name):
         # fetch the task object
@@ -28,8 +30,12 @@ class XefabCollection(Collection):
             task.hosts = [self.name]
         return task, conf
 
-    def load_objects_from_entry_points(self, group="tasks"):
-        """Load tasks/collections from entry points."""
+    def load_objects_from_entry_points(self, group="tasks", lazy=False):
+        """Load tasks/collections from entry points.
+
+        If lazy is True, the entry points are only registered by name
+        and their modules are imported on first use, see `load_lazy_object`.
+        """
 
         if not (group and isinstance(group, str)):
             raise ValueError(
@@ -39,31 +45,224 @@ class XefabCollection(Collection):
         if not group.startswith(self.entrypoint_prefix):
             group = ".".join([self.entrypoint_prefix, group])
 
-        for ep in get_entry_points(group):
-            try:
+        with profiler.phase("entry point discovery", group=group):
+            eps = list(get_entry_points(group))
+
+        for ep in eps:
+            if lazy:
+                self._lazy_entry_points[self.transform(ep.name)] = (group, ep)
+            else:
+                self._load_entry_point(group, ep)
+
+    @property
+    def lazy_names(self):
+        """Names of entry points registered but not yet loaded."""
+        return list(self._lazy_entry_points)
+
+    def load_lazy_object(self, name, lazy=True):
+        """Load a single lazily registered entry point by name.
+        Returns True if an entry point was loaded.
+        """
+        name = self.transform(name)
+        if name not in self._lazy_entry_points:
+            return False
+        group, ep = self._lazy_entry_points.pop(name)
+        self._load_entry_point(group, ep, lazy=lazy)
+        return True
+
+    def load_lazy_objects(self, recursive=True):
+        """Load all lazily registered entry points."""
+        for name in self.lazy_names:
+            self.load_lazy_object(name, lazy=not recursive)
+        if recursive:
+            for collection in self.collections.values():
+                if isinstance(collection, XefabCollection):
+                    collection.load_lazy_objects(recursive=True)
+
+    def _load_entry_point(self, group, ep, lazy=False):
+        try:
+            with profiler.phase(f"load {group}:{ep.name}"):
                 obj = ep.load()
-                if isinstance(obj, type):
-                    obj = obj()
-                self._add_object(obj, name=ep.name)
-                obj = self.collections.get(ep.name, None)
-                if isinstance(obj, XefabCollection):
-                    grp = ".".join([group, ep.name])
-                    obj.load_objects_from_entry_points(grp)
-            except TypeError as e:
-                debug(
-                    f"xefab.{self.name}: Error loading tasks from {ep.name} due to wrong type. "
-                    f"details: {e}"
-                )
-                continue
-            except ImportError as e:
-                debug(
-                    f"xefab.{self.name}: Error loading tasks from {ep.name} due to import error."
-                    f"details: {e}"
-                )
-                continue
-            except Exception as e:
-                debug(
-                    f"xefab.{self.name}: Error loading tasks from {ep.name} due to unknwon error."
-                    f"details: {e}"
+            if isinstance(obj, type):
+                obj = obj()
+            self._add_object(obj, name=ep.name)
+            obj = self.collections.get(ep.name, None)
+            if isinstance(obj, XefabCollection):
+                grp = ".".join([group, ep.name])
+                obj.load_objects_from_entry_points(grp, lazy=lazy)
+        except TypeError as e:
+            debug(
+                f"xefab.{self.name}: Error loading tasks from {ep.name} due to wrong type. "
+                f"details: {e}"
+            )
+        except ImportError as e:
+            debug(
+                f"xefab.{self.name}: Error loading tasks from {ep.name} due to import error."
+                f"details: {e}"
+            )
+        except Exception as e:
+            debug(
+                f"xefab.{self.name}: Error loading tasks from {ep.name} due to unknwon error."
+                f"details: {e}"
+            )
+
+
+def iter_tasks(collection):
+    """Iterate over all tasks in a collection tree, including duplicates."""
+    yield from collection.tasks.values()
+    for subcollection in collection.collections.values():
+        yield from iter_tasks(subcollection)
+
+
+def context_flags(ctx):
+    """Map the flag names of a parser context to whether they take a value."""
+    flags = {}
+    for name in ctx.flag_names():
+        flag = ctx.flags.get(name, None)
+        flags[name] = flag is not None and flag.takes_value
+    return flags
+
+
+def collection_snapshot(collection, contexts=None, parents=()):
+    """Create a json serializable snapshot of a collection tree.
+    Contains everything needed to list tasks and render help.
+    """
+    if contexts is None:
+        # invoke pops the argument help of a task when building its parser
+        # context, restore it for the contexts used to run the tasks.
+        helps = [(task, dict(task.help)) for task in iter_tasks(collection)]
+        try:
+            contexts = collection.to_contexts(ignore_unknown_help=True)
+        finally:
+            for task, help in helps:
+                task.help = help
+        contexts = {ctx.name: ctx for ctx in contexts}
+
+    tasks = {}
+    for name, task in collection.tasks.items():
+        ctx = contexts.get(".".join(parents + (name,)))
+        body = getattr(task, "body", task)
+        tasks[name] = {
+            "id": f"{body.__module__}.{body.__qualname__}",
+            "name": task.name,
+            "aliases": list(task.aliases),
+            "doc": task.__doc__,
+            "help_tuples": ctx.help_tuples() if ctx is not None else [],
+            "flags": context_flags(ctx) if ctx is not None else {},
+        }
+
+    collections = {}
+    for name, subcollection in collection.collections.items():
+        collections[name] = collection_snapshot(
+            subcollection, contexts=contexts, parents=parents + (name,)
+        )
+
+    configuration = {}
+    if "hostnames" in collection._configuration:
+        configuration["hostnames"] = collection._configuration["hostnames"]
+
+    return {
+        "name": collection.name,
+        "doc": collection.__doc__,
+        "default": collection.default,
+        "configuration": configuration,
+        "tasks": tasks,
+        "collections": collections,
+    }
+
+
+class CachedTask:
+    """Stand-in for a task, restored from a collection snapshot."""
+
+    def __init__(self, id, name, aliases=(), doc=None, help_tuples=(), flags=None):
+        self.id = id
+        self.name = name
+        self.aliases = tuple(aliases)
+        self.__doc__ = doc
+        self.help_tuples = [tuple(t) for t in help_tuples]
+        self.flags = flags or {}
+
+    def __repr__(self):
+        return f"<CachedTask {self.name!r}>"
+
+    def __eq__(self, other):
+        return isinstance(other, CachedTask) and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class CachedCollection:
+    """Stand-in for a collection, restored from a collection snapshot.
+    Supports listing and help rendering but not task execution.
+    """
+
+    def __init__(
+        self,
+        name=None,
+        doc=None,
+        default=None,
+        configuration=None,
+        tasks=None,
+        collections=None,
+    ):
+        self.name = name
+        self.__doc__ = doc
+        self.default = default
+        self._configuration = configuration or {}
+        self.tasks = tasks or {}
+        self.collections = collections or {}
+
+    @classmethod
+    def from_snapshot(cls, data):
+        tasks = {name: CachedTask(**task) for name, task in data["tasks"].items()}
+        collections = {
+            name: cls.from_snapshot(collection)
+            for name, collection in data["collections"].items()
+        }
+        return cls(
+            name=data["name"],
+            doc=data["doc"],
+            default=data["default"],
+            configuration=data["configuration"],
+            tasks=tasks,
+            collections=collections,
+        )
+
+    def __repr__(self):
+        return f"<CachedCollection {self.name!r}>"
+
+    def __bool__(self):
+        return bool(self.tasks) or any(self.collections.values())
+
+    def transform(self, name):
+        # Names were already transformed when the snapshot was taken
+        return name
+
+    def subcollection_from_path(self, path):
+        parts = path.split(".")
+        collection = self
+        while parts:
+            collection = collection.collections[parts.pop(0)]
+        return collection
+
+    def serialized(self):
+        return {
+            "name": self.name,
+            "help": helpline(self),
+            "default": self.default,
+            "tasks": [
+                {
+                    "name": name,
+                    "help": helpline(task),
+                    "aliases": list(task.aliases),
+                }
+                for name, task in sorted(self.tasks.items())
+            ],
+            "collections": [
+                collection.serialized()
+                for collection in sorted(
+                    self.collections.values(), key=lambda x: x.name or ""
                 )
-                continue
+            ],
+        }
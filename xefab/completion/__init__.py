@@ -0,0 +1,204 @@
+"""Shell tab-completion answered from a precomputed completion index.
+
+The index holds the core flags, host collections, task names, aliases
+and per-task flags. It is written by the xefab program whenever all
+collections are loaded and the index is out of date, and read by the
+`xefab-complete` hook which imports neither Fabric nor the task modules.
+"""
+
+import glob
+import os
+import site
+import sys
+
+from xefab import __version__
+from xefab.cache import read_cache, write_cache
+
+COMPLETION_CACHE = "completion.json"
+
+# Flags that change which tasks are available, completing these
+# requires the full program.
+COLLECTION_FLAGS = ("-c", "--collection", "-r", "--search-root")
+
+
+def completion_key():
+    """A key that changes whenever a package is installed or removed.
+    Cheaper than inspecting the entry points, installing a package
+    changes the modification time of its site-packages directory.
+    """
+    key = [__version__]
+    paths = list(site.getsitepackages())
+    if site.ENABLE_USER_SITE:
+        paths.append(site.getusersitepackages())
+    for path in paths:
+        try:
+            key.append([path, os.stat(path).st_mtime_ns])
+        except OSError:
+            continue
+    return key
+
+
+def completion_tree(snapshot):
+    """Strip a collection snapshot down to what completion needs."""
+    return {
+        "default": snapshot["default"],
+        "tasks": {
+            name: {"aliases": task["aliases"], "flags": task.get("flags", {})}
+            for name, task in snapshot["tasks"].items()
+        },
+        "collections": {
+            name: completion_tree(collection)
+            for name, collection in snapshot["collections"].items()
+        },
+    }
+
+
+def write_completion_index(snapshot, core_flags, collection_name):
+    """Write the completion index for a collection snapshot."""
+    index = {
+        "collection_name": collection_name,
+        "core_flags": core_flags,
+        "tree": completion_tree(snapshot),
+    }
+    return write_cache(COMPLETION_CACHE, completion_key(), index)
+
+
+def read_completion_index():
+    """Read the completion index, returns None if missing or stale."""
+    return read_cache(COMPLETION_CACHE, completion_key())
+
+
+def has_local_collection(name, start=None):
+    """Whether a local task collection would be loaded from the
+    current directory, in which case the index does not apply.
+    """
+    path = os.path.abspath(start or os.getcwd())
+    while True:
+        candidate = os.path.join(path, name)
+        if os.path.isfile(candidate + ".py") or os.path.isdir(candidate):
+            return True
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+
+
+def task_names(tree, prefix=""):
+    """Task names and aliases of a collection tree, as dotted paths."""
+    names = []
+    for name, task in sorted(tree["tasks"].items()):
+        names.append(prefix + name)
+        names.extend(prefix + alias for alias in task["aliases"])
+    for name, collection in sorted(tree["collections"].items()):
+        if collection["default"]:
+            names.append(prefix + name)
+        names.extend(task_names(collection, prefix=f"{prefix}{name}."))
+    return names
+
+
+def find_task(tree, name):
+    """Look up a task by dotted name or alias, None if not found."""
+    *path, name = name.split(".")
+    for part in path:
+        tree = tree["collections"].get(part, None)
+        if tree is None:
+            return None
+    if name in tree["tasks"]:
+        return tree["tasks"][name]
+    for task in tree["tasks"].values():
+        if name in task["aliases"]:
+            return task
+    collection = tree["collections"].get(name, None)
+    if collection is not None and collection["default"]:
+        return collection["tasks"].get(collection["default"], None)
+    return None
+
+
+def complete(index, words):
+    """Completion candidates for the current (last) word of words.
+    Mirrors invoke's --complete, host collections are selected
+    by leading positional arguments as in `XeFab.parse_collection`.
+    """
+    tree = index["tree"]
+    flags = index["core_flags"]
+    selecting = True
+    takes_value = False
+    *previous, current = words[1:] or [""]
+
+    for word in previous:
+        if takes_value:
+            takes_value = False
+            continue
+        if word.startswith("-"):
+            name, eq, _ = word.partition("=")
+            takes_value = flags.get(name, False) and not eq
+            continue
+        host, _, rest = word.partition(".")
+        if selecting and host in tree["collections"]:
+            tree = tree["collections"][host]
+            if not rest:
+                continue
+            word = rest
+        selecting = False
+        task = find_task(tree, word)
+        flags = task["flags"] if task is not None else {}
+
+    if takes_value:
+        # Let the shell complete the flag value, usually a file name
+        return []
+    if current.startswith("-"):
+        if current in flags:
+            return [] if flags[current] else task_names(tree)
+        if current.startswith("--"):
+            return [name for name in flags if name.startswith("--")]
+        if current == "-":
+            return list(flags)
+        return []
+    names = task_names(tree)
+    if selecting:
+        names = sorted(tree["collections"]) + names
+    return names
+
+
+def complete_with_program(words):
+    """Fall back to the full program, which also updates the index."""
+    from xefab.main import program
+
+    program.run([words[0], "--complete", "--"] + words, exit=False)
+
+
+def main(argv=None):
+    """Entry point of the `xefab-complete` hook.
+    Called by the completion scripts as `xefab-complete -- <words>`
+    with the command line up to and including the word being completed.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "--":
+        argv = argv[1:]
+    words = argv or ["xefab"]
+
+    index = read_completion_index()
+    if (
+        index is None
+        or any(word.partition("=")[0] in COLLECTION_FLAGS for word in words)
+        or has_local_collection(index["collection_name"])
+    ):
+        return complete_with_program(words)
+
+    for name in complete(index, words):
+        print(name)
+
+
+def print_completion_script(shell, names):
+    """Print the completion script for a shell, using the fast hook."""
+    completions = {
+        os.path.splitext(os.path.basename(path))[0]: path
+        for path in glob.glob(os.path.join(os.path.dirname(__file__), "*.completion"))
+    }
+    if shell not in completions:
+        raise ValueError(
+            f'Completion for shell "{shell}" not supported '
+            f"(options are: {', '.join(sorted(completions))})."
+        )
+    with open(completions[shell]) as f:
+        print(f.read().format(binary=names[0], spaced_names=" ".join(names)))
@@ -0,0 +1,5 @@
+"""Run the completion hook with `python -m xefab.completion`."""
+
+from xefab.completion import main
+
+main()
@@ -1,22 +1,142 @@
 import configparser
+import copy
+import errno
+import json
 import os
 from pathlib import Path
 
-import appdirs
 from fabric.config import Config as FabricConfig
 from fabric.config import merge_dicts
 from invoke.util import debug
+from paramiko.config import SSHConfig
 from rich.console import Console
 
+from xefab import link
+from xefab.broker import DEFAULT_TTL
+from xefab.cache import (DEFAULT_CONTENT_CACHE_SIZE, dirs, read_cache,
+                         write_cache)
 from xefab.entrypoints import get_entry_points
+from xefab.instrumentation import DEFAULT_SIZE as DEFAULT_TRACE_SIZE
+from xefab.pool import DEFAULT_KEEPALIVE
+from xefab.profiling import profiler
 from xefab.utils import console
 
-dirs = appdirs.AppDirs("xefab")
-
 XEFAB_CONFIG = os.getenv(
     "XEFAB_CONFIG", os.path.join(dirs.user_config_dir, "config.env")
 )
 
+SSH_CONFIG_CACHE = "ssh_config.json"
+
+# Parsed xenon config files by files_key, shared by all Config objects
+_XENON_CONFIGS = {}
+
+
+def files_key(paths):
+    """Cache key for a list of files, changes if any of the files does."""
+    key = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            key.append([path, stat.st_mtime_ns, stat.st_size])
+        except OSError:
+            key.append([path, None, None])
+    return key
+
+
+def read_xenon_config(paths):
+    """Parse the xenon config files, cached until any of them changes."""
+    key = json.dumps(files_key(paths))
+    if key not in _XENON_CONFIGS:
+        xenon_config = configparser.ConfigParser()
+        loaded = xenon_config.read(paths)
+        debug(f"xefab: loaded xenon config from {loaded}")
+        _XENON_CONFIGS[key] = xenon_config
+    return _XENON_CONFIGS[key]
+
+
+class SSHConfigIndex:
+    """Index of the host aliases in a set of ssh config files.
+
+    Maps every literal host alias, and the HostName given in its own Host
+    block, to the alias. The full config of an alias is resolved with a
+    single lookup on first use. Parsed rules and the index are kept for
+    the process and persisted in the cache, keyed by the files' mtimes so
+    unchanged files are never re-parsed. Resolved configs depend on the
+    local user and environment (`Match exec`, `Match localuser`, `%u`
+    and `%l` tokens), so they are only kept for the process.
+    """
+
+    _instances = {}
+
+    def __init__(self, rules, hostnames=None, resolved=None, paths=None):
+        self.rules = rules
+        self.paths = paths
+        self.resolved = resolved if resolved is not None else {}
+        if hostnames is None:
+            hostnames = self.build_hostnames(rules)
+        self.hostnames = hostnames
+
+    @staticmethod
+    def build_hostnames(rules):
+        aliases = {}
+        hostnames = {}
+        for rule in rules:
+            for alias in rule.get("host", []):
+                if any(c in alias for c in "*?!"):
+                    continue
+                aliases.setdefault(alias, alias)
+                hostname = rule["config"].get("hostname", None)
+                if hostname:
+                    hostnames.setdefault(hostname.replace("%h", alias), alias)
+        # aliases take precedence over hostnames
+        hostnames.update(aliases)
+        return hostnames
+
+    @classmethod
+    def for_paths(cls, paths):
+        """Index for a list of ssh config files."""
+        key = files_key(paths)
+        memory_key = json.dumps(key)
+        if memory_key in cls._instances:
+            return cls._instances[memory_key]
+
+        data = read_cache(SSH_CONFIG_CACHE, key)
+        if data is not None:
+            debug(f"xefab: loaded ssh config index from cache for {paths}")
+            index = cls(data["rules"], data["hostnames"], paths=paths)
+        else:
+            ssh_config = SSHConfig()
+            for path in paths:
+                if os.path.isfile(path):
+                    with open(path) as fd:
+                        ssh_config.parse(fd)
+            index = cls(ssh_config._config, paths=paths)
+            index.save()
+        cls._instances[memory_key] = index
+        return index
+
+    @classmethod
+    def from_ssh_config(cls, ssh_config):
+        """Index for an SSHConfig object, not persisted."""
+        return cls(copy.deepcopy(ssh_config._config))
+
+    def save(self):
+        if self.paths is None:
+            return
+        data = {"rules": self.rules, "hostnames": self.hostnames}
+        write_cache(SSH_CONFIG_CACHE, files_key(self.paths), data)
+
+    def resolve(self, hostname):
+        """Resolved config of a host alias or hostname, None if not found."""
+        alias = self.hostnames.get(hostname, None)
+        if alias is None:
+            return None
+        if alias not in self.resolved:
+            ssh_config = SSHConfig()
+            ssh_config._config = self.rules
+            self.resolved[alias] = dict(ssh_config.lookup(alias))
+        return copy.deepcopy(self.resolved[alias])
+
 
 class Config(FabricConfig):
     """Settings for xefab."""
@@ -24,32 +144,80 @@ class Config(FabricConfig):
     MONGO_CLIENTS = {}
 
     prefix = "xefab"
-    xenon_config = None
+    _xenon_config = None
 
     def __init__(self, *args, **kwargs):
         kwargs.setdefault("system_prefix", dirs.site_config_dir + "/")
         kwargs.setdefault("user_prefix", dirs.user_config_dir + "/")
-        super().__init__(*args, **kwargs)
-        self.load_xenon_config()
+        with profiler.phase("config construction"):
+            super().__init__(*args, **kwargs)
+
+    @property
+    def xenon_config(self):
+        """The xenon config files, parsed on first access."""
+        if self._xenon_config is None:
+            self.load_xenon_config()
+        return self._xenon_config
+
+    @xenon_config.setter
+    def xenon_config(self, value):
+        self._xenon_config = value
+
+    def _ssh_config_paths(self):
+        if self._runtime_ssh_path is not None:
+            return [os.path.expanduser(self._runtime_ssh_path)]
+        if self.load_ssh_configs:
+            return [
+                os.path.expanduser(path)
+                for path in (self._user_ssh_path, self._system_ssh_path)
+            ]
+        return []
+
+    def _load_ssh_files(self):
+        """Load the ssh config files into base_ssh_config.
+        Each set of files is only added once per SSHConfig object and
+        parsed rules are taken from the ssh config cache if up to date.
+        """
+        if self._runtime_ssh_path is not None:
+            path = self._runtime_ssh_path
+            if not os.path.exists(path):
+                raise FileNotFoundError(
+                    errno.ENOENT, "No such file or directory", path
+                )
+
+        paths = self._ssh_config_paths()
+        ssh_config = self.base_ssh_config
+        loaded = ssh_config.__dict__.setdefault("_xefab_loaded_paths", [])
+        if not paths or paths in loaded:
+            return
+        loaded.append(paths)
+
+        index = SSHConfigIndex.for_paths(paths)
+        ssh_config._config.extend(copy.deepcopy(index.rules))
+        ssh_config._xefab_index = index if len(loaded) == 1 else None
+
+    def ssh_config_index(self):
+        """Index of the ssh config by host alias and hostname."""
+        index = getattr(self.base_ssh_config, "_xefab_index", None)
+        if index is None:
+            index = SSHConfigIndex.from_ssh_config(self.base_ssh_config)
+            self.base_ssh_config._xefab_index = index
+        return index
 
     def _get_ssh_config(self, hostname):
         """Look up the host in the SSH config, if it exists."""
+        data = self.ssh_config_index().resolve(hostname)
+        if data is None:
+            return None
         config = {"hostname": hostname}
-
-        for host in self.base_ssh_config.get_hostnames():
-            data = self.base_ssh_config.lookup(host)
-            host_hostname = data.get("hostname", "")
-            if hostname in [host, host_hostname]:
-                config.update(data)
-                return config
+        config.update(data)
+        return config
 
     def configure_ssh_for_host(self, host, hostnames=None):
         """Find the SSH config for a host."""
         if isinstance(hostnames, str):
             hostnames = hostnames.split(",")
 
-        config = None
-
         if hostnames is None:
             return
 
@@ -60,6 +228,10 @@ class Config(FabricConfig):
             )
             return
 
+        with profiler.phase(f"ssh config resolution {host}"):
+            self._configure_ssh_for_host(host, hostnames)
+
+    def _configure_ssh_for_host(self, host, hostnames):
         self.load_ssh_config()
 
         for hostname in hostnames:
@@ -77,6 +249,15 @@ class Config(FabricConfig):
 
         self.base_ssh_config._config.insert(0, ssh_config)
 
+    def configure_link_for_host(self, host, settings=None):
+        """Register the link tuning of a host collection.
+        The user config takes precedence over the collection's settings.
+        """
+        settings = link.merge(settings, self.link)
+        hostname = self.base_ssh_config.lookup(host).get("hostname", host)
+        debug(f"xefab: link settings for {host} ({hostname}): {settings}")
+        link.configure({host, hostname}, settings)
+
     @staticmethod
     def global_defaults():
         """Add extra parameters to the default dict."""
@@ -98,6 +279,21 @@ class Config(FabricConfig):
             },
             "xenon_config_paths": Config.get_xenon_config_paths(),
             "list-depth": 3,
+            "broker": {
+                "ttl": DEFAULT_TTL,
+                "keepalive": DEFAULT_KEEPALIVE,
+            },
+            "pool": {
+                "enabled": True,
+                "keepalive": DEFAULT_KEEPALIVE,
+            },
+            "link": dict(link.DEFAULT_LINK),
+            "trace": {
+                "size": DEFAULT_TRACE_SIZE,
+            },
+            "content_cache": {
+                "max_size": DEFAULT_CONTENT_CACHE_SIZE,
+            },
         }
 
         merge_dicts(defaults, ours)
@@ -121,16 +317,13 @@ class Config(FabricConfig):
 
     def load_xenon_config(self):
         """Load the xenon config file."""
-        self.xenon_config = configparser.ConfigParser()
-        self.merge()  # Make sure we have the latest config
         paths = getattr(self, "xenon_config_paths", [])
         if isinstance(paths, str):
             paths = paths.split(",")
         if not isinstance(paths, list):
             raise ValueError("xenon_config_paths must be a list or a string")
         paths = [os.path.expanduser(path) for path in paths]
-        loaded = self.xenon_config.read(paths)
-        debug(f"xefab: loaded xenon config from {loaded}")
+        self.xenon_config = read_xenon_config(paths)
 
     def _mongo_client(self, experiment, url=None, user=None, password=None):
         import pymongo
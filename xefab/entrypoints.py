@@ -23,6 +23,18 @@ try:
             eps = importlib_metadata.entry_points().get(name, [])
         yield from eps
 
+    def get_all_entry_points(prefix="xefab"):
+        """Yield (group, entrypoint) for all groups starting with prefix."""
+        eps = importlib_metadata.entry_points()
+        if hasattr(eps, "groups"):
+            groups = {group: eps.select(group=group) for group in eps.groups}
+        else:
+            groups = eps
+        for group, group_eps in groups.items():
+            if group.startswith(prefix):
+                for ep in group_eps:
+                    yield group, ep
+
 except ImportError:
     # But if we're not on Python >= 3.8 and the importlib_metadata backport
     # is not installed, we fall back to pkg_resources anyway.
@@ -39,7 +51,17 @@ except ImportError:
         def get_entry_points(name):
             yield from ()
 
+        def get_all_entry_points(prefix="xefab"):
+            yield from ()
+
     else:
 
         def get_entry_points(name="xesites"):
             yield from pkg_resources.iter_entry_points(name)
+
+        def get_all_entry_points(prefix="xefab"):
+            for dist in pkg_resources.working_set:
+                for group, group_eps in dist.get_entry_map().items():
+                    if group.startswith(prefix):
+                        for ep in group_eps.values():
+                            yield group, ep
@@ -0,0 +1,159 @@
+"""Task execution across several host collections at once.
+
+`xefab midway,midway3,dali squeue` selects several host collections.
+Each task then runs on all hosts concurrently, one thread per host as in
+Fabric's `ThreadingGroup`, so the total latency is that of the slowest
+host. DataFrames returned by the hosts are merged with a `host` column
+and rendered as one table.
+"""
+
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+
+from fabric.executor import Executor
+from fabric.tasks import ConnectionCall
+from invoke.exceptions import Exit
+from invoke.util import debug
+
+from xefab.utils import console, df_to_table
+
+
+def takes_hide(task):
+    return "hide" in inspect.signature(task.body).parameters
+
+
+class MultiHostExecutor(Executor):
+    """Executor running the per-host calls of each task concurrently."""
+
+    def __init__(self, collection, config=None, core=None, host_collections=None):
+        super().__init__(collection, config=config, core=core)
+        self.host_collections = host_collections or {}
+
+    def execute(self, *tasks):
+        calls = self.normalize(tasks)
+        direct = list(calls)
+        expanded = self.expand_calls(calls)
+        try:
+            dedupe = self.config.tasks.dedupe
+        except AttributeError:
+            dedupe = True
+        calls = self.dedupe(expanded) if dedupe else expanded
+
+        results = {}
+        while calls:
+            call = calls.pop(0)
+            if not isinstance(call, ConnectionCall):
+                results[call.task] = self.run_call(call, call in direct)
+                continue
+            # Per-host variants of the same call are adjacent
+            group = [call]
+            while calls and calls[0].task is call.task and isinstance(
+                calls[0], ConnectionCall
+            ):
+                group.append(calls.pop(0))
+            results[call.task] = self.run_group(group, call in direct)
+        return results
+
+    def run_call(self, call, autoprint=False, collection=None):
+        """Run a single call, as the base executor does."""
+        if collection is None:
+            collection = self.collection
+        config = self.config.clone()
+        config.load_collection(collection.configuration(call.called_as))
+        config.load_shell_env()
+        context = call.make_context(config)
+        result = call.task(context, *call.args, **call.kwargs)
+        if autoprint:
+            print(result)
+        return result
+
+    def host_call(self, call):
+        """The call of a task on a host with its own collection."""
+        host = call.init_kwargs["host"]
+        collection = self.host_collections.get(host, self.collection)
+        if call.called_as is None:
+            return call, collection
+        try:
+            task = collection[call.called_as]
+        except KeyError:
+            raise Exit(f"Task {call.called_as} is not available on {host}.", code=1)
+        kwargs = dict(call.kwargs)
+        if takes_hide(task):
+            # The results of all hosts are rendered together instead
+            kwargs["hide"] = True
+        call = ConnectionCall(
+            task,
+            called_as=call.called_as,
+            args=call.args,
+            kwargs=kwargs,
+            init_kwargs=call.init_kwargs,
+        )
+        return call, collection
+
+    def run_group(self, group, autoprint=False):
+        """Run the calls of a task on all hosts concurrently, returns
+        the merged results or a dict of results by host.
+        """
+        if len(group) == 1:
+            return self.run_call(group[0], autoprint)
+
+        host_calls = [self.host_call(call) for call in group]
+        hosts = [call.init_kwargs["host"] for call in group]
+        debug(f"xefab: running {group[0].called_as} on {', '.join(hosts)}")
+
+        with ThreadPoolExecutor(max_workers=len(group)) as threads:
+            futures = {
+                host: threads.submit(self.run_call, call, collection=collection)
+                for host, (call, collection) in zip(hosts, host_calls)
+            }
+
+        results, failed = {}, {}
+        for host, future in futures.items():
+            exception = future.exception()
+            if exception is None:
+                results[host] = future.result()
+            else:
+                failed[host] = exception
+
+        merged = self.merge_results(results)
+        if autoprint or merged is not None or takes_hide(group[0].task):
+            self.show_results(results, merged)
+        for host, exception in failed.items():
+            console.print(f"[red]{host}: {type(exception).__name__}: {exception}")
+        if failed:
+            raise Exit(code=1)
+        return merged if merged is not None else results
+
+    @staticmethod
+    def merge_results(results):
+        """Concatenate DataFrame results with a host column, None if
+        the results are not all DataFrames.
+        """
+        if not results:
+            return None
+        try:
+            import pandas as pd
+        except ImportError:
+            return None
+        if not all(isinstance(df, pd.DataFrame) for df in results.values()):
+            return None
+        frames = []
+        for host, df in results.items():
+            df = df.copy()
+            df.insert(0, "host", host)
+            frames.append(df)
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def show_results(results, merged=None):
+        if merged is None:
+            for host, result in results.items():
+                if result is not None:
+                    console.print(f"{host}: {result}")
+            return
+        table = df_to_table(merged)
+        if len(merged) > 10:
+            with console.pager():
+                console.print(table)
+        else:
+            console.print(table)
@@ -4,8 +4,19 @@ File access helper classes for optionally remote files.
 '''
 
 import contextlib
+import functools
+import hashlib
 import io
+import json
+import mmap
 import os
+import posixpath
+import re
+import shlex
+import stat
+import string
+import time
+import uuid
 import fsspec
 from pathlib import Path
 from typing import List
@@ -14,8 +25,147 @@ from fabric.connection import Connection
 from invoke.context import Context
 from pydantic import BaseModel, Field, root_validator, validator
 
+from .cache import content_cache, read_cache, write_cache
 from .utils import console, filesystem
 
+RESOLVED_PATHS_CACHE = "resolved_paths.json"
+RESOLVED_PATHS_KEY = 1
+
+# Seconds a resolved path of a MultiPathFile is reused without probing
+RESOLVED_PATH_TTL = float(os.getenv("XEFAB_RESOLVED_PATH_TTL", 24 * 3600))
+
+# Buffer size of files opened for streaming
+STREAM_BUFFER_SIZE = 2**20
+
+
+class RangeReader(io.RawIOBase):
+    """Seekable raw reader of a file of known size, readable as a
+    stream (wrapped in a buffered or text reader) or by byte ranges.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self._pos)
+        if n <= 0:
+            return 0
+        data = self._read_at(self._pos, n)
+        n = len(data)
+        b[:n] = data
+        self._pos += n
+        return n
+
+    def _read_at(self, offset, n):
+        """At most n bytes at offset, at least one before the end."""
+        raise NotImplementedError
+
+    def read_range(self, offset, length):
+        """The bytes of a range, without moving the stream position."""
+        raise NotImplementedError
+
+
+class SFTPReader(RangeReader):
+    """Reader of a remote file, reading ahead a window of
+    read_ahead chunks with pipelined SFTP requests. Memory use is
+    bounded by the window, not the file size.
+    """
+
+    def __init__(self, f, size=None, chunk_size=256 * 2**10, read_ahead=8):
+        super().__init__(f.stat().st_size if size is None else size)
+        self.file = f
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+        self._window_start = 0
+        self._window = b""
+
+    def _read_at(self, offset, n):
+        start = offset - self._window_start
+        if not 0 <= start < len(self._window):
+            end = min(offset + self.chunk_size * self.read_ahead, self.size)
+            self._window = self.read_range(offset, end - offset)
+            self._window_start, start = offset, 0
+        return memoryview(self._window)[start : start + n]
+
+    def read_range(self, offset, length):
+        length = min(length, self.size - offset)
+        if length <= 0:
+            return b""
+        chunks = [
+            (start, min(self.chunk_size, offset + length - start))
+            for start in range(offset, offset + length, self.chunk_size)
+        ]
+        return b"".join(self.file.readv(chunks))
+
+    def read_ranges(self, ranges):
+        """The bytes of several (offset, length) ranges, fetched together."""
+        ranges = [(offset, min(length, self.size - offset)) for offset, length in ranges]
+        data = iter(self.file.readv([r for r in ranges if r[1] > 0]))
+        return [next(data) if length > 0 else b"" for _, length in ranges]
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+            self._window = b""
+        super().close()
+
+
+class MappedReader(RangeReader):
+    """Reader of a memory-mapped local file."""
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        super().__init__(size)
+        self.mmap = b""
+        # Empty files can't be mapped
+        if size:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _read_at(self, offset, n):
+        return self.mmap[offset : offset + n]
+
+    def read_range(self, offset, length):
+        return self.mmap[offset : offset + length]
+
+    def read_ranges(self, ranges):
+        return [self.read_range(offset, length) for offset, length in ranges]
+
+    def close(self):
+        if not self.closed:
+            if self.size:
+                self.mmap.close()
+            self.file.close()
+        super().close()
+
+
+def stream(raw, mode="rb"):
+    """A buffered (binary) or text file object reading from raw."""
+    f = io.BufferedReader(raw, buffer_size=STREAM_BUFFER_SIZE)
+    if mode == "r":
+        return io.TextIOWrapper(f, encoding="utf-8")
+    return f
+
 
 class BaseFile(BaseModel):
     name: str = None
@@ -51,22 +201,139 @@ class MultiPathFile(BaseFile):
             return [v]
         return v
 
-    def _read(self, c, method: str = 'read_text'):
-        fs = filesystem(c)
-        local_fs = filesystem(c, local=True)
+    def _cache_key(self, c):
+        host = c.host if isinstance(c, Connection) else "localhost"
+        return f"{host}:{json.dumps(self.paths)}"
+
+    def _probe_remote(self, c, paths):
+        """The paths that are files on the remote host, in one round trip."""
+        if not paths:
+            return set()
+        quoted = " ".join(shlex.quote(path) for path in paths)
+        result = c.run(
+            f"for p in {quoted}; do [ -f \"$p\" ] && printf '%s\\n' \"$p\"; done; true",
+            hide=True,
+            warn=True,
+            in_stream=False,
+        )
+        return set(result.stdout.splitlines())
+
+    def cached_path(self, c):
+        """The resolved (location, path) if cached and fresh, else None."""
+        cached = read_cache(RESOLVED_PATHS_CACHE, RESOLVED_PATHS_KEY) or {}
+        entry = cached.get(self._cache_key(c), None)
+        if entry is None or time.time() - entry["time"] >= RESOLVED_PATH_TTL:
+            return None
+        return entry["location"], entry["path"]
 
+    def resolve(self, c, use_cache=True):
+        """The first of the paths that exists, as (location, path) with
+        location one of "url", "remote" and "local". Remote candidates
+        are probed together and the result is cached for RESOLVED_PATH_TTL.
+        """
+        if use_cache:
+            cached = self.cached_path(c)
+            if cached is not None:
+                return cached
+
+        candidates = []
         for path in self.paths:
-            protocol = fsspec.utils.get_protocol(path)
-            if protocol != "file":
-                with fsspec.open(path, "r") as f:
-                    return f.read()
-            elif fs.isfile(path):
-                return getattr(fs, method)(path)
-            elif local_fs.isfile(path):
-                return getattr(local_fs, method)(path)
+            if fsspec.utils.get_protocol(path) != "file":
+                # URLs are not probed, later candidates are never reached
+                candidates.append(("url", path))
+                break
+            candidates.append((None, path))
+
+        remote = set()
+        if isinstance(c, Connection):
+            remote = self._probe_remote(c, [p for loc, p in candidates if loc is None])
+
+        for location, path in candidates:
+            if location is None:
+                if path in remote:
+                    location = "remote"
+                elif os.path.isfile(path):
+                    location = "local"
+                else:
+                    continue
+            self._remember(self._cache_key(c), location, path)
+            return location, path
 
         raise FileNotFoundError(f"Could not find any of {self.paths} on remote or local")
 
+    @staticmethod
+    def _remember(key, location, path):
+        now = time.time()
+        cached = read_cache(RESOLVED_PATHS_CACHE, RESOLVED_PATHS_KEY) or {}
+        cached = {
+            k: v for k, v in cached.items() if now - v["time"] < RESOLVED_PATH_TTL
+        }
+        if location is None:
+            cached.pop(key, None)
+        else:
+            cached[key] = {"location": location, "path": path, "time": now}
+        write_cache(RESOLVED_PATHS_CACHE, RESOLVED_PATHS_KEY, cached)
+
+    def forget(self, c):
+        """Drop the cached resolved path."""
+        self._remember(self._cache_key(c), None, None)
+
+    def _read_from(self, c, location, path, method):
+        if location == "url":
+            mode = "rb" if method == "read_bytes" else "r"
+            with fsspec.open(path, mode) as f:
+                return f.read()
+        if location == "remote":
+            # Rarely changing files are served from the local content cache
+            data = content_cache.read(c.host, path, c.sftp())
+            return data if method == "read_bytes" else data.decode("utf-8")
+        fs = filesystem(c, local=True)
+        return getattr(fs, method)(path)
+
+    @contextlib.contextmanager
+    def open(self, c: Context, mode="r"):
+        """Open the file for streaming. Remote files are read through
+        SFTP with read-ahead, local files are memory-mapped. The raw
+        reader (`f.raw`, `f.buffer.raw` in text mode) also reads ranges
+        with `read_range` and `read_ranges`.
+        """
+        if mode not in ("r", "rb"):
+            raise RuntimeError("File is not writable")
+        cached = self.cached_path(c)
+        raw = None
+        if cached is not None:
+            try:
+                raw = self._open_raw(c, *cached, mode)
+            except OSError:
+                self.forget(c)
+        if raw is None:
+            raw = self._open_raw(c, *self.resolve(c, use_cache=False), mode)
+        if isinstance(raw, RangeReader):
+            f = stream(raw, mode)
+        else:
+            f = raw
+        with f:
+            yield f
+
+    @staticmethod
+    def _open_raw(c, location, path, mode):
+        if location == "url":
+            return fsspec.open(path, mode).open()
+        if location == "remote":
+            sftp = c.sftp()
+            return SFTPReader(sftp.open(path, "rb"), sftp.stat(path).st_size)
+        return MappedReader(path)
+
+    def _read(self, c, method: str = 'read_text'):
+        cached = self.cached_path(c)
+        if cached is not None:
+            try:
+                return self._read_from(c, *cached, method)
+            except OSError:
+                # The file moved since it was resolved, probe again
+                self.forget(c)
+        return self._read_from(c, *self.resolve(c, use_cache=False), method)
+
     def read_text(self, c: Context):
         return self._read(c, method='read_text')
 
@@ -74,12 +341,92 @@ class MultiPathFile(BaseFile):
         return self._read(c, method='read_bytes')
 
 
+_FIELD_LOOKUP = re.compile(r"\.([^.\[]+)|\[([^\]]+)\]")
+
+_CONVERSIONS = {"r": repr, "s": str, "a": ascii}
+
+
+def compile_field(field):
+    """The name and the attribute and item lookups of a field, e.g.
+    "job.args[0]" is ("job", ((True, "args"), (False, 0))).
+    """
+    name = re.split(r"[.\[]", field, maxsplit=1)[0]
+    lookups = []
+    for attr, key in _FIELD_LOOKUP.findall(field[len(name) :]):
+        if attr:
+            lookups.append((True, attr))
+        else:
+            lookups.append((False, int(key) if key.isdigit() else key))
+    return name, tuple(lookups)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_format(text):
+    """A format string as (literal, field, spec, conversion) segments,
+    parsed once so `render_format` only looks values up. Fields are
+    compiled by `compile_field`, specs with fields are compiled too.
+    """
+    segments = []
+    for literal, field, spec, conversion in string.Formatter().parse(text):
+        if field is not None:
+            field = compile_field(field)
+            if spec and "{" in spec:
+                spec = compile_format(spec)
+        segments.append((literal, field, spec or "", _CONVERSIONS.get(conversion)))
+    return tuple(segments)
+
+
+def format_fields(segments):
+    """The names of the fields compiled format segments refer to."""
+    names = set()
+    for _, field, spec, _ in segments:
+        if field is not None:
+            names.add(field[0])
+            if not isinstance(spec, str):
+                names |= format_fields(spec)
+    return names
+
+
+def template_fields(text):
+    """The names of the fields a format string refers to."""
+    return format_fields(compile_format(text))
+
+
+def render_format(segments, values):
+    """Render compiled format segments, like `str.format_map`."""
+    parts = []
+    for literal, field, spec, conversion in segments:
+        if literal:
+            parts.append(literal)
+        if field is None:
+            continue
+        name, lookups = field
+        value = values[name]
+        for attr, key in lookups:
+            value = getattr(value, key) if attr else value[key]
+        if conversion is not None:
+            value = conversion(value)
+        if not isinstance(spec, str):
+            spec = render_format(spec, values)
+        parts.append(format(value, spec))
+    return "".join(parts)
+
+
+# Compiled templates, compiled string field defaults and field
+# interpolation orders, by TemplateFile class
+_compiled_templates = {}
+_compiled_defaults = {}
+_interpolation_orders = {}
+
+
 class TemplateFile(BaseFile):
     """
     A template file that can be rendered using a pydantic model.
     The model should contain a __TEMPLATE__ attribute that is a
     string containing the template or a path to a file.
     All fields in the model will be available to the template.
+    String fields may refer to other fields, e.g. "{workdir}/logs".
+    The template is loaded once per class.
     """
 
     
@@ -89,18 +436,85 @@ class TemplateFile(BaseFile):
 
     @classmethod
     def get_template(cls):
-        path = Path(cls.__TEMPLATE__)
-        if path.is_file():
-            return path.read_text()
-        else:
-            return cls.__TEMPLATE__
+        return cls.compiled_template()[0]
+
+    @classmethod
+    def compiled_template(cls):
+        """The template, the names of the fields it refers to and its
+        compiled segments.
+        """
+        compiled = _compiled_templates.get(cls, None)
+        if compiled is None:
+            template = cls.__TEMPLATE__
+            try:
+                path = Path(template)
+                if path.is_file():
+                    template = path.read_text()
+            except OSError:
+                # Not a valid path, e.g. a long inline template
+                pass
+            segments = compile_format(template)
+            compiled = (template, format_fields(segments), segments)
+            _compiled_templates[cls] = compiled
+        return compiled
+
+    @classmethod
+    def compiled_defaults(cls):
+        """The compiled segments of string field defaults with fields."""
+        compiled = _compiled_defaults.get(cls, None)
+        if compiled is None:
+            compiled = _compiled_defaults[cls] = {
+                name: compile_format(field.default)
+                for name, field in cls.__fields__.items()
+                if isinstance(field.default, str) and "{" in field.default
+            }
+        return compiled
+
+    @classmethod
+    def interpolation_order(cls):
+        """The fields in the order their values are interpolated. Fields
+        whose defaults refer to other fields follow those fields, other
+        fields keep their definition order.
+        """
+        order = _interpolation_orders.get(cls, None)
+        if order is not None:
+            return order
+        defaults = cls.compiled_defaults()
+        depends = {}
+        for name in cls.__fields__:
+            if name in defaults:
+                fields = format_fields(defaults[name]) & set(cls.__fields__)
+                depends[name] = fields - {name}
+            else:
+                depends[name] = set()
+        order, done = [], set()
+
+        def visit(name, path):
+            if name in done or name in path:
+                # Cyclic references are interpolated in definition order
+                return
+            for dependency in depends[name]:
+                visit(dependency, path | {name})
+            done.add(name)
+            order.append(name)
+
+        for name in cls.__fields__:
+            visit(name, frozenset())
+        _interpolation_orders[cls] = order
+        return order
 
     @root_validator
     def format_args(cls, values):
-        for name, field in cls.__fields__.items():
-            value = values.get(name, field.default)
-            if isinstance(value, str):
-                values[name] = value.format(**values)
+        defaults = cls.compiled_defaults()
+        for name in cls.interpolation_order():
+            default = cls.__fields__[name].default
+            value = values.get(name, default)
+            if isinstance(value, str) and "{" in value:
+                if value == default:
+                    segments = defaults[name]
+                else:
+                    segments = compile_format(value)
+                values[name] = render_format(segments, values)
         return values
 
     def __init_subclass__(cls):
@@ -110,25 +524,143 @@ class TemplateFile(BaseFile):
             )
         super().__init_subclass__()
 
+    def template_values(self, names):
+        """The values of fields, nested models and containers as dicts."""
+        values, nested = {}, set()
+        for name in names:
+            value = getattr(self, name, None)
+            if isinstance(value, (BaseModel, dict, list, tuple, set)):
+                nested.add(name)
+            elif name in self.__fields__:
+                values[name] = value
+        if nested:
+            values.update(self.dict(include=nested))
+        return values
+
     def read_text(self):
-        template = self.get_template()
-        kwargs = self.dict()
-        return template.format(**kwargs)
+        _, names, segments = self.compiled_template()
+        return render_format(segments, self.template_values(names))
 
     def read_bytes(self):
         return self.read_text().encode()
 
     def deploy(self, c: Context, path, hide=False, warn=False):
-        try:
-            fs = filesystem(c)
-            fs.makedirs(path, exist_ok=True)
-            full_path = fs.sep.join([path, self.filename])
-            fs.write_text(full_path, self.read_text())
-        except Exception as e:
-            if not warn:
-                raise e
-            if not hide:
-                console.print_exception(show_locals=True)
+        """Deploy the rendered template to a directory, see `deploy_templates`."""
+        return deploy_templates(c, [self], path, hide=hide, warn=warn)
+
+
+def remote_digests(c: Connection, path, targets):
+    """Create a remote directory and return the sha256 digests of
+    the targets that exist in it, in one round trip.
+    """
+    quoted = " ".join(shlex.quote(target) for target in targets)
+    result = c.run(
+        f"mkdir -p {shlex.quote(path)} && {{ sha256sum {quoted} 2>/dev/null; true; }}",
+        hide=True,
+        in_stream=False,
+    )
+    digests = {}
+    for line in result.stdout.splitlines():
+        digest, _, target = line.partition("  ")
+        digests[target] = digest
+    return digests
+
 
+def local_digests(path, targets):
+    os.makedirs(path, exist_ok=True)
+    digests = {}
+    for target in targets:
+        if os.path.isfile(target):
+            with open(target, "rb") as f:
+                digests[target] = hashlib.sha256(f.read()).hexdigest()
+    return digests
+
+
+def write_remote(sftp, target, data):
+    """Upload to a temporary file and rename it over the target,
+    keeping the permissions of an existing target.
+    """
+    try:
+        mode = stat.S_IMODE(sftp.stat(target).st_mode)
+    except IOError:
+        mode = None
+    tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+    sftp.putfo(io.BytesIO(data), tmp_path, len(data), confirm=False)
+    try:
+        if mode is not None:
+            sftp.chmod(tmp_path, mode)
+        sftp.posix_rename(tmp_path, target)
+    except IOError:
+        sftp.remove(tmp_path)
+        raise
+
+
+def write_local(target, data):
+    try:
+        mode = stat.S_IMODE(os.stat(target).st_mode)
+    except OSError:
+        mode = None
+    tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def deploy_templates(c: Context, templates, path, hide=False, warn=False):
+    """Deploy rendered templates to a directory. The digests of the
+    deployed copies are compared in one round trip and only changed
+    files are uploaded, over the connection's SFTP session, to a
+    temporary file renamed over the target. Returns the filenames
+    deployed, skipped as unchanged and failed (with the error).
+    """
+    remote = isinstance(c, Connection)
+    join = posixpath.join if remote else os.path.join
+    rendered = {
+        join(path, template.filename): (template.filename, template.read_bytes())
+        for template in templates
+    }
+    report = {"deployed": [], "skipped": [], "failed": {}}
+
+    try:
+        if remote:
+            digests = remote_digests(c, path, rendered)
+        else:
+            digests = local_digests(path, rendered)
+        for target, (filename, data) in rendered.items():
+            if digests.get(target) == hashlib.sha256(data).hexdigest():
+                report["skipped"].append(filename)
+                continue
+            try:
+                if remote:
+                    write_remote(c.sftp(), target, data)
+                else:
+                    write_local(target, data)
+            except Exception as e:
+                if not warn:
+                    raise
+                report["failed"][filename] = str(e)
+                continue
+            report["deployed"].append(filename)
+    except Exception:
+        if not warn:
+            raise
         if not hide:
-            console.print(f"Deployed {self.filename} to {path}")
+            console.print_exception(show_locals=True)
+
+    if not hide:
+        for filename in report["deployed"]:
+            console.print(f"Deployed {filename} to {path}")
+        if report["skipped"]:
+            console.print(
+                f"Skipped {len(report['skipped'])} unchanged file(s) in {path}: "
+                + ", ".join(report["skipped"])
+            )
+        for filename, error in report["failed"].items():
+            console.print(f"[red]Failed to deploy {filename} to {path}: {error}")
+    return report
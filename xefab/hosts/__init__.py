@@ -1,2 +0,0 @@
-from . import osg
-from .uchicago import dali, midway, midway3
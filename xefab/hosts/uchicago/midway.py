@@ -2,8 +2,9 @@ from xefab.collection import XefabCollection
 from xefab.tasks.batchq import sbatch
 from xefab.tasks.jupyter import start_jupyter
 from xefab.tasks.main import show_context
-from xefab.tasks.squeue import squeue
-from xefab.tasks.transfer import download_file, upload_file
+from xefab.tasks.squeue import squeue, wait_for_jobs
+from xefab.tasks.transfer import (bench_link, download_dir, download_file,
+                                  sync, upload_dir, upload_file)
 
 namespace = XefabCollection("midway")
 
@@ -13,13 +14,21 @@ namespace.configure(
             "midway2.rcc.uchicago.edu",
             "midway2-login1.rcc.uchicago.edu",
             "midway2-login2.rcc.uchicago.edu",
-        ]
+        ],
+        # A window covering the bandwidth-delay product of transatlantic links,
+        # compare profiles with `xefab midway bench-link`
+        "link": {"window_size": 16 * 2**20},
     }
 )
 
 namespace.add_task(squeue)
+namespace.add_task(wait_for_jobs)
 namespace.add_task(start_jupyter)
 namespace.add_task(download_file)
 namespace.add_task(upload_file)
+namespace.add_task(download_dir)
+namespace.add_task(upload_dir)
+namespace.add_task(sync)
+namespace.add_task(bench_link)
 namespace.add_task(show_context)
 namespace.add_task(sbatch)
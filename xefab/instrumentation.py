@@ -0,0 +1,263 @@
+"""Records of remote calls, see `xefab --trace`.
+
+Every `Connection.run`, `sudo`, `local`, `put` and `get` and every
+operation on a pooled SFTP session is recorded with its (redacted)
+command, host, bytes in/out and wall time into a ring buffer. The
+summary counts round trips and network time, so tasks making a remote
+call per item of a list stand out. Calls made within another recorded
+call (e.g. the SFTP requests of a `get`) are recorded nested below it
+and are not counted as round trips of their own.
+"""
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import re
+import threading
+import time
+
+DEFAULT_SIZE = 10000
+
+# Longest command kept in a record
+MAX_COMMAND_LENGTH = 500
+
+# Values of options and variables that look like credentials
+SECRET_PATTERN = re.compile(
+    r"((?:password|passwd|passphrase|token|secret|api[_-]?key|auth)"
+    r"[\w-]*\s*[=:]\s*|--(?:password|token|secret)[\w-]*\s+)"
+    r"(\"[^\"]*\"|'[^']*'|\S+)",
+    re.IGNORECASE,
+)
+
+# Passwords in user:password@host, with or without a URL scheme
+USERINFO_PATTERN = re.compile(r"((?<![\w.%+-])[\w.%+-]+:)([^\s@/:]+)(?=@)")
+
+# curl -u user:password and the like
+USER_OPTION_PATTERN = re.compile(
+    r"((?:^|\s)(?:-u|--user)(?:\s+|=)?['\"]?[^\s:'\"]+:)([^\s'\"]+)"
+)
+
+# -p is the password of sshpass and mysql, elsewhere mostly a port or partition
+PASSWORD_OPTION_PATTERN = re.compile(
+    r"(\b(?:sshpass|mysql|mariadb)\b[^|;&]*?\s-p\s*)(\"[^\"]*\"|'[^']*'|\S+)"
+)
+
+# Patterns of (prefix, secret) groups
+SECRET_PATTERNS = (
+    SECRET_PATTERN,
+    USERINFO_PATTERN,
+    USER_OPTION_PATTERN,
+    PASSWORD_OPTION_PATTERN,
+)
+
+# Operations on the local host, not counted as round trips
+LOCAL_OPS = ("local",)
+
+
+def redact(command):
+    """Hide credentials in a command and truncate it."""
+    command = str(command)
+    for pattern in SECRET_PATTERNS:
+        command = pattern.sub(lambda m: m.group(1) + "***", command)
+    if len(command) > MAX_COMMAND_LENGTH:
+        command = command[:MAX_COMMAND_LENGTH] + "..."
+    return command
+
+
+class CallRecorder:
+    """Ring buffer of remote call records."""
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.started = time.perf_counter()
+        self.records = collections.deque(maxlen=size)
+        # Event counts, e.g. content cache hits and misses
+        self.counters = collections.Counter()
+        self._local = threading.local()
+
+    def resize(self, size):
+        self.records = collections.deque(self.records, maxlen=size)
+
+    def clear(self):
+        self.records.clear()
+        self.counters.clear()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    @contextlib.contextmanager
+    def record(self, op, host=None, command=None, bytes_out=0, nest=True):
+        """Record the enclosed block as a call. Yields the record,
+        so the block can fill in bytes_in, bytes_out and exited.
+        Calls recorded within the block are nested below it, unless
+        `nest` is False (e.g. for coroutines sharing the thread).
+        """
+        depth = getattr(self._local, "depth", 0)
+        if nest:
+            self._local.depth = depth + 1
+        record = {
+            "op": op,
+            "host": host,
+            "command": redact(command) if command is not None else None,
+            "bytes_in": 0,
+            "bytes_out": bytes_out,
+            "depth": depth,
+            "thread": threading.current_thread().name,
+        }
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record["exception"] = type(e).__name__
+            raise
+        finally:
+            record["start"] = start - self.started
+            record["duration"] = time.perf_counter() - start
+            if nest:
+                self._local.depth = depth
+            self.records.append(record)
+
+    def summary(self, slowest=10):
+        """Round trips, network time and the slowest calls."""
+        records = list(self.records)
+        remote = [r for r in records if r["depth"] == 0 and r["op"] not in LOCAL_OPS]
+        by_op = collections.Counter(r["op"] for r in remote)
+        return {
+            "round_trips": len(remote),
+            "network_time": sum(r["duration"] for r in remote),
+            "bytes_in": sum(r["bytes_in"] for r in remote),
+            "bytes_out": sum(r["bytes_out"] for r in remote),
+            "by_op": dict(by_op),
+            "counters": dict(self.counters),
+            "slowest": sorted(records, key=lambda r: -r["duration"])[:slowest],
+        }
+
+    def dump(self, path):
+        """Export the records as JSON lines, followed by the counters."""
+        with open(path, "w") as f:
+            for record in self.records:
+                f.write(json.dumps(record) + "\n")
+            if self.counters:
+                f.write(json.dumps({"counters": dict(self.counters)}) + "\n")
+
+    def table(self, slowest=10):
+        from rich.table import Table
+
+        summary = self.summary(slowest=slowest)
+        ops = ", ".join(f"{op}: {n}" for op, n in sorted(summary["by_op"].items()))
+        caption = (
+            f"{summary['round_trips']} round trips ({ops}), "
+            f"{summary['network_time']:.3f}s network time, "
+            f"{summary['bytes_out']} bytes out, {summary['bytes_in']} bytes in"
+        )
+        if summary["counters"]:
+            counters = sorted(summary["counters"].items())
+            caption += "\n" + ", ".join(f"{name}: {n}" for name, n in counters)
+        table = Table(
+            title="xefab remote calls",
+            caption=caption,
+            header_style="bold magenta",
+        )
+        table.add_column("Call")
+        table.add_column("Host")
+        table.add_column("Command")
+        table.add_column("Duration [s]", justify="right")
+        for record in summary["slowest"]:
+            op = "  " * record["depth"] + record["op"]
+            if record.get("exception"):
+                op += f" ({record['exception']})"
+            table.add_row(
+                op,
+                str(record["host"] or ""),
+                record["command"] or "",
+                f"{record['duration']:.3f}",
+            )
+        return table
+
+
+recorder = CallRecorder()
+
+
+def file_size(f):
+    """Size of a local path, or position of a file-like object."""
+    if isinstance(f, (str, os.PathLike)):
+        try:
+            return os.path.getsize(f)
+        except OSError:
+            return 0
+    try:
+        return f.tell()
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def instrument_connection(cls):
+    """Record the calls of a Fabric connection class."""
+
+    def command_call(op, method):
+        @functools.wraps(method)
+        def wrapper(self, command, **kwargs):
+            host = None if op == "local" else self.host
+            with recorder.record(
+                op, host=host, command=command, bytes_out=len(command)
+            ) as record:
+                result = method(self, command, **kwargs)
+                if result is not None:
+                    record["bytes_in"] = len(result.stdout or "") + len(
+                        result.stderr or ""
+                    )
+                    record["exited"] = result.exited
+                return result
+
+        return wrapper
+
+    def argument(args, kwargs, index, name):
+        return args[index] if len(args) > index else kwargs.get(name, None)
+
+    # Arguments are passed on as given, the signatures are Fabric's
+    def put(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            local = argument(args, kwargs, 0, "local")
+            remote = argument(args, kwargs, 1, "remote")
+            with recorder.record("put", host=self.host, command=remote) as record:
+                result = method(self, *args, **kwargs)
+                record["bytes_out"] = file_size(local)
+                return result
+
+        return wrapper
+
+    def get(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            remote = argument(args, kwargs, 0, "remote")
+            local = argument(args, kwargs, 1, "local")
+            with recorder.record("get", host=self.host, command=remote) as record:
+                result = method(self, *args, **kwargs)
+                record["bytes_in"] = file_size(
+                    local if local is not None and not isinstance(local, str)
+                    else result.local
+                )
+                return result
+
+        return wrapper
+
+    if getattr(cls, "_xefab_instrumented", False):
+        return cls
+    cls.run = command_call("run", cls.run)
+    cls.sudo = command_call("sudo", cls.sudo)
+    cls.local = command_call("local", cls.local)
+    cls.put = put(cls.put)
+    cls.get = get(cls.get)
+    cls._xefab_instrumented = True
+    return cls
+
+
+def install():
+    """Record the calls of all Fabric connections. Not done on import,
+    fabric must be imported after `xefab.ssh_client` patched paramiko.
+    """
+    from fabric.connection import Connection
+
+    instrument_connection(Connection)
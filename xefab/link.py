@@ -0,0 +1,232 @@
+"""Tuning of SSH links with a long round-trip time.
+
+Paramiko's defaults (2 MiB channel window, 32 KiB packets, no
+compression, AES-CTR first) cap the throughput of links such as
+Europe <-> Chicago well below the available bandwidth. The `link`
+settings can be given per host collection, e.g.
+
+    namespace.configure({"hostnames": [...], "link": {"window_size": 16 * 2**20}})
+
+or in the user config, which takes precedence. A setting of None keeps
+paramiko's default:
+
+    window_size: channel window in bytes.
+    max_packet_size: maximum packet size in bytes.
+    compress: whether to use zlib compression.
+    ciphers: preferred ciphers, tried before the other supported ones.
+    prefetch: whether SFTP downloads prefetch the file.
+    max_concurrent_prefetch_requests: limit of in-flight prefetch requests.
+    pipelined: whether SFTP uploads pipeline writes without awaiting acks.
+
+Transport settings apply to directly opened transports, transports held
+by the broker keep the settings they were opened with.
+"""
+
+import os
+import time
+from io import BytesIO
+
+import paramiko
+
+LINK_SETTINGS = (
+    "window_size",
+    "max_packet_size",
+    "compress",
+    "ciphers",
+    "prefetch",
+    "max_concurrent_prefetch_requests",
+    "pipelined",
+)
+
+DEFAULT_LINK = {name: None for name in LINK_SETTINGS}
+
+MiB = 2**20
+
+# Bytes per SFTP write, as in paramiko's putfo
+CHUNK_SIZE = 32768
+
+# Candidate settings compared by the bench-link task
+BENCH_PROFILES = {
+    "default": {},
+    "wide-window": {"window_size": 16 * MiB},
+    "wide-window-large-packets": {
+        "window_size": 16 * MiB,
+        "max_packet_size": 65536,
+    },
+    "compressed": {"compress": True},
+    "aes-gcm": {"ciphers": ["aes128-gcm@openssh.com", "aes256-gcm@openssh.com"]},
+    "limited-prefetch": {
+        "window_size": 16 * MiB,
+        "max_concurrent_prefetch_requests": 64,
+    },
+}
+
+# Settings by hostname, registered when a host collection is selected
+_hosts = {}
+_defaults = {}
+
+
+def clean(settings):
+    """Drop unset and unknown settings."""
+    return {
+        name: value
+        for name, value in dict(settings or {}).items()
+        if name in LINK_SETTINGS and value is not None
+    }
+
+
+def merge(*settings):
+    """Merge settings, later ones take precedence where they are set."""
+    merged = {}
+    for s in settings:
+        merged.update(clean(s))
+    return merged
+
+
+def configure(hostnames=(), settings=None, defaults=None):
+    """Register the settings of hosts and/or the defaults of other hosts."""
+    if defaults is not None:
+        _defaults.clear()
+        _defaults.update(clean(defaults))
+    for hostname in hostnames:
+        _hosts[hostname] = clean(settings)
+
+
+def settings_for(hostname):
+    return dict(_hosts.get(hostname, _defaults))
+
+
+def transport_factory(settings):
+    """A paramiko transport factory applying the transport settings."""
+    kwargs = {}
+    if settings.get("window_size"):
+        kwargs["default_window_size"] = int(settings["window_size"])
+    if settings.get("max_packet_size"):
+        kwargs["default_max_packet_size"] = int(settings["max_packet_size"])
+    ciphers = settings.get("ciphers")
+    if isinstance(ciphers, str):
+        ciphers = ciphers.split(",")
+
+    def factory(sock, **transport_kwargs):
+        transport = paramiko.Transport(sock, **kwargs, **transport_kwargs)
+        if ciphers:
+            options = transport.get_security_options()
+            supported = list(options.ciphers)
+            preferred = [name for name in ciphers if name in supported]
+            options.ciphers = preferred + [
+                name for name in supported if name not in preferred
+            ]
+        return transport
+
+    return factory
+
+
+def connect_kwargs(settings):
+    """Keyword arguments of `SSHClient.connect` applying the settings."""
+    kwargs = {}
+    transport_settings = ("window_size", "max_packet_size", "ciphers")
+    if any(settings.get(name) for name in transport_settings):
+        kwargs["transport_factory"] = transport_factory(settings)
+    if settings.get("compress") is not None:
+        kwargs["compress"] = bool(settings["compress"])
+    return kwargs
+
+
+class TunedSFTPClient:
+    """SFTP client applying the prefetch and pipelining settings
+    to transfers, other attributes are those of the wrapped client.
+    """
+
+    def __init__(self, sftp, settings=None):
+        self._sftp = sftp
+        self._settings = clean(settings)
+
+    def __getattr__(self, name):
+        return getattr(self._sftp, name)
+
+    def getfo(self, remotepath, fl, callback=None, **kwargs):
+        for name in ("prefetch", "max_concurrent_prefetch_requests"):
+            if name in self._settings:
+                kwargs.setdefault(name, self._settings[name])
+        return self._sftp.getfo(remotepath, fl, callback=callback, **kwargs)
+
+    def get(self, remotepath, localpath, callback=None, **kwargs):
+        with open(localpath, "wb") as fl:
+            size = self.getfo(remotepath, fl, callback=callback, **kwargs)
+        s = os.stat(localpath)
+        if s.st_size != size:
+            raise IOError(f"size mismatch in get!  {s.st_size} != {size}")
+
+    def putfo(self, fl, remotepath, file_size=0, callback=None, confirm=True):
+        if self._settings.get("pipelined", True):
+            return self._sftp.putfo(
+                fl, remotepath, file_size=file_size, callback=callback, confirm=confirm
+            )
+        size = 0
+        with self._sftp.file(remotepath, "wb") as fr:
+            fr.set_pipelined(False)
+            while True:
+                data = fl.read(CHUNK_SIZE)
+                if not data:
+                    break
+                fr.write(data)
+                size += len(data)
+                if callback is not None:
+                    callback(size, file_size)
+        if not confirm:
+            return paramiko.SFTPAttributes()
+        s = self._sftp.stat(remotepath)
+        if s.st_size != size:
+            raise IOError(f"size mismatch in put!  {s.st_size} != {size}")
+        return s
+
+    def put(self, localpath, remotepath, callback=None, confirm=True):
+        file_size = os.stat(localpath).st_size
+        with open(localpath, "rb") as fl:
+            return self.putfo(fl, remotepath, file_size, callback, confirm)
+
+
+def bench(c, settings, size, remote_path):
+    """Measure a fresh link to the host of a connection with settings.
+    Returns the connect time in seconds and the upload and download
+    throughput in MB/s of a file of size bytes.
+    """
+    from xefab.ssh_client import SSHClient
+
+    client = SSHClient()
+    # Measure a link of its own
+    client.use_pool = False
+    client.use_broker = False
+    client.load_system_host_keys()
+    # The policy of the connection, fabric's unless overridden
+    client.set_missing_host_key_policy(c.client._policy)
+    kwargs = dict(
+        c.connect_kwargs,
+        # Explicitly, the settings registered for the host don't apply
+        transport_factory=transport_factory(settings),
+        compress=bool(settings.get("compress")),
+    )
+
+    start = time.perf_counter()
+    client.connect(c.host, port=c.port, username=c.user, **kwargs)
+    connected = time.perf_counter()
+    try:
+        sftp = TunedSFTPClient(client.open_sftp(), settings)
+        data = os.urandom(size)
+        start_upload = time.perf_counter()
+        sftp.putfo(BytesIO(data), remote_path, file_size=size)
+        uploaded = time.perf_counter()
+        out = BytesIO()
+        sftp.getfo(remote_path, out)
+        downloaded = time.perf_counter()
+        sftp.remove(remote_path)
+        if out.getvalue() != data:
+            raise IOError("Downloaded data differs from uploaded data")
+    finally:
+        client.close()
+
+    return {
+        "connect_s": connected - start,
+        "upload_MBps": size / 1e6 / (uploaded - start_upload),
+        "download_MBps": size / 1e6 / (downloaded - uploaded),
+    }
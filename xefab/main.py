@@ -1,30 +1,45 @@
 """Console script for xesites."""
 import inspect
 import sys
-from collections import defaultdict
 
-# IMPORTANT: Must be imported before fabric for monkey patching to work
 # isort: off
+# Imported first so the startup imports can be timed
+from xefab.profiling import profiler  # isort: skip
+
+# IMPORTANT: Must be imported before fabric for monkey patching to work
 from xefab.ssh_client import SSHClient  # isort: skip
 
 # isort: on
 
 from fabric.executor import Executor
 from fabric.main import Fab
-from invoke.exceptions import Exit
-from invoke.parser import Argument
+from invoke.exceptions import Exit, ParseError
+from invoke.parser import Argument, ParseResult
 from invoke.util import debug, helpline
-from rich.console import Group, NewLine, group
+from rich.console import Console, Group, NewLine, group
 from rich.padding import Padding
 from rich.panel import Panel
 from rich.table import Table
 from rich.text import Text
 from rich.tree import Tree
 
-from xefab import __version__, tasks
-from xefab.collection import XefabCollection
+from xefab import __version__, link
+from xefab.cache import (content_cache, entry_points_key, read_cache,
+                         write_cache)
+from xefab.collection import (CachedCollection, CachedTask, XefabCollection,
+                              collection_snapshot, context_flags)
+from xefab.completion import (print_completion_script,
+                              read_completion_index, write_completion_index)
 from xefab.config import Config
-from xefab.utils import ProgressContext, console, nested_dict
+from xefab.executor import MultiHostExecutor
+from xefab.instrumentation import install as install_instrumentation
+from xefab.instrumentation import recorder
+from xefab.pool import pool
+from xefab.utils import console
+
+install_instrumentation()
+
+profiler.mark("imports")
 
 
 @group()
@@ -62,6 +77,9 @@ class XeFab(Fab):
 
     ROOT_COLLECTION_NAME = "main"
     USER_COLLECTION_NAME = "my-tasks"
+    HELP_CACHE_NAME = "help_tree.json"
+
+    host_collections = {}
 
     def core_args(self):
         """Add xefab config to core args."""
@@ -77,6 +95,28 @@ class XeFab(Fab):
                     arg.default = DEFAULTS[name]
 
         my_args = [
+            Argument(
+                names=("profile",),
+                kind=bool,
+                default=False,
+                help="Print wall-clock timings of startup and execution phases at exit.",
+            ),
+            Argument(
+                names=("profile-file",),
+                kind=str,
+                help="Dump the phase timings as JSON to this file at exit.",
+            ),
+            Argument(
+                names=("trace",),
+                kind=bool,
+                default=False,
+                help="Print the round trips, network time and slowest remote calls at exit.",
+            ),
+            Argument(
+                names=("trace-file",),
+                kind=str,
+                help="Dump the remote calls as JSON lines to this file at exit.",
+            ),
             # Argument(
             #     names=("verbose", "v"),
             #     kind=int,
@@ -91,6 +131,67 @@ class XeFab(Fab):
     def task_args(self):
         return super().task_args()
 
+    def run(self, argv=None, exit=True):
+        try:
+            super().run(argv=argv, exit=exit)
+        finally:
+            self.report_profile()
+            self.report_calls()
+
+    def parse_core_args(self):
+        super().parse_core_args()
+        # Our completion scripts use the xefab-complete hook
+        shell = self.args["print-completion-script"].value
+        if shell:
+            try:
+                print_completion_script(shell=shell, names=self.binary_names)
+            except ValueError as e:
+                raise ParseError(str(e))
+            raise Exit
+
+    def report_profile(self):
+        """Print or dump the phase timings if --profile was given."""
+        try:
+            show = self.args.profile.value
+            path = self.args["profile-file"].value
+        except (AttributeError, IndexError, KeyError):
+            return
+        if path:
+            profiler.dump(path)
+        if show:
+            Console(stderr=True).print(profiler.table())
+
+    def report_calls(self):
+        """Print or dump the remote calls if --trace was given."""
+        try:
+            show = self.args.trace.value
+            path = self.args["trace-file"].value
+        except (AttributeError, IndexError, KeyError):
+            return
+        if path:
+            recorder.dump(path)
+        if show:
+            Console(stderr=True).print(recorder.table())
+
+    def execute(self):
+        recorder.resize(self.config.trace.size)
+        pool.configure(
+            enabled=self.config.pool.enabled, keepalive=self.config.pool.keepalive
+        )
+        link.configure(defaults=self.config.link)
+        content_cache.configure(max_size=self.config.content_cache.max_size)
+        with profiler.phase("execute"):
+            if len(self.host_collections) > 1:
+                executor = MultiHostExecutor(
+                    self.collection,
+                    self.config,
+                    self.core,
+                    host_collections=self.host_collections,
+                )
+                executor.execute(*self.tasks)
+            else:
+                super().execute()
+
     def parse_collection(self):
         user_namespace = None
         # Load any locally defined tasks
@@ -103,16 +204,29 @@ class XeFab(Fab):
             except Exit:
                 pass
 
-        # Load the default tasks
-        self.namespace = XefabCollection.from_module(
-            tasks, name=self.ROOT_COLLECTION_NAME
-        )
-        self.namespace.load_objects_from_entry_points()
+        self._help_cache_key = None
+        self.namespace = None
+        if user_namespace is None and self._requests_listing():
+            # Render listings/help from the cached task tree if it is up to date
+            self.namespace = self.load_cached_namespace()
+
+        if self.namespace is None:
+            with profiler.phase("collection construction"):
+                from xefab import tasks
+
+                # Load the default tasks
+                self.namespace = XefabCollection.from_module(
+                    tasks, name=self.ROOT_COLLECTION_NAME
+                )
+                # Host collections are only imported once selected (or listed)
+                self.namespace.load_objects_from_entry_points(lazy=True)
         if user_namespace is not None:
             for name, task in user_namespace.tasks.items():
                 self.namespace.add_task(task, name=name)
             for name, collection in user_namespace.collections.items():
                 self.namespace.add_collection(collection, name=name)
+        self.root_namespace = self.namespace
+        self._has_user_namespace = user_namespace is not None
 
         hostname = None
         if len(self.argv) > 1:
@@ -124,15 +238,38 @@ class XeFab(Fab):
                     argv.insert(1, arg)
                     continue
 
-                if "." in arg:
+                # keep other core flags (and their values) ahead of the tasks
+                flag = self.initial_context.flags.get(arg.partition("=")[0])
+                if flag is not None:
+                    argv.append(arg)
+                    if flag.takes_value and not flag.optional and "=" not in arg:
+                        if self.argv:
+                            argv.append(self.argv.pop(0))
+                    continue
+
+                if "." in arg and not arg.startswith("-"):
                     arg, _, rest = arg.partition(".")
                     self.argv.insert(0, rest)
 
+                if "," in arg and not arg.startswith("-") and hostname is None:
+                    host_collections = self.select_host_collections(arg.split(","))
+                    if host_collections:
+                        self.host_collections = host_collections
+                        self.namespace = next(iter(host_collections.values()))
+                        hostname = arg
+                        continue
+
+                if isinstance(self.namespace, XefabCollection):
+                    self.namespace.load_lazy_object(arg)
+
                 if arg in self.namespace.collections:
                     self.namespace = self.namespace.collections[arg]
                     hostnames = self.namespace._configuration.get("hostnames", None)
                     debug(f"xefab: {arg} hostnames: {hostnames}")
                     self.config.configure_ssh_for_host(arg, hostnames)
+                    self.config.configure_link_for_host(
+                        arg, self.namespace._configuration.get("link", None)
+                    )
                     if hostnames is not None and hostname is None:
                         hostname = arg
                 else:
@@ -147,11 +284,145 @@ class XeFab(Fab):
             # if we loaded a host collection, it sets the default host argument
             if not self.args.hosts.value and hostname is not None:
                 self.args.hosts.value = hostname
-        
+
+        if self.args.list.value or self.args.complete.value:
+            self.load_all_collections()
+
         super().parse_collection()
 
-    def task_panel(self, task, name, parents=None):
-        """Create a help panel for a specific task."""
+    def select_host_collections(self, names):
+        """Select several host collections to run tasks on concurrently.
+        Returns a dict of the collections by name, empty if any of the
+        names is not a host collection.
+        """
+        collections = {}
+        for name in names:
+            if isinstance(self.namespace, XefabCollection):
+                self.namespace.load_lazy_object(name)
+            collection = self.namespace.collections.get(name, None)
+            if collection is None:
+                return {}
+            hostnames = collection._configuration.get("hostnames", None)
+            if hostnames is None:
+                return {}
+            collections[name] = collection
+        for name, collection in collections.items():
+            hostnames = collection._configuration["hostnames"]
+            debug(f"xefab: {name} hostnames: {hostnames}")
+            self.config.configure_ssh_for_host(name, hostnames)
+            self.config.configure_link_for_host(
+                name, collection._configuration.get("link", None)
+            )
+        return collections
+
+    def _requests_listing(self):
+        """Whether argv asks for a task listing or help, or names no
+        tasks at all. Checked before the help cache is read, so running
+        tasks doesn't pay for it.
+        """
+        if self.args.complete.value:
+            return False
+        if self.args.list.value or self.args.help.value is True:
+            return True
+        flags = self.initial_context.flags
+        positional = False
+        tokens = iter(self.argv[1:])
+        for arg in tokens:
+            if arg == "--":
+                return False
+            if not arg.startswith("-"):
+                positional = True
+                continue
+            flag, eq, _ = arg.partition("=")
+            if flag in ["-l", "--list"] or (flag in ["-h", "--help"] and not eq):
+                return True
+            if flag in flags and flags[flag].takes_value and not eq:
+                if not flags[flag].optional:
+                    next(tokens, None)
+        return not positional
+
+    def _only_lists_tasks(self, namespace):
+        """Whether argv selects no tasks to run, i.e. the invocation
+        only prints a task listing or the core help for a collection.
+        """
+        if self.args.complete.value:
+            return False
+        flags = self.initial_context.flags
+        listing = bool(self.args.list.value or self.args.help.value is True)
+        tokens = iter(self.argv[1:])
+        for arg in tokens:
+            if arg == "--":
+                return False
+            if arg.startswith("-"):
+                flag, eq, _ = arg.partition("=")
+                if flag in ["-l", "--list"]:
+                    listing = True
+                elif flag in ["-h", "--help"]:
+                    if eq:
+                        return False
+                    listing = True
+                elif flag in flags and flags[flag].takes_value and not eq:
+                    if not flags[flag].optional:
+                        next(tokens, None)
+                continue
+            for part in arg.split("."):
+                if part not in namespace.collections:
+                    return False
+                namespace = namespace.collections[part]
+        return listing or not namespace.default
+
+    def load_cached_namespace(self):
+        """Load the task tree snapshot from the help cache.
+        Returns None if the cache is stale or tasks need to be parsed.
+        """
+        self._help_cache_key = entry_points_key()
+        data = read_cache(self.HELP_CACHE_NAME, self._help_cache_key)
+        if data is None:
+            debug("xefab: help cache is missing or stale")
+            return None
+        namespace = CachedCollection.from_snapshot(data)
+        if not self._only_lists_tasks(namespace):
+            return None
+        debug("xefab: rendering help from cache")
+        return namespace
+
+    def load_all_collections(self):
+        """Import all lazily registered collections.
+        Updates the help cache and completion index if they are stale.
+        """
+        if not isinstance(self.root_namespace, XefabCollection):
+            return
+        self.root_namespace.load_lazy_objects()
+        if self._has_user_namespace:
+            return
+        if self._help_cache_key is None:
+            self._help_cache_key = entry_points_key()
+        snapshot = None
+        if read_cache(self.HELP_CACHE_NAME, self._help_cache_key) is None:
+            snapshot = collection_snapshot(self.root_namespace)
+            write_cache(self.HELP_CACHE_NAME, self._help_cache_key, snapshot)
+        if read_completion_index() is None:
+            if snapshot is None:
+                snapshot = collection_snapshot(self.root_namespace)
+            write_completion_index(
+                snapshot,
+                core_flags=context_flags(self.initial_context),
+                collection_name=self.config.tasks.collection_name,
+            )
+
+    def parse_tasks(self):
+        if isinstance(self.collection, CachedCollection):
+            # Only listing/help was requested, there are no tasks to parse.
+            self.parser = None
+            self.tasks = ParseResult()
+            return
+        super().parse_tasks()
+
+    def task_panel(self, task, name, parents=None, contexts=None):
+        """Create a help panel for a specific task.
+        contexts are the names of the parser contexts to take
+        the task options from, by default derived from parents.
+        """
         if parents is None:
             parents = ()
         if isinstance(parents, str):
@@ -162,14 +433,15 @@ class XeFab(Fab):
         if docstring is None:
             docstring = ""
         tuples = []
-        if name in self.parser.contexts:
-            ctx = self.parser.contexts[name]
-            tuples = ctx.help_tuples()
-        elif parents:
-            for parent in parents:
-                if f"{'.'.join(parent)}.{name}" in self.parser.contexts:
-                    ctx = self.parser.contexts[f"{'.'.join(parent)}.{name}"]
-                    tuples = ctx.help_tuples()
+        if isinstance(task, CachedTask):
+            tuples = task.help_tuples
+        else:
+            if contexts is None:
+                contexts = [name]
+                contexts += [".".join(parent + (name,)) for parent in parents]
+            for context in contexts:
+                if context in self.parser.contexts:
+                    tuples = self.parser.contexts[context].help_tuples()
                     break
 
         if len(parents) > 1:
@@ -217,35 +489,32 @@ class XeFab(Fab):
             self.task_tree(subcollection, tree=subtree, parents=parents + (name,))
         return tree
 
-    def unique_tasks(self, collection, parents=()):
-        """Create a set of unique tasks."""
-        tasks = set()
-        for name, task in collection.tasks.items():
-            tasks.add(task)
-
-        for name, subcollection in collection.collections.items():
-            tasks.update(self.unique_tasks(subcollection, parents=parents + (name,)))
-        return tasks
-
-    def find_task_paths(self, task, collection, parents=()):
-        """Find all paths to a task."""
-        paths = []
-        for name, subtask in collection.tasks.items():
-            if subtask == task:
-                paths.append(parents)
-
-        for name, subcollection in collection.collections.items():
-            paths.extend(
-                self.find_task_paths(task, subcollection, parents=parents + (name,))
-            )
-        return paths
+    def task_index(self, collection, prefix=()):
+        """Map each unique task to the paths of the collections it
+        appears in and the names of its parser contexts.
+        Built in a single walk of the collection tree, prefix is
+        the path of the collection from the root namespace.
+        """
+        index = {}
+
+        def walk(collection, parents):
+            for name, task in collection.tasks.items():
+                entry = index.setdefault(task, {"paths": [], "contexts": []})
+                entry["paths"].append(parents)
+                entry["contexts"].append(".".join(prefix + parents + (name,)))
+            for name, subcollection in collection.collections.items():
+                walk(subcollection, parents + (name,))
+
+        walk(collection, ())
+        return index
 
     def collection_panel(self, collection, parents=()):
         """Create a help panel for a specific collection."""
         panels = []
-        for task in self.unique_tasks(collection):
-            task_paths = self.find_task_paths(task, collection)
-            panel = self.task_panel(task, task.name, parents=task_paths)
+        for task, entry in self.task_index(collection, prefix=parents).items():
+            panel = self.task_panel(
+                task, task.name, parents=entry["paths"], contexts=entry["contexts"]
+            )
             panels.append(panel)
         return Group(*panels)
 
@@ -301,11 +570,8 @@ class XeFab(Fab):
         console.print(Text(f"\n\nAvailable Tasks:\n", style="bold"))
         console.print(self._make_help_tree(self.scoped_collection))
         console.print(Text(f"\n\nTask Usage:\n", style="bold"))
-        console.print(
-            self.collection_panel(
-                self.scoped_collection,
-            )
-        )
+        parents = tuple(self.list_root.split(".")) if self.list_root else ()
+        console.print(self.collection_panel(self.scoped_collection, parents=parents))
 
     def list_nested(self):
         """List all tasks in the current namespace."""
@@ -343,6 +609,7 @@ class XeFab(Fab):
         self.print_columns(self.initial_context.help_tuples())
         console.print("\n")
         if self.namespace is not None:
+            self.load_all_collections()
             self.list_tasks()
 
 
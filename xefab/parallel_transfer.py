@@ -0,0 +1,502 @@
+"""Transfers of large files as ranges moved concurrently.
+
+A single SFTP stream is limited by the round-trip time of its requests
+and acks. The engine splits a file into chunks that several workers
+move concurrently, each over its own SFTP channel on the connection's
+transport. Data goes to a `.part` file next to the target, which is
+renamed over it once the sha256 digests computed on both ends agree.
+
+Completed chunks are recorded in a journal in the xefab cache
+directory, so an interrupted transfer started again with `resume`
+only moves the missing chunks, provided the source is unchanged.
+
+Directory trees are walked and moved by concurrent workers as well.
+Small files are moved in groups whose reads or writes are pipelined,
+so a tree of many small files isn't bound by a round trip per file.
+"""
+
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import posixpath
+import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_ISDIR, S_ISLNK
+
+from xefab.cache import cache_path, makedirs_private, open_private
+from xefab.instrumentation import recorder
+from xefab.pool import open_sftp
+from xefab.utils import console
+
+CHUNK_SIZE = 16 * 2**20
+# Size of the reads and writes a chunk is moved in
+BLOCK_SIZE = 2**20
+
+JOURNAL_DIR = "transfers"
+
+
+class TransferJournal:
+    """Record of the completed chunks of a transfer."""
+
+    def __init__(self, state, resume=False):
+        identity = {k: state[k] for k in ("direction", "host", "remote", "local")}
+        key = hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+        self.path = cache_path(os.path.join(JOURNAL_DIR, f"{key}.json"))
+        self.state = state
+        self.done = set()
+        self._lock = threading.Lock()
+        if resume:
+            try:
+                with open(self.path) as f:
+                    journal = json.load(f)
+                if journal["state"] == state:
+                    self.done = set(journal["done"])
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def mark(self, index):
+        with self._lock:
+            self.done.add(index)
+            self.write()
+
+    def write(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        makedirs_private(os.path.dirname(self.path))
+        with open_private(tmp_path) as f:
+            json.dump({"state": self.state, "done": sorted(self.done)}, f)
+        os.replace(tmp_path, self.path)
+
+    def reset(self):
+        with self._lock:
+            self.done.clear()
+            self.write()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def chunks(size, chunk_size=CHUNK_SIZE):
+    """The (offset, length) ranges of a file."""
+    return [
+        (offset, min(chunk_size, size - offset))
+        for offset in range(0, size, chunk_size)
+    ]
+
+
+def local_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def remote_sha256(c, path):
+    quoted = shlex.quote(path)
+    result = c.run(
+        f"sha256sum {quoted} 2>/dev/null || shasum -a 256 {quoted}",
+        hide=True,
+        in_stream=False,
+    )
+    return result.stdout.split()[0]
+
+
+def run_workers(c, ranges, pending, streams, move):
+    """Move the pending chunks with streams workers, each with an SFTP
+    channel of its own. move(sftp, index, offset, length) moves a chunk.
+    """
+
+    def move_chunk(sftp, index):
+        move(sftp, index, *ranges[index])
+
+    run_units(c, pending, streams, move_chunk)
+
+
+def download(
+    c,
+    remote,
+    local=None,
+    streams=4,
+    resume=False,
+    chunk_size=CHUNK_SIZE,
+    preserve_mode=True,
+):
+    """Download a file with streams concurrent channels, returns the local path."""
+    if local is None:
+        local = os.path.basename(remote)
+    elif os.path.isdir(local):
+        local = os.path.join(local, os.path.basename(remote))
+    local = os.path.abspath(local)
+    part = f"{local}.part"
+
+    c.open()
+    attrs = c.sftp().stat(remote)
+    ranges = chunks(attrs.st_size, chunk_size)
+    state = dict(
+        direction="download",
+        host=c.host,
+        remote=remote,
+        local=local,
+        size=attrs.st_size,
+        mtime=attrs.st_mtime,
+        chunk_size=chunk_size,
+    )
+    journal = TransferJournal(state, resume=resume)
+    valid_part = os.path.exists(part) and os.path.getsize(part) == attrs.st_size
+    if not (journal.done and valid_part):
+        with open(part, "wb") as f:
+            f.truncate(attrs.st_size)
+        journal.reset()
+
+    fd = os.open(part, os.O_WRONLY)
+
+    def move(sftp, index, offset, length):
+        with sftp.open(remote, "rb") as f:
+            blocks = [(offset + start, n) for start, n in chunks(length, BLOCK_SIZE)]
+            for (start, _), data in zip(blocks, f.readv(blocks)):
+                os.pwrite(fd, data, start)
+        journal.mark(index)
+
+    with recorder.record("get", host=c.host, command=remote) as record:
+        with ThreadPoolExecutor(max_workers=1) as hasher:
+            # The remote digest is computed while the data moves
+            digest = hasher.submit(remote_sha256, c, remote)
+            try:
+                pending = [i for i in range(len(ranges)) if i not in journal.done]
+                run_workers(c, ranges, pending, streams, move)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            record["bytes_in"] = sum(ranges[i][1] for i in pending)
+            if local_sha256(part) != digest.result():
+                journal.remove()
+                raise IOError(f"Checksum mismatch downloading {remote}, start again.")
+
+    os.replace(part, local)
+    if preserve_mode:
+        os.chmod(local, attrs.st_mode & 0o7777)
+    journal.remove()
+    return local
+
+
+def upload(
+    c,
+    local,
+    remote=None,
+    streams=4,
+    resume=False,
+    chunk_size=CHUNK_SIZE,
+    preserve_mode=True,
+):
+    """Upload a file with streams concurrent channels, returns the remote path."""
+    c.open()
+    sftp = c.sftp()
+    if remote is None:
+        remote = os.path.basename(local)
+    else:
+        try:
+            if S_ISDIR(sftp.stat(remote).st_mode):
+                remote = f"{remote.rstrip('/')}/{os.path.basename(local)}"
+        except IOError:
+            pass
+    part = f"{remote}.part"
+
+    stat = os.stat(local)
+    ranges = chunks(stat.st_size, chunk_size)
+    state = dict(
+        direction="upload",
+        host=c.host,
+        remote=remote,
+        local=os.path.abspath(local),
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+        chunk_size=chunk_size,
+    )
+    journal = TransferJournal(state, resume=resume)
+    try:
+        valid_part = journal.done and sftp.stat(part).st_size == stat.st_size
+    except IOError:
+        valid_part = False
+    if not valid_part:
+        with sftp.open(part, "wb"):
+            pass
+        sftp.truncate(part, stat.st_size)
+        journal.reset()
+
+    fd = os.open(local, os.O_RDONLY)
+
+    def move(sftp, index, offset, length):
+        # Closing the handle waits for the acks of the pipelined writes
+        with sftp.open(part, "r+b") as f:
+            f.set_pipelined(True)
+            f.seek(offset)
+            for start, n in chunks(length, BLOCK_SIZE):
+                f.write(os.pread(fd, n, offset + start))
+        journal.mark(index)
+
+    with recorder.record("put", host=c.host, command=remote) as record:
+        with ThreadPoolExecutor(max_workers=1) as hasher:
+            # The local digest is computed while the data moves
+            digest = hasher.submit(local_sha256, local)
+            try:
+                pending = [i for i in range(len(ranges)) if i not in journal.done]
+                run_workers(c, ranges, pending, streams, move)
+            finally:
+                os.close(fd)
+            record["bytes_out"] = sum(ranges[i][1] for i in pending)
+            if remote_sha256(c, part) != digest.result():
+                journal.remove()
+                raise IOError(f"Checksum mismatch uploading {local}, start again.")
+
+    sftp.posix_rename(part, remote)
+    if preserve_mode:
+        sftp.chmod(remote, stat.st_mode & 0o7777)
+    journal.remove()
+    return remote
+
+
+# Files up to SMALL_FILE bytes are moved in groups of up to GROUP_FILES
+# files and GROUP_BYTES bytes, overlapping their reads or writes
+SMALL_FILE = 2**20
+GROUP_FILES = 32
+GROUP_BYTES = 8 * 2**20
+
+
+def groups(files):
+    """Work units of (relpath, size) files: large files on their own,
+    small files grouped.
+    """
+    units, group, group_bytes = [], [], 0
+    for relpath, size in files:
+        if size > SMALL_FILE:
+            units.append([(relpath, size)])
+            continue
+        if len(group) == GROUP_FILES or group_bytes + size > GROUP_BYTES:
+            units.append(group)
+            group, group_bytes = [], 0
+        group.append((relpath, size))
+        group_bytes += size
+    if group:
+        units.append(group)
+    return units
+
+
+def run_units(c, units, workers, move):
+    """Move work units with workers, each with an SFTP channel of its own.
+    move(sftp, unit) moves a unit.
+    """
+    queue = collections.deque(units)
+    lock = threading.Lock()
+
+    def worker():
+        with open_sftp(c.transport, c.host) as sftp:
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    unit = queue.popleft()
+                move(sftp, unit)
+
+    n_workers = max(1, min(workers, len(queue)))
+    with ThreadPoolExecutor(max_workers=n_workers) as threads:
+        futures = [threads.submit(worker) for _ in range(n_workers)]
+    for future in futures:
+        future.result()
+
+
+def walk_remote(c, root, workers=8):
+    """The directories and (relpath, size, mode) files below a remote
+    directory, listed with listdir_attr by concurrent workers.
+    """
+    dirs, files = [], []
+    pending = [""]
+    lock = threading.Condition()
+    busy = 0
+
+    def worker():
+        nonlocal busy
+        sftp = open_sftp(c.transport, c.host)
+        try:
+            while True:
+                with lock:
+                    while not pending and busy:
+                        lock.wait()
+                    if not pending:
+                        return
+                    relpath = pending.pop()
+                    busy += 1
+                entries = []
+                try:
+                    for attrs in sftp.listdir_attr(posixpath.join(root, relpath)):
+                        path = posixpath.join(relpath, attrs.filename)
+                        if S_ISLNK(attrs.st_mode):
+                            # Links to files are followed, links to directories not
+                            attrs = sftp.stat(posixpath.join(root, path))
+                            if S_ISDIR(attrs.st_mode):
+                                continue
+                        entries.append((path, attrs))
+                finally:
+                    with lock:
+                        busy -= 1
+                        for path, attrs in entries:
+                            if S_ISDIR(attrs.st_mode):
+                                dirs.append(path)
+                                pending.append(path)
+                            else:
+                                files.append((path, attrs.st_size, attrs.st_mode))
+                        lock.notify_all()
+        finally:
+            sftp.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as threads:
+        futures = [threads.submit(worker) for _ in range(workers)]
+    for future in futures:
+        future.result()
+    return sorted(dirs), sorted(files)
+
+
+def walk_local(root):
+    """The directories and (relpath, size, mode) files below a local directory."""
+    dirs, files = [], []
+    for dirpath, dirnames, filenames in os.walk(root):
+        relpath = os.path.relpath(dirpath, root)
+        for name in dirnames:
+            dirs.append(os.path.normpath(os.path.join(relpath, name)))
+        for name in filenames:
+            path = os.path.normpath(os.path.join(relpath, name))
+            stat = os.stat(os.path.join(root, path))
+            files.append((path, stat.st_size, stat.st_mode))
+    return sorted(dirs), sorted(files)
+
+
+def transfer_progress():
+    from rich.progress import (BarColumn, DownloadColumn, TextColumn,
+                               TimeRemainingColumn, TransferSpeedColumn)
+
+    from xefab.progress import ProgressContext, SuccessSpinnerColumn
+
+    return ProgressContext(
+        SuccessSpinnerColumn(),
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        DownloadColumn(),
+        TransferSpeedColumn(),
+        TimeRemainingColumn(),
+        console=console,
+    )
+
+
+def download_dir(c, remote, local=None, workers=8, hide=False):
+    """Download a directory tree with concurrent workers, returns the
+    number of files and bytes transferred.
+    """
+    if local is None:
+        local = posixpath.basename(remote.rstrip("/"))
+    c.open()
+    dirs, files = walk_remote(c, remote, workers)
+    modes = {path: mode for path, _, mode in files}
+    os.makedirs(local, exist_ok=True)
+    for path in dirs:
+        os.makedirs(os.path.join(local, path), exist_ok=True)
+    total = sum(size for _, size, _ in files)
+
+    progress = None if hide else transfer_progress()
+    with progress or contextlib.nullcontext():
+        if progress is not None:
+            task = progress.add_task(f"Downloading {remote} from {c.host}", total=total)
+
+        def move(sftp, unit):
+            # Open all files of the unit, then read them with prefetch
+            # so the reads of the group overlap
+            handles = []
+            try:
+                for relpath, size in unit:
+                    f = sftp.open(posixpath.join(remote, relpath), "rb")
+                    handles.append(f)
+                    f.prefetch(size)
+                for f, (relpath, size) in zip(handles, unit):
+                    target = os.path.join(local, relpath)
+                    with open(target, "wb") as out:
+                        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                            out.write(block)
+                            if progress is not None:
+                                progress.advance(task, len(block))
+                    os.chmod(target, modes[relpath] & 0o7777)
+            finally:
+                for f in handles:
+                    f.close()
+
+        with recorder.record("get", host=c.host, command=remote) as record:
+            units = groups([(path, size) for path, size, _ in files])
+            run_units(c, units, workers, move)
+            record["bytes_in"] = total
+    return len(files), total
+
+
+def make_remote_dirs(c, paths):
+    """Create remote directories, in one round trip per 1000."""
+    for start in range(0, len(paths), 1000):
+        quoted = " ".join(shlex.quote(path) for path in paths[start : start + 1000])
+        c.run(f"mkdir -p {quoted}", hide=True, in_stream=False)
+
+
+def upload_dir(c, local, remote=None, workers=8, hide=False):
+    """Upload a directory tree with concurrent workers, returns the
+    number of files and bytes transferred.
+    """
+    if remote is None:
+        remote = os.path.basename(os.path.normpath(local))
+    c.open()
+    dirs, files = walk_local(local)
+    make_remote_dirs(
+        c, [remote] + [posixpath.join(remote, *path.split(os.sep)) for path in dirs]
+    )
+    files = [(path, size) for path, size, _ in files]
+    return upload_files(c, local, remote, files, workers=workers, hide=hide)
+
+
+def upload_files(c, local, remote, files, workers=8, hide=False, mtimes=None):
+    """Upload (relpath, size) files of a local directory to existing
+    remote directories with concurrent workers. With mtimes, a dict of
+    modification times by relpath, these are set on the uploaded files.
+    Returns the number of files and bytes transferred.
+    """
+    c.open()
+    total = sum(size for _, size in files)
+    progress = None if hide else transfer_progress()
+    with progress or contextlib.nullcontext():
+        if progress is not None:
+            task = progress.add_task(f"Uploading {local} to {c.host}", total=total)
+
+        def move(sftp, unit):
+            # Pipelined writes to all files of the unit, closing the
+            # handles waits for their acks together
+            handles = []
+            try:
+                for relpath, size in unit:
+                    target = posixpath.join(remote, *relpath.split(os.sep))
+                    f = sftp.open(target, "wb")
+                    handles.append(f)
+                    f.set_pipelined(True)
+                    with open(os.path.join(local, relpath), "rb") as source:
+                        for block in iter(lambda: source.read(BLOCK_SIZE), b""):
+                            f.write(block)
+                            if progress is not None:
+                                progress.advance(task, len(block))
+            finally:
+                for f in handles:
+                    f.close()
+            if mtimes is not None:
+                for relpath, _ in unit:
+                    mtime = int(mtimes[relpath])
+                    target = posixpath.join(remote, *relpath.split(os.sep))
+                    sftp.utime(target, (mtime, mtime))
+
+        with recorder.record("put", host=c.host, command=remote) as record:
+            run_units(c, groups(files), workers, move)
+            record["bytes_out"] = total
+    return len(files), total
@@ -0,0 +1,196 @@
+"""Process-wide pool of authenticated SSH transports.
+
+Tasks chained in one invocation, task helpers reaching the same host,
+fsspec filesystems and port forwards all connect with their own
+`SSHClient`. The pool hands every client for the same (user, host, port)
+the same live transport and SFTP session, and keeps the transports alive
+so long-running monitors don't silently lose the link.
+"""
+
+import atexit
+import getpass
+import socket
+import threading
+
+from invoke.util import debug
+
+from xefab import link
+from xefab.instrumentation import recorder
+
+DEFAULT_KEEPALIVE = 30
+
+
+def pool_key(hostname, port=None, username=None):
+    return (username or getpass.getuser(), hostname, int(port or 22))
+
+
+# SFTP requests recorded by the call recorder
+SFTP_OPS = frozenset(
+    (
+        "listdir",
+        "listdir_attr",
+        "listdir_iter",
+        "open",
+        "file",
+        "remove",
+        "unlink",
+        "rename",
+        "posix_rename",
+        "mkdir",
+        "rmdir",
+        "stat",
+        "lstat",
+        "symlink",
+        "chmod",
+        "chown",
+        "utime",
+        "truncate",
+        "readlink",
+        "normalize",
+    )
+)
+
+
+class RecordedSFTPClient(link.TunedSFTPClient):
+    """SFTP session tuned for the host's link, with its requests
+    recorded by the call recorder.
+    """
+
+    def __init__(self, sftp, settings=None, host=None):
+        super().__init__(sftp, settings)
+        self.host = host
+
+    def __getattr__(self, name):
+        attr = super().__getattr__(name)
+        if name not in SFTP_OPS:
+            return attr
+
+        def call(*args, **kwargs):
+            path = args[0] if args else kwargs.get("path", ".")
+            with recorder.record(f"sftp.{name}", host=self.host, command=path):
+                return attr(*args, **kwargs)
+
+        return call
+
+    def getfo(self, remotepath, fl, *args, **kwargs):
+        with recorder.record(
+            "sftp.getfo", host=self.host, command=remotepath
+        ) as record:
+            size = super().getfo(remotepath, fl, *args, **kwargs)
+            record["bytes_in"] = size
+            return size
+
+    def putfo(self, fl, remotepath, file_size=0, *args, **kwargs):
+        with recorder.record(
+            "sftp.putfo", host=self.host, command=remotepath
+        ) as record:
+            attrs = super().putfo(fl, remotepath, file_size, *args, **kwargs)
+            record["bytes_out"] = attrs.st_size or file_size
+            return attrs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._sftp.close()
+
+    def is_active(self):
+        channel = self._sftp.get_channel()
+        if isinstance(channel, socket.socket):
+            # Relayed through the broker socket
+            return channel.fileno() != -1
+        return not channel.closed
+
+
+class SharedSFTPClient(RecordedSFTPClient):
+    """SFTP session shared through the pool, tuned for the host's link.
+    Closing it is a no-op, the session is closed with the pool.
+    """
+
+    def close(self):
+        pass
+
+
+def open_sftp(transport, host):
+    """A new SFTP session of its own over a transport, tuned for the
+    host's link and recorded like the pooled ones.
+    """
+    return RecordedSFTPClient(
+        transport.open_sftp_client(), link.settings_for(host), host=host
+    )
+
+
+class ConnectionPool:
+    """Authenticated transports and SFTP sessions by (user, host, port)."""
+
+    def __init__(self, keepalive=DEFAULT_KEEPALIVE, enabled=True):
+        self.keepalive = keepalive
+        self.enabled = enabled
+        self._transports = {}
+        self._sftp = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def configure(self, keepalive=None, enabled=None):
+        if keepalive is not None:
+            self.keepalive = keepalive
+        if enabled is not None:
+            self.enabled = enabled
+        for transport in self._transports.values():
+            transport.set_keepalive(self.keepalive)
+
+    def lock(self, key):
+        """Lock serializing the connection to a key."""
+        with self._lock:
+            return self._locks.setdefault(key, threading.RLock())
+
+    def get(self, key):
+        """The live transport for key, None if there is none."""
+        transport = self._transports.get(key, None)
+        if transport is None:
+            return None
+        if not transport.is_active():
+            debug(f"xefab: dropping dead pooled transport {key}")
+            self.discard(key)
+            return None
+        return transport
+
+    def add(self, key, transport):
+        transport.set_keepalive(self.keepalive)
+        self._transports[key] = transport
+
+    def sftp(self, key):
+        """The shared SFTP session of the transport for key."""
+        with self.lock(key):
+            sftp = self._sftp.get(key, None)
+            if sftp is not None and sftp.is_active():
+                return sftp
+            transport = self.get(key)
+            if transport is None:
+                raise KeyError(key)
+            sftp = SharedSFTPClient(
+                transport.open_sftp_client(), link.settings_for(key[1]), host=key[1]
+            )
+            self._sftp[key] = sftp
+            return sftp
+
+    def discard(self, key):
+        """Close and forget the transport and SFTP session for key."""
+        sftp = self._sftp.pop(key, None)
+        if sftp is not None:
+            sftp._sftp.close()
+        transport = self._transports.pop(key, None)
+        if transport is not None:
+            transport.close()
+
+    def close(self):
+        for key in list(self._transports):
+            self.discard(key)
+
+
+pool = ConnectionPool()
+
+atexit.register(pool.close)
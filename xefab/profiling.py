@@ -0,0 +1,90 @@
+"""Wall-clock timings of startup and execution phases, see `xefab --profile`."""
+
+import contextlib
+import json
+import threading
+import time
+
+
+class Profiler:
+    """Records the wall-clock duration of named phases.
+    Recording is always on since most phases happen before the
+    command line is parsed, it only costs a couple of clock reads.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.records = []
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def phase(self, name, **details):
+        """Time the enclosed block as a phase called name."""
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        start = time.perf_counter()
+        exception = None
+        try:
+            yield
+        except BaseException as e:
+            exception = e
+            raise
+        finally:
+            end = time.perf_counter()
+            self._local.depth = depth
+            record = {
+                "name": name,
+                "start": start - self.started,
+                "duration": end - start,
+                "depth": depth,
+                "thread": threading.current_thread().name,
+            }
+            if exception is not None:
+                record["exception"] = type(exception).__name__
+            if details:
+                record["details"] = details
+            self.records.append(record)
+
+    def mark(self, name):
+        """Record a phase lasting from the profiler start until now."""
+        self.records.append(
+            {
+                "name": name,
+                "start": 0.0,
+                "duration": time.perf_counter() - self.started,
+                "depth": 0,
+                "thread": threading.current_thread().name,
+            }
+        )
+
+    def summary(self):
+        """Records ordered by start time, plus the total elapsed time."""
+        return {
+            "total": time.perf_counter() - self.started,
+            "phases": sorted(self.records, key=lambda x: x["start"]),
+        }
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=4)
+
+    def table(self):
+        from rich.table import Table
+
+        summary = self.summary()
+        table = Table(title="xefab profile", header_style="bold magenta")
+        table.add_column("Phase")
+        table.add_column("Start [s]", justify="right")
+        table.add_column("Duration [s]", justify="right")
+        for record in summary["phases"]:
+            name = "  " * record["depth"] + record["name"]
+            if record.get("exception"):
+                name += f" ({record['exception']})"
+            table.add_row(
+                name, f"{record['start']:.3f}", f"{record['duration']:.3f}"
+            )
+        table.add_row("total", "", f"{summary['total']:.3f}", style="bold")
+        return table
+
+
+profiler = Profiler()
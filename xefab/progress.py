@@ -0,0 +1,80 @@
+import contextlib
+from typing import Iterable, Tuple
+
+from rich.console import RenderableType
+from rich.progress import (Progress, ProgressColumn, SpinnerColumn, Task,
+                           TextColumn)
+
+from xefab.profiling import profiler
+
+
+class SuccessSpinnerColumn(SpinnerColumn):
+    """A spinner column that shows a checkmark when the task
+    is completed successfully or a x if not.
+    """
+
+    def render(self, task: Task) -> RenderableType:
+        if task.finished:
+            if task.fields.get("exception", None) is None:
+                return "[bold green]✓[/bold green]"
+            else:
+                return "[bold red]✗[/bold red]"
+        else:
+            return super().render(task)
+
+
+class ProgressContext(Progress):
+    """A context manager for rich.progress.Progress.
+    Allows entering a task context and task will be completed when exiting
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._live_display = None
+        super().__init__(*args, **kwargs)
+
+    @classmethod
+    def get_default_columns(cls) -> Tuple[ProgressColumn, ...]:
+        return (
+            SuccessSpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            SpinnerColumn(spinner_name="simpleDots", finished_text=""),
+        )
+
+    def get_renderables(self) -> Iterable[RenderableType]:
+        yield from super().get_renderables()
+        if self._live_display is not None:
+            yield self._live_display
+
+    @contextlib.contextmanager
+    def enter_task(
+        self,
+        description,
+        total=1,
+        finished_description=None,
+        exception_description="Task failed to excecute.",
+        warn=False,
+        hide=False,
+    ):
+        """Start and end a task in a progress bar."""
+        task = self.add_task(description, total=total)
+        exception = None
+        try:
+            with profiler.phase(description):
+                yield task
+        except Exception as e:
+            finished_description = exception_description.format(exception=e)
+            exception = e
+            self.update(task_id=task, exception=True)
+        finally:
+            description = finished_description or self.tasks[task].description
+            self.update(task_id=task, completed=total, description=description)
+            if exception is not None and not hide:
+                self.console.print_exception(show_locals=True)
+            if exception is not None and not warn:
+                exit(1)
+
+    def live_display(self, renderable):
+        """Display a renderable in a panel below the progress bar."""
+        with self._lock:
+            self._live_display = renderable
+        self.refresh()
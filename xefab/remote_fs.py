@@ -0,0 +1,56 @@
+"""fsspec filesystem on the SFTP session of a Fabric connection.
+
+fsspec's own sftp filesystem connects with a client of its own, which
+costs a TCP handshake and, on hosts with two-factor authentication,
+another Duo prompt. `ConnectionFileSystem` uses the connection's
+(pooled) SFTP session instead and is cached per connection, so remote
+file access needs no further authentication.
+"""
+
+import weakref
+
+from fsspec.implementations.sftp import SFTPFileSystem
+
+# Filesystems by id of their connection, dropped with the connection.
+# Not a WeakKeyDictionary, equal connections must not share an entry.
+_filesystems = {}
+
+
+class ConnectionFileSystem(SFTPFileSystem):
+    """SFTP filesystem using `Connection.sftp()` of a connection."""
+
+    # Instances are cached per connection by `connection_filesystem`
+    cachable = False
+
+    def __init__(self, c, temppath="/tmp", **kwargs):
+        super(SFTPFileSystem, self).__init__(**kwargs)
+        # Not a strong reference, the cache entry lives as long as the connection
+        self._connection = weakref.ref(c)
+        self.host = c.host
+        self.temppath = temppath
+        self.ssh_kwargs = {}
+
+    @property
+    def c(self):
+        c = self._connection()
+        if c is None:
+            raise RuntimeError(f"The connection to {self.host} was discarded")
+        return c
+
+    @property
+    def client(self):
+        return self.c.client
+
+    @property
+    def ftp(self):
+        # Reopened by the connection if the session was closed
+        return self.c.sftp()
+
+
+def connection_filesystem(c):
+    """The cached filesystem of a connection."""
+    fs = _filesystems.get(id(c), None)
+    if fs is None:
+        fs = _filesystems[id(c)] = ConnectionFileSystem(c)
+        weakref.finalize(c, _filesystems.pop, id(c), None)
+    return fs
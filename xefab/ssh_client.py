@@ -1,9 +1,58 @@
 import paramiko
+from invoke.util import debug
 from paramiko.ssh_exception import SSHException
 
+from xefab import broker, link
+from xefab.pool import pool, pool_key
+from xefab.profiling import profiler
+
 
 class SSHClient(paramiko.SSHClient):
     password = None
+    # Open channels through the xefab broker if it is running
+    use_broker = True
+    # Share transports with other clients in the process, see xefab.pool
+    use_pool = True
+    _pool_key = None
+
+    def connect(self, hostname, *args, **kwargs):
+        with profiler.phase(f"connect {hostname}"):
+            if not (self.use_pool and pool.enabled) or args:
+                return self._connect(hostname, *args, **kwargs)
+
+            key = pool_key(hostname, kwargs.get("port"), kwargs.get("username"))
+            with pool.lock(key):
+                transport = pool.get(key)
+                if transport is None:
+                    self._connect(hostname, **kwargs)
+                    transport = self._transport
+                    pool.add(key, transport)
+                else:
+                    debug(f"xefab: reusing pooled transport for {key}")
+                self._transport = transport
+                self._pool_key = key
+
+    def _connect(self, hostname, *args, **kwargs):
+        if self.use_broker and not args:
+            transport = broker.open_transport(self, hostname, **kwargs)
+            if transport is not None:
+                self._transport = transport
+                return
+        if not args:
+            kwargs = dict(link.connect_kwargs(link.settings_for(hostname)), **kwargs)
+        return super().connect(hostname, *args, **kwargs)
+
+    def open_sftp(self):
+        if self._pool_key is not None:
+            return pool.sftp(self._pool_key)
+        return super().open_sftp()
+
+    def close(self):
+        if self._pool_key is not None:
+            # The transport is shared, it is closed with the pool
+            self._transport = None
+            self._pool_key = None
+        super().close()
 
     def _2fa_handler(self, title, instructions, prompt_list):
         if not prompt_list:
@@ -13,20 +62,7 @@ class SSHClient(paramiko.SSHClient):
         if "Duo two-factor login" in prompt_list[0][0]:
             return ["1"]
 
-    def _auth(
-        self,
-        username,
-        password,
-        pkey,
-        key_filenames,
-        allow_agent,
-        look_for_keys,
-        gss_auth,
-        gss_kex,
-        gss_deleg_creds,
-        gss_host,
-        passphrase,
-    ):
+    def _auth(self, username, password, *args):
         """
         Try, in order:
             - The key(s) passed in, if one was passed in.
@@ -37,8 +73,14 @@ class SSHClient(paramiko.SSHClient):
         (The password might be needed to unlock a private key [if 'passphrase'
         isn't also given], or for two-factor authentication [for which it is
         required].)
+        The remaining arguments differ between paramiko versions
+        and are passed on as is.
         """
 
+        with profiler.phase("auth", username=username):
+            self._auth_2fa(username, password, *args)
+
+    def _auth_2fa(self, username, password, *args):
         self.password = password
         if self.password is not None:
             try:
@@ -47,19 +89,9 @@ class SSHClient(paramiko.SSHClient):
             except SSHException as e:
                 pass
 
-        super()._auth(
-            username=username,
-            password=password,
-            pkey=pkey,
-            key_filenames=key_filenames,
-            allow_agent=allow_agent,
-            look_for_keys=look_for_keys,
-            gss_auth=gss_auth,
-            gss_kex=gss_kex,
-            gss_deleg_creds=gss_deleg_creds,
-            gss_host=gss_host,
-            passphrase=passphrase,
-        )
+        super()._auth(username, password, *args)
 
 
 paramiko.client.SSHClient = SSHClient
+# fsspec's sftp filesystem uses paramiko.SSHClient
+paramiko.SSHClient = SSHClient
@@ -0,0 +1,217 @@
+"""One-way sync of a local directory to a remote one without rsync.
+
+Follows the semantics of `xefab.tasks.transfer.rsync`: a source with a
+trailing slash syncs its contents into the target, one without creates
+a directory named after it inside the target.
+
+The remote manifest (path, size and mtime of every file, plus a fast
+hash with `checksum`) is listed by one `find -printf` command, so an
+unchanged tree costs a single round trip however large it is. Files
+are compared by size and mtime, or by size and fast hash with
+`checksum`, and only new or changed ones are uploaded, with their
+mtimes set to the local ones so the next sync finds them unchanged.
+
+The fast hash is the sha256 digest of the first and last HASH_BLOCK
+bytes of a file. Local hashes are kept in a manifest in the xefab
+cache directory and only recomputed for files whose size or mtime
+changed since.
+
+Exclude globs follow `xefab.tar_transfer.matches`: without a "/" they
+match names, else paths relative to the synced directory. Excluded
+remote files are never deleted. Deletion removes files only, emptied
+remote directories are kept.
+"""
+
+import hashlib
+import json
+import os
+import posixpath
+import shlex
+
+from xefab import parallel_transfer
+from xefab.cache import cache_path, makedirs_private, open_private
+from xefab.tar_transfer import matches, walk_selected
+
+HASH_BLOCK = 2**16
+
+MANIFEST_DIR = "sync"
+
+# Paths per mkdir or rm command
+BATCH_SIZE = 1000
+
+
+def remote_root(source, target):
+    """The remote directory a local source is synced to."""
+    if source.endswith("/"):
+        return target
+    return posixpath.join(target, os.path.basename(os.path.normpath(source)))
+
+
+def excluded(relpath, patterns):
+    """Whether a relative path or one of its parent directories is excluded."""
+    parts = relpath.split("/")
+    return any(
+        matches("/".join(parts[: i + 1]), patterns) for i in range(len(parts))
+    )
+
+
+def fast_hash(path, size):
+    """The sha256 digest of the first and last HASH_BLOCK bytes of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        digest.update(f.read(HASH_BLOCK))
+        f.seek(max(0, size - HASH_BLOCK))
+        digest.update(f.read(HASH_BLOCK))
+    return digest.hexdigest()
+
+
+def manifest_command(root, checksum=False):
+    """Shell listing the files below root as NUL terminated records,
+    "F<path>\\t<size>\\t<mtime>" and with checksum "H<hash>\\t<path>".
+    A missing root lists nothing.
+    """
+    script = (
+        f"cd {shlex.quote(root)} 2>/dev/null || exit 0; "
+        "find . -type f -printf 'F%P\\t%s\\t%T@\\0'"
+    )
+    if checksum:
+        block = HASH_BLOCK
+        loop = (
+            "for f; do "
+            f'h=$({{ head -c {block} "$f"; tail -c {block} "$f"; }} | $S); '
+            'printf "H%s\\t%s\\0" "${h%% *}" "${f#./}"; done'
+        )
+        script += (
+            " && S=sha256sum; command -v sha256sum >/dev/null"
+            " || S='shasum -a 256'; export S; "
+            f"find . -type f -exec sh -c {shlex.quote(loop)} sh {{}} +"
+        )
+    return script
+
+
+def remote_manifest(c, root, checksum=False):
+    """{relpath: [size, mtime, hash]} of the files below a remote directory,
+    listed in one round trip.
+    """
+    result = c.run(manifest_command(root, checksum), hide=True, in_stream=False)
+    manifest = {}
+    hashes = {}
+    for record in result.stdout.split("\0"):
+        if record.startswith("F"):
+            path, size, mtime = record[1:].rsplit("\t", 2)
+            manifest[path] = [int(size), int(float(mtime)), None]
+        elif record.startswith("H"):
+            digest, path = record[1:].split("\t", 1)
+            hashes[path] = digest
+    for path, digest in hashes.items():
+        if path in manifest:
+            manifest[path][2] = digest
+    return manifest
+
+
+class LocalManifest:
+    """{relpath: [size, mtime, hash]} of the files below a local
+    directory, cached so hashes are only computed for changed files.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        key = hashlib.sha1(self.root.encode()).hexdigest()
+        self.path = cache_path(os.path.join(MANIFEST_DIR, f"{key}.json"))
+        try:
+            with open(self.path) as f:
+                self.cached = json.load(f)
+        except (OSError, ValueError):
+            self.cached = {}
+        self.files = {}
+
+    def scan(self, exclude=(), checksum=False):
+        for relpath in walk_selected(self.root, exclude=exclude):
+            path = os.path.join(self.root, *relpath.split("/"))
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # e.g. a dangling symlink
+                continue
+            entry = [stat.st_size, int(stat.st_mtime), None]
+            cached = self.cached.get(relpath)
+            if cached is not None and cached[:2] == entry[:2]:
+                entry[2] = cached[2]
+            if checksum and entry[2] is None:
+                entry[2] = fast_hash(path, stat.st_size)
+            self.files[relpath] = entry
+        return self.files
+
+    def save(self):
+        makedirs_private(os.path.dirname(self.path))
+        tmp = f"{self.path}.tmp"
+        with open_private(tmp) as f:
+            json.dump(self.files, f)
+        os.replace(tmp, self.path)
+
+
+def changed(local, remote, checksum=False):
+    """Whether a local manifest entry differs from the remote one."""
+    if remote is None or local[0] != remote[0]:
+        return True
+    if checksum:
+        return local[2] != remote[2]
+    return local[1] != remote[1]
+
+
+def sync(
+    c,
+    source,
+    target,
+    exclude=(),
+    delete=False,
+    checksum=False,
+    workers=8,
+    dry_run=False,
+    hide=False,
+):
+    """Sync a local directory to a remote one, returns the uploaded and
+    deleted relative paths and the number of unchanged files.
+    """
+    if not os.path.isdir(source):
+        raise NotADirectoryError(f"{source} is not a local directory")
+    root = remote_root(source, target)
+    local_manifest = LocalManifest(source)
+    local = local_manifest.scan(exclude, checksum)
+    remote = {
+        path: entry
+        for path, entry in remote_manifest(c, root, checksum).items()
+        if not excluded(path, exclude)
+    }
+
+    uploads = sorted(
+        path for path, entry in local.items() if changed(entry, remote.get(path), checksum)
+    )
+    deletes = sorted(set(remote) - set(local)) if delete else []
+    report = {
+        "uploaded": uploads,
+        "deleted": deletes,
+        "unchanged": len(local) - len(uploads),
+    }
+    if dry_run:
+        return report
+
+    if uploads:
+        parents = {posixpath.dirname(path) for path in uploads}
+        parallel_transfer.make_remote_dirs(
+            c, sorted(posixpath.join(root, parent) for parent in parents)
+        )
+        parallel_transfer.upload_files(
+            c,
+            os.path.abspath(source),
+            root,
+            [(path.replace("/", os.sep), local[path][0]) for path in uploads],
+            workers=workers,
+            hide=hide,
+            mtimes={path.replace("/", os.sep): local[path][1] for path in uploads},
+        )
+    for start in range(0, len(deletes), BATCH_SIZE):
+        quoted = " ".join(shlex.quote(path) for path in deletes[start : start + BATCH_SIZE])
+        c.run(f"cd {shlex.quote(root)} && rm -f -- {quoted}", hide=True, in_stream=False)
+    local_manifest.save()
+    return report
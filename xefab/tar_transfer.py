@@ -0,0 +1,331 @@
+"""Directory transfers as one compressed tar stream.
+
+Moving thousands of small files over SFTP costs round trips per file.
+Instead, the remote side runs `tar | zstd` (or `zstd -d | tar` for
+uploads) over a single exec channel and the stream is packed or
+unpacked locally as it flows. The remote side picks zstd if it is
+installed there and the local side can handle it, gzip otherwise, and
+announces its choice with the first byte on stdout.
+
+Locally zstd is handled by the `zstandard` package if installed, else
+by a local `zstd` binary.
+
+Include and exclude globs without a "/" match file names, others
+match paths relative to the transferred directory. Excluded
+directories are skipped as a whole. Directories are transferred
+too, including empty ones, include globs only select files.
+
+Downloaded archives are unpacked with tarfile's "data" filter, or
+equivalent checks on Python versions without it. Members it rejects,
+e.g. links pointing outside the directory, are skipped and reported.
+"""
+
+import fnmatch
+import os
+import posixpath
+import shlex
+import shutil
+import subprocess
+import tarfile
+import threading
+
+from xefab.instrumentation import recorder
+
+BLOCK_SIZE = 2**20
+
+ZSTD, GZIP = b"Z", b"G"
+
+# Extraction filters were added in Python 3.12 and backported to
+# patch releases of 3.8 to 3.11
+DATA_FILTER = hasattr(tarfile, "data_filter")
+
+
+class UnsafeMemberError(tarfile.TarError):
+    """An archive member would be unpacked outside the target directory."""
+
+
+def local_zstd():
+    """How zstd streams are handled locally: "module", "binary" or None."""
+    try:
+        import zstandard  # noqa: F401
+
+        return "module"
+    except ImportError:
+        pass
+    if shutil.which("zstd"):
+        return "binary"
+    return None
+
+
+def matches(relpath, patterns):
+    """Whether a relative path matches any of the globs."""
+    name = posixpath.basename(relpath)
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(relpath if "/" in pattern else name, pattern):
+            return True
+    return False
+
+
+def find_command(include=(), exclude=()):
+    """A find command listing the selected files (NUL separated)."""
+
+    def tests(patterns):
+        quoted = [
+            f"-path {shlex.quote('./' + p)}" if "/" in p else f"-name {shlex.quote(p)}"
+            for p in patterns
+        ]
+        return "\\( " + " -o ".join(quoted) + " \\)"
+
+    parts = ["find . -mindepth 1"]
+    if exclude:
+        parts.append(f"{tests(exclude)} -prune -o")
+    parts.append("\\( -type d -print0 -o \\( -type f -o -type l \\)")
+    if include:
+        parts.append(tests(include))
+    parts.append("-print0 \\)")
+    return " ".join(parts)
+
+
+def codec_script(zstd_allowed, zstd_command, gzip_command):
+    """Shell choosing zstd if allowed and installed, announcing the choice."""
+    condition = "command -v zstd >/dev/null 2>&1"
+    if not zstd_allowed:
+        condition = "false"
+    return (
+        f"if {condition}; then printf {ZSTD.decode()}; {zstd_command}; "
+        f"else printf {GZIP.decode()}; {gzip_command}; fi"
+    )
+
+
+def copy(source, target, close=True):
+    """Copy a stream in blocks, closing the target at EOF."""
+    try:
+        for block in iter(lambda: source.read(BLOCK_SIZE), b""):
+            target.write(block)
+    finally:
+        if close:
+            target.close()
+
+
+def reader(stream, codec, zstd):
+    """A file object of the decompressed stream and a cleanup."""
+    if codec == GZIP:
+        import gzip
+
+        return gzip.GzipFile(fileobj=stream, mode="rb"), lambda: None
+    if zstd == "module":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().stream_reader(stream), lambda: None
+    process = subprocess.Popen(
+        ["zstd", "-dcq"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    feeder = threading.Thread(target=copy, args=(stream, process.stdin), daemon=True)
+    feeder.start()
+
+    def cleanup():
+        feeder.join()
+        process.stdout.close()
+        if process.wait():
+            raise IOError("Local zstd failed to decompress the stream")
+
+    return process.stdout, cleanup
+
+
+def writer(stream, codec, zstd):
+    """A file object compressing into the stream and a cleanup."""
+    if codec == GZIP:
+        import gzip
+
+        f = gzip.GzipFile(fileobj=stream, mode="wb", compresslevel=1)
+        return f, f.close
+    if zstd == "module":
+        import zstandard
+
+        f = zstandard.ZstdCompressor().stream_writer(stream, closefd=False)
+        return f, f.close
+    process = subprocess.Popen(
+        ["zstd", "-cq"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    drainer = threading.Thread(
+        target=copy, args=(process.stdout, stream, False), daemon=True
+    )
+    drainer.start()
+
+    def cleanup():
+        process.stdin.close()
+        drainer.join()
+        if process.wait():
+            raise IOError("Local zstd failed to compress the stream")
+
+    return process.stdin, cleanup
+
+
+def check_member(member, root):
+    """Raise UnsafeMemberError for members the "data" filter rejects:
+    absolute paths, paths or links leading outside root, special files.
+    """
+    root = os.path.realpath(root)
+
+    def inside(path):
+        path = os.path.realpath(os.path.join(root, path))
+        return os.path.commonpath([root, path]) == root
+
+    if os.path.isabs(member.name) or not inside(member.name):
+        raise UnsafeMemberError(f"{member.name} is outside the target directory")
+    if member.issym():
+        target = os.path.join(os.path.dirname(member.name), member.linkname)
+        if os.path.isabs(member.linkname) or not inside(target):
+            raise UnsafeMemberError(
+                f"{member.name} links to {member.linkname}, outside the target"
+            )
+    elif member.islnk():
+        if os.path.isabs(member.linkname) or not inside(member.linkname):
+            raise UnsafeMemberError(
+                f"{member.name} links to {member.linkname}, outside the target"
+            )
+    elif not (member.isfile() or member.isdir()):
+        raise UnsafeMemberError(f"{member.name} is a special file")
+
+
+def extract(archive, member, root):
+    """Unpack a member with the "data" filter, or equivalent checks."""
+    if DATA_FILTER:
+        archive.extract(member, root, filter="data")
+        return
+    check_member(member, root)
+    # As the data filter: no setuid, setgid, sticky or group/other write bits
+    if member.mode is not None:
+        member.mode &= 0o755
+        if member.isfile():
+            member.mode |= 0o600
+    member.uid = member.gid = None
+    member.uname = member.gname = None
+    archive.extract(member, root)
+
+
+def rejected_errors():
+    if DATA_FILTER:
+        return (UnsafeMemberError, tarfile.FilterError)
+    return (UnsafeMemberError,)
+
+
+def exec_channel(c, command):
+    c.open()
+    channel = c.transport.open_session()
+    channel.exec_command(command)
+    return channel
+
+
+def check_exit(channel, what):
+    status = channel.recv_exit_status()
+    if status:
+        stderr = channel.makefile_stderr("rb").read().decode(errors="replace")
+        raise IOError(f"Remote tar failed to {what} (exit {status}): {stderr.strip()}")
+
+
+def download_dir(c, remote, local=None, include=(), exclude=()):
+    """Download a directory as one tar stream, returns the number of
+    files and bytes unpacked and the (name, reason) of skipped members.
+    """
+    if local is None:
+        local = posixpath.basename(remote.rstrip("/"))
+    os.makedirs(local, exist_ok=True)
+    zstd = local_zstd()
+    tar = f"{find_command(include, exclude)} | tar --null --no-recursion -T - -cf -"
+    command = f"cd {shlex.quote(remote)} && " + codec_script(
+        zstd is not None, f"{tar} | zstd -cq", f"{tar} | gzip -c1"
+    )
+
+    n_files = n_bytes = 0
+    skipped = []
+    with recorder.record("get", host=c.host, command=command) as record:
+        channel = exec_channel(c, command)
+        try:
+            stream = channel.makefile("rb")
+            codec = stream.read(1)
+            if codec not in (ZSTD, GZIP):
+                check_exit(channel, "pack")
+                raise IOError(f"Unexpected reply from remote tar: {codec!r}")
+            f, cleanup = reader(stream, codec, zstd)
+            with tarfile.open(fileobj=f, mode="r|") as archive:
+                for member in archive:
+                    try:
+                        extract(archive, member, local)
+                    except rejected_errors() as e:
+                        skipped.append((posixpath.normpath(member.name), str(e)))
+                        continue
+                    if member.isfile():
+                        n_files += 1
+                        n_bytes += member.size
+            cleanup()
+            check_exit(channel, "pack")
+        finally:
+            channel.close()
+        record["bytes_in"] = n_bytes
+        record["codec"] = codec.decode()
+        record["skipped"] = len(skipped)
+    return n_files, n_bytes, skipped
+
+
+def walk_selected(root, include=(), exclude=(), dirs=False):
+    """Relative paths of the selected local files, excluded directories
+    pruned. With dirs, directories are listed too, ahead of their contents.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        relpath = os.path.relpath(dirpath, root)
+        relpath = "" if relpath == "." else relpath.replace(os.sep, "/")
+        if dirs and relpath:
+            yield relpath
+        dirnames[:] = [
+            name
+            for name in sorted(dirnames)
+            if not matches(posixpath.join(relpath, name), exclude)
+        ]
+        for name in sorted(filenames):
+            path = posixpath.join(relpath, name)
+            if matches(path, exclude) or (include and not matches(path, include)):
+                continue
+            yield path
+
+
+def upload_dir(c, local, remote=None, include=(), exclude=()):
+    """Upload a directory as one tar stream, returns the number of
+    files and bytes packed.
+    """
+    if remote is None:
+        remote = os.path.basename(os.path.normpath(local))
+    zstd = local_zstd()
+    command = f"mkdir -p {shlex.quote(remote)} && cd {shlex.quote(remote)} && " + (
+        codec_script(zstd is not None, "zstd -dcq | tar -xf -", "gzip -dc | tar -xf -")
+    )
+
+    n_files = n_bytes = 0
+    with recorder.record("put", host=c.host, command=command) as record:
+        channel = exec_channel(c, command)
+        try:
+            codec = channel.makefile("rb").read(1)
+            if codec not in (ZSTD, GZIP):
+                check_exit(channel, "unpack")
+                raise IOError(f"Unexpected reply from remote tar: {codec!r}")
+            stream = channel.makefile("wb")
+            f, cleanup = writer(stream, codec, zstd)
+            with tarfile.open(fileobj=f, mode="w|") as archive:
+                for path in walk_selected(local, include, exclude, dirs=True):
+                    member = archive.gettarinfo(os.path.join(local, path), arcname=path)
+                    if member.isfile():
+                        with open(os.path.join(local, path), "rb") as source:
+                            archive.addfile(member, source)
+                        n_files += 1
+                        n_bytes += member.size
+                    else:
+                        archive.addfile(member)
+            cleanup()
+            stream.flush()
+            channel.shutdown_write()
+            check_exit(channel, "unpack")
+        finally:
+            channel.close()
+        record["bytes_out"] = n_bytes
+        record["codec"] = codec.decode()
+    return n_files, n_bytes
@@ -1,4 +1,3 @@
-import pandas as pd
 from fabric.tasks import task
 
 from xefab.utils import console
@@ -27,6 +26,8 @@ def add_recipient(
 @task
 def user_db(c, limit: int = None, hide: bool = False):
     """Get all users from the user database."""
+    import pandas as pd
+
     users = c.config.xent_collection(collection="users").find({}, projection={"_id": 0})
     if limit is not None:
         users = users.limit(int(limit))
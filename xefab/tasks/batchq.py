@@ -1,3 +1,4 @@
+import asyncio
 import json
 import time
 import uuid
@@ -8,9 +9,11 @@ from fabric.connection import Connection
 from fabric.tasks import task
 from rich.panel import Panel
 
-from xefab.tasks.shell import exists, is_file
+from xefab.batch import RemoteBatch
+from xefab.tasks.shell import is_file
 from xefab.tasks.squeue import parse_squeue_output
-from xefab.utils import ProgressContext, console, tail
+from xefab.progress import ProgressContext
+from xefab.utils import console, tail
 
 SLURM_INSTRUCTIONS = {
     "partition": "partition to submit the job to.",
@@ -201,11 +204,20 @@ def sbatch(
         extra_instructions = json.loads(extra_instructions)
 
     with ProgressContext() as progress:
+        local_script = is_file(c, script, hide=True, local=True)
+
+        with progress.enter_task("Checking for $SCRATCH folder and script"):
+            with RemoteBatch(c) as batch:
+                if workdir is None:
+                    scratch = batch.run("echo $SCRATCH", hide=True, warn=True)
+                if not local_script:
+                    remote_script = batch.run(
+                        f"test -f {script}", hide=True, warn=True
+                    )
+
         if workdir is None:
-            with progress.enter_task("Checking for $SCRATCH folder") as task:
-                result = c.run("echo $SCRATCH", hide=True, warn=True)
-            if result.ok and result.stdout:
-                SCRATCH = result.stdout.strip()
+            if scratch.ok and scratch.stdout:
+                SCRATCH = scratch.stdout.strip()
             else:
                 SCRATCH = f"/scratch/midway2/{c.user}"
 
@@ -225,31 +237,20 @@ def sbatch(
 
         sbatch_path = f"{workdir}/{job_name}.sbatch"
 
-        with progress.enter_task(
-            "Testing remote connection and workdir existince"
-        ) as task:
-            if not exists(c, workdir, hide=True):
-                progress.update(
-                    task, description=f"Creating workdir {workdir} on {c.host}"
-                )
-                c.run(f"mkdir -p {workdir}", hide=True)
+        with progress.enter_task(f"Preparing workdir {workdir} on {c.host}"):
+            with RemoteBatch(c) as batch:
+                batch.run(f"mkdir -p {workdir}", hide=True)
+                if not local_script and remote_script:
+                    batch.run(f"cp {script} {remote_script_path}", hide=True)
 
-        if is_file(c, script, hide=True, local=True):
+        if local_script:
             with progress.enter_task(f"Copying script to {c.original_host}"):
                 c.put(script, remote=remote_script_path)
-
-        elif is_file(c, script, hide=True):
-            with progress.enter_task(f"Copying script to working directory"):
-                c.run(f"cp {script} {remote_script_path}", hide=True)
-        else:
+        elif not remote_script:
             script_fd = StringIO("#!/bin/bash\n" + script)
             with progress.enter_task(f"Creating script at on {c.original_host}"):
                 c.put(script_fd, remote=remote_script_path)
 
-        if remote_script_path.endswith("sh"):
-            with progress.enter_task(f"Making script executable"):
-                c.run(f"chmod +x {remote_script_path}", hide=True)
-
         with progress.enter_task(f"Creating sbatch file"):
             slurm_instructions = generate_slurm_instructions(
                 job_name=job_name,
@@ -290,11 +291,12 @@ def sbatch(
             sbatch_fd = StringIO(sbatch_content)
             c.put(sbatch_fd, remote=sbatch_path)
 
-        with progress.enter_task(f"Making sbatch file executable"):
-            c.run(f"chmod +x {sbatch_path}", hide=True)
-
         with progress.enter_task(f"Submitting job to SLURM queue") as task:
-            result = c.run(f"sbatch {sbatch_path}", hide=True, warn=True)
+            with RemoteBatch(c) as batch:
+                if remote_script_path.endswith("sh"):
+                    batch.run(f"chmod +x {remote_script_path}", hide=True)
+                batch.run(f"chmod +x {sbatch_path}", hide=True)
+                result = batch.run(f"sbatch {sbatch_path}", hide=True, warn=True)
             if result.ok and result.stdout:
                 job_id = int(result.stdout.split()[-1])
                 progress.update(
@@ -319,10 +321,11 @@ def sbatch(
         with progress.enter_task(f"Waiting for job to finish") as task:
             for _ in range(hours * 3600 // 2):
                 time.sleep(2)
-                if not is_file(c, output, hide=True):
-                    continue
                 result = c.run(f"tail -n 5 {output}", hide=True, warn=True)
-                if result.ok and result.stdout:
+                if result.failed:
+                    # No output file yet
+                    continue
+                if result.stdout:
                     progress.live_display(Panel.fit(result.stdout, title="Output file"))
                 if done_message in result.stdout:
                     progress.update(task, description=f"Output file ready")
@@ -330,11 +333,34 @@ def sbatch(
                     break
 
         with progress.enter_task(f"Getting output files") as task:
-            result = c.run(f"cat {output}", hide=True, warn=True)
-            if result.ok and result.stdout:
-                out = tail(result.stdout, 50)
+            with RemoteBatch(c) as batch:
+                out_result = batch.run(f"cat {output}", hide=True, warn=True)
+                err_result = batch.run(f"cat {error}", hide=True, warn=True)
+            if out_result.ok and out_result.stdout:
+                out = tail(out_result.stdout, 50)
                 progress.console.print(Panel(out, title="Output file"))
-            result = c.run(f"cat {error}", hide=True, warn=True)
-            if result.ok and result.stdout:
-                err = tail(result.stdout, 50)
+            if err_result.ok and err_result.stdout:
+                err = tail(err_result.stdout, 50)
                 progress.console.print(Panel(err, title="Error file"))
+
+
+async def wait_for_log(
+    c,
+    path: str,
+    text: str,
+    lines: int = 5,
+    timeout: float = None,
+    interval: float = 2.0,
+) -> str:
+    """Poll the end of a (log) file with an async connection until it
+    contains text, returns the last lines of the file.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while True:
+        result = await c.run(f"tail -n {lines} {path}", hide=True, warn=True)
+        if result.ok and text in result.stdout:
+            return result.stdout
+        if deadline is not None and loop.time() > deadline:
+            raise RuntimeError(f"Timeout reached while waiting for {path}.")
+        await asyncio.sleep(interval)
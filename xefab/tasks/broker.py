@@ -0,0 +1,87 @@
+import os
+import subprocess
+import sys
+import time
+
+from fabric.tasks import task
+
+from xefab import broker
+from xefab.cache import cache_path, makedirs_private, open_private
+from xefab.collection import XefabCollection
+from xefab.utils import console
+
+namespace = XefabCollection("broker")
+
+
+@task
+def start(c, ttl: float = None, keepalive: int = None, wait: float = 5):
+    """Start the connection broker, keeping authenticated SSH transports open."""
+
+    status = broker.ping()
+    if status is not None:
+        console.print(f"Broker already running (pid {status['pid']}).")
+        return
+
+    if ttl is None:
+        ttl = c.config.broker.ttl
+    if keepalive is None:
+        keepalive = c.config.broker.keepalive
+
+    log_path = cache_path("broker.log")
+    makedirs_private(os.path.dirname(log_path))
+    cmd = [
+        sys.executable,
+        "-m",
+        "xefab.broker",
+        "--ttl",
+        str(ttl),
+        "--keepalive",
+        str(keepalive),
+    ]
+    with open_private(log_path, "ab") as log:
+        subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            start_new_session=True,
+        )
+
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        status = broker.ping()
+        if status is not None:
+            console.print(f"Broker started (pid {status['pid']}).")
+            return
+        time.sleep(0.1)
+    raise RuntimeError(f"Broker did not start, see {log_path}")
+
+
+@task
+def stop(c):
+    """Stop the connection broker, closing all its transports."""
+
+    if broker.shutdown():
+        console.print("Broker stopped.")
+    else:
+        console.print("Broker is not running.")
+
+
+@task(default=True)
+def status(c):
+    """Show the hosts the connection broker holds transports for."""
+
+    status = broker.ping()
+    if status is None:
+        console.print("Broker is not running.")
+        return
+    console.print(f"Broker running (pid {status['pid']}) at {broker.socket_path()}")
+    for key, info in sorted(status["hosts"].items()):
+        console.print(
+            f"  {key}: {info['channels']} open channels, idle {info['idle']:.0f}s"
+        )
+
+
+namespace.add_task(start)
+namespace.add_task(stop)
+namespace.add_task(status)
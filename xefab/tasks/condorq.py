@@ -1,6 +1,5 @@
 import datetime
 
-import pandas as pd
 from fabric.tasks import task
 
 from xefab.utils import console, df_to_table
@@ -37,10 +36,14 @@ slots = {
 }
 
 
+def parse_submitted(x):
+    import pandas as pd
+
+    return pd.to_datetime(f"{datetime.datetime.utcnow().year}/{x[0]}T{x[1]}")
+
+
 mergers = {
-    "SUBMITTED": lambda x: pd.to_datetime(
-        f"{datetime.datetime.utcnow().year}/{x[0]}T{x[1]}"
-    ),
+    "SUBMITTED": parse_submitted,
     "JOB_IDS": lambda x: "".join(x),
 }
 
@@ -57,6 +60,8 @@ def parse_row(line, columns):
 
 
 def parse_condorq_output(condorq_output):
+    import pandas as pd
+
     lines = condorq_output.split("\n")
     rows = []
     columns = []
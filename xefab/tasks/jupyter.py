@@ -10,7 +10,8 @@ from rich.progress import SpinnerColumn, TextColumn
 from rich.prompt import IntPrompt
 from xefab.tasks.shell import is_file
 
-from xefab.utils import ProgressContext, console, get_open_port
+from xefab.progress import ProgressContext
+from xefab.utils import console, get_open_port
 
 from .squeue import parse_squeue_output, squeue
 from .utils import print_splash
@@ -1,16 +1,15 @@
+import inspect
 import sys
 
 from decopatch import DECORATED, decorator
 from fabric.connection import Connection
 from fabric.tasks import task as fabric_task
 from invoke.context import DataProxy
-from pydantic import BaseModel
 
 from xefab.collection import XefabCollection
 from xefab.utils import console
 
-from ..pydantic_support import task_from_model
-from . import admin, github, install, secrets, shell
+from . import admin, broker, github, install, secrets, shell
 
 namespace = XefabCollection("root")
 
@@ -19,12 +18,23 @@ namespace = XefabCollection("root")
 def task(*args, f=DECORATED, **kwargs):
     """
     If used to decorate a pydantic Model, then create a task from the model.
+    If used to decorate a coroutine function, the task runs it in an event
+    loop with an async connection, see `xefab.aio`.
     If not, then just apply the fabric task decorator.
     """
+    # Models can only exist if pydantic was already imported by their module
+    pydantic = sys.modules.get("pydantic", None)
+    BaseModel = getattr(pydantic, "BaseModel", ())
     if (isinstance(f, type) and issubclass(f, BaseModel)) or isinstance(f, BaseModel):
+        from ..pydantic_support import task_from_model
+
         task = task_from_model(f, *args, **kwargs)
         namespace.add_task(task)
         return f
+    if inspect.iscoroutinefunction(f):
+        from xefab.aio import async_task_body
+
+        f = async_task_body(f)
     return fabric_task(f, *args, **kwargs)
 
 
@@ -70,5 +80,8 @@ namespace.add_collection(github)
 sh = XefabCollection.from_module(shell, name="sh")
 namespace.add_collection(sh)
 
+broker = XefabCollection.from_module(broker, name="broker")
+namespace.add_collection(broker)
+
 
 namespace.add_task(show_context)
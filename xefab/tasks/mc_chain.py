@@ -10,7 +10,8 @@ from rich.panel import Panel
 from rich.text import Text
 from rich.prompt import Confirm
 
-from xefab.utils import ProgressContext, console
+from xefab.progress import ProgressContext
+from xefab.utils import console
 
 from .github import clone
 from .shell import exists
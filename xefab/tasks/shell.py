@@ -10,6 +10,24 @@ SHELL_PROFILE_FILES = {
 }
 
 
+def source_profiles(
+    c, cmd: str, shell: str, user_profile: bool = True, system_profile: bool = True
+):
+    """Prefix a command with sourcing the login profiles of a shell.
+    Missing profiles are skipped by the shell running the command,
+    instead of checking each one with its own `test -f` first.
+    """
+    profiles = []
+    if system_profile:
+        profiles.append("/etc/profile")
+    if user_profile:
+        for f in SHELL_PROFILE_FILES.get(shell):
+            profiles.append(f.replace("~/", f"/home/{c.user}/"))
+    for fpath in profiles:
+        cmd = f"{{ test ! -f {fpath} || . {fpath}; }} && {cmd}"
+    return cmd
+
+
 @task(default=True)
 def shell(c: Connection, shell: str = None):
     """Open interactive shell on remote host."""
@@ -89,15 +107,13 @@ def which(
     if shell is None:
         shell = "bash"
 
-    cmd = f"which {command}"
-
-    if not no_system_profile and is_file(c, f"/etc/profile", local=local, hide=True):
-        cmd = f"source /etc/profile && {cmd}"
-    if not no_user_profile:
-        for f in SHELL_PROFILE_FILES.get(shell):
-            fpath = f.replace("~/", f"/home/{c.user}/")
-            if is_file(c, fpath, local=local, hide=True):
-                cmd = f"source {fpath} && {cmd}"
+    cmd = source_profiles(
+        c,
+        f"which {command}",
+        shell,
+        user_profile=not no_user_profile,
+        system_profile=not no_system_profile,
+    )
 
     if local and isinstance(c, Connection):
         result = c.local(cmd, hide=True, warn=True, shell=f"/bin/{shell}")
@@ -141,12 +157,7 @@ def path(
         result = c.local(cmd, hide=True, warn=True, shell=f"/bin/{shell}")
     else:
         if profile:
-            if is_file(c, f"/etc/profile", hide=True):
-                cmd = f"source /etc/profile && {cmd}"
-            for f in SHELL_PROFILE_FILES.get(shell):
-                if is_file(c, f, hide=True):
-                    fpath = f.replace("~/", f"/home/{c.user}/")
-                    cmd = f"source {fpath} && {cmd}"
+            cmd = source_profiles(c, cmd, shell)
 
         result = c.run(cmd, hide=True, warn=True, shell=f"/bin/{shell}")
     assert (
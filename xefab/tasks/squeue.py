@@ -1,14 +1,20 @@
+import asyncio
 import time
+from typing import TYPE_CHECKING
 
-import pandas as pd
 from fabric.connection import Connection
 from fabric.tasks import task
 
+from xefab.tasks.main import task as xefab_task
 from xefab.utils import console, df_to_table
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 
 def parse_squeue_output(squeue_output):
     """Parse the output of the squeue command."""
+    import pandas as pd
 
     squeue_output = squeue_output.split("\n")
     header, rows = squeue_output[0], squeue_output[1:]
@@ -27,7 +33,7 @@ def parse_squeue_output(squeue_output):
 def squeue(
     c: Connection, user: str = "me", partition: str = None, out: str = "", 
     hide: bool = False, warn: bool = False,
-) -> pd.DataFrame:
+) -> "pd.DataFrame":
     """Get the job-queue status."""
 
     command = 'squeue --format="%.18i %.9P %.30j %.8u %.8T %.10M %.9l %.6D %R"'
@@ -65,3 +71,94 @@ def squeue(
         else:
             console.print(table)
     return df
+
+
+# Consecutive failed squeue calls before giving up
+MAX_SQUEUE_FAILURES = 5
+
+
+async def poll_squeue(c, job_ids):
+    """States of the jobs still in the queue by job id, None if squeue
+    failed in a way worth retrying. squeue rejecting the job ids means
+    they left the queue.
+    """
+    result = await c.run(f"squeue -j {','.join(job_ids)}", hide=True, warn=True)
+    if result.failed and "Invalid job id specified" not in result.stderr:
+        if result.exited == 127:
+            raise RuntimeError(f"squeue is not available: {result.stderr.strip()}")
+        return None
+    df = parse_squeue_output(result.stdout)
+    states = {}
+    for job_id, state in zip(df.get("JOBID", []), df.get("ST", [])):
+        # Array jobs are listed as <id>_<index>
+        states.setdefault(str(job_id).split("_")[0], state)
+    return states
+
+
+def squeue_failed(c, failures):
+    if failures >= MAX_SQUEUE_FAILURES:
+        raise RuntimeError(f"squeue failed {failures} times in a row on {c.host}.")
+
+
+async def wait_for_job(
+    c, job_id: int, states=("R",), timeout: float = None, interval: float = 1.0
+) -> str:
+    """Poll squeue with an async connection until the job is in one of
+    states, or has left the queue if states is empty.
+    Returns the last state, an empty string once the job left the queue.
+    Failed squeue calls are retried, up to MAX_SQUEUE_FAILURES in a row.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + float(timeout) if timeout else None
+    failures = 0
+    while True:
+        queued = await poll_squeue(c, [str(job_id)])
+        if queued is None:
+            failures += 1
+            squeue_failed(c, failures)
+        else:
+            failures = 0
+            state = queued.get(str(job_id), "")
+            if state in states or (not states and not state):
+                return state
+            if state == "C":
+                raise RuntimeError(f"Job {job_id} was cancelled.")
+        if deadline is not None and loop.time() > deadline:
+            raise RuntimeError(f"Timeout reached while waiting for job {job_id}.")
+        await asyncio.sleep(interval)
+
+
+@xefab_task
+async def wait_for_jobs(
+    c, job_ids: str, timeout: float = 0.0, interval: float = 5.0, hide: bool = False
+):
+    """Wait for the given (comma separated) jobs to leave the queue.
+    Gives up after timeout seconds unless it is 0.
+    """
+
+    job_ids = [int(job_id) for job_id in str(job_ids).split(",") if job_id]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + float(timeout) if timeout else None
+    pending = {str(job_id) for job_id in job_ids}
+    failures = 0
+    # One squeue per interval for all jobs, not a session per job
+    while pending:
+        queued = await poll_squeue(c, sorted(pending))
+        if queued is None:
+            failures += 1
+            squeue_failed(c, failures)
+        else:
+            failures = 0
+            cancelled = sorted(j for j in pending if queued.get(j) == "C")
+            if cancelled:
+                raise RuntimeError(f"Jobs {', '.join(cancelled)} were cancelled.")
+            pending &= set(queued)
+            if not pending:
+                break
+        if deadline is not None and loop.time() > deadline:
+            raise RuntimeError(
+                f"Timeout reached while waiting for jobs {', '.join(sorted(pending))}."
+            )
+        await asyncio.sleep(interval)
+    if not hide:
+        console.print(f"Jobs {', '.join(map(str, job_ids))} finished.")
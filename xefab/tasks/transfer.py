@@ -1,27 +1,250 @@
+import uuid
+from contextlib import nullcontext
+
 import six
 from fabric.tasks import task
 
-from xefab.utils import console
+from xefab import link, parallel_transfer, tar_transfer
+from xefab.sync import sync as sync_dir
+from xefab.utils import console, df_to_table
 
 
-@task
-def download_file(c, path: str, out: str = None, preserve_mode: bool = True):
+@task(
+    help={
+        "streams": "number of concurrent SFTP channels moving ranges of the file.",
+        "resume": "continue an interrupted transfer of the same file.",
+    }
+)
+def download_file(
+    c,
+    path: str,
+    out: str = None,
+    preserve_mode: bool = True,
+    streams: int = 1,
+    resume: bool = False,
+):
     """Download a file from a remote server."""
 
     with console.status(f"Downloading {path} from {c.host}"):
-        c.get(path, local=out, preserve_mode=preserve_mode)
+        if streams > 1 or resume:
+            parallel_transfer.download(
+                c,
+                path,
+                out,
+                streams=streams,
+                resume=resume,
+                preserve_mode=preserve_mode,
+            )
+        else:
+            c.get(path, local=out, preserve_mode=preserve_mode)
     console.print(f"Done.")
 
 
-@task
-def upload_file(c, path: str, remote_path: str = None, preserve_mode: bool = True):
+@task(
+    help={
+        "streams": "number of concurrent SFTP channels moving ranges of the file.",
+        "resume": "continue an interrupted transfer of the same file.",
+    }
+)
+def upload_file(
+    c,
+    path: str,
+    remote_path: str = None,
+    preserve_mode: bool = True,
+    streams: int = 1,
+    resume: bool = False,
+):
     """Upload a file to a remote server."""
 
     with console.status(f"Uploading {path} to {c.host}"):
-        c.put(path, remote=remote_path, preserve_mode=preserve_mode)
+        if streams > 1 or resume:
+            parallel_transfer.upload(
+                c,
+                path,
+                remote_path,
+                streams=streams,
+                resume=resume,
+                preserve_mode=preserve_mode,
+            )
+        else:
+            c.put(path, remote=remote_path, preserve_mode=preserve_mode)
     console.print(f"Done.")
 
 
+def globs(patterns):
+    return [p.strip() for p in patterns.split(",") if p.strip()] if patterns else []
+
+
+@task(
+    help={
+        "out": "local directory, defaults to the name of the remote one.",
+        "workers": "number of concurrent SFTP channels.",
+        "tar": "move the files as one compressed tar stream instead of per file.",
+        "include": "with --tar, comma separated globs of the files to transfer.",
+        "exclude": "with --tar, comma separated globs of files and folders to skip.",
+        "hide": "don't show the progress.",
+    }
+)
+def download_dir(
+    c,
+    path: str,
+    out: str = None,
+    workers: int = 8,
+    tar: bool = False,
+    include: str = None,
+    exclude: str = None,
+    hide: bool = False,
+):
+    """Download a directory tree from a remote server."""
+    if (include or exclude) and not tar:
+        raise ValueError("--include and --exclude require --tar.")
+    if tar:
+        status = f"Downloading {path} from {c.host}"
+        with nullcontext() if hide else console.status(status):
+            n_files, n_bytes, skipped = tar_transfer.download_dir(
+                c, path, out, include=globs(include), exclude=globs(exclude)
+            )
+        for name, reason in skipped:
+            console.print(f"Skipped {name}: {reason}", style="warning")
+    else:
+        n_files, n_bytes = parallel_transfer.download_dir(
+            c, path, out, workers=workers, hide=hide
+        )
+    if not hide:
+        console.print(f"Downloaded {n_files} files ({n_bytes / 1e6:.1f} MB).")
+
+
+@task(
+    help={
+        "remote_path": "remote directory, defaults to the name of the local one.",
+        "workers": "number of concurrent SFTP channels.",
+        "tar": "move the files as one compressed tar stream instead of per file.",
+        "include": "with --tar, comma separated globs of the files to transfer.",
+        "exclude": "with --tar, comma separated globs of files and folders to skip.",
+        "hide": "don't show the progress.",
+    }
+)
+def upload_dir(
+    c,
+    path: str,
+    remote_path: str = None,
+    workers: int = 8,
+    tar: bool = False,
+    include: str = None,
+    exclude: str = None,
+    hide: bool = False,
+):
+    """Upload a directory tree to a remote server."""
+    if (include or exclude) and not tar:
+        raise ValueError("--include and --exclude require --tar.")
+    if tar:
+        status = f"Uploading {path} to {c.host}"
+        with nullcontext() if hide else console.status(status):
+            n_files, n_bytes = tar_transfer.upload_dir(
+                c, path, remote_path, include=globs(include), exclude=globs(exclude)
+            )
+    else:
+        n_files, n_bytes = parallel_transfer.upload_dir(
+            c, path, remote_path, workers=workers, hide=hide
+        )
+    if not hide:
+        console.print(f"Uploaded {n_files} files ({n_bytes / 1e6:.1f} MB).")
+
+
+@task(
+    help={
+        "source": "local directory, with a trailing slash only its contents.",
+        "target": "remote directory.",
+        "exclude": "comma separated globs of files and folders to skip.",
+        "delete": "remove remote files that don't exist locally.",
+        "checksum": "compare files by size and a fast hash instead of size and mtime.",
+        "workers": "number of concurrent SFTP channels.",
+        "dry_run": "only show what would be transferred and deleted.",
+        "hide": "don't show the progress.",
+    }
+)
+def sync(
+    c,
+    source: str,
+    target: str,
+    exclude: str = None,
+    delete: bool = False,
+    checksum: bool = False,
+    workers: int = 8,
+    dry_run: bool = False,
+    hide: bool = False,
+):
+    """Sync a local directory to a remote server, like rsync but without needing it."""
+    report = sync_dir(
+        c,
+        source,
+        target,
+        exclude=globs(exclude),
+        delete=delete,
+        checksum=checksum,
+        workers=workers,
+        dry_run=dry_run,
+        hide=hide,
+    )
+    if not hide:
+        if dry_run:
+            for path in report["uploaded"]:
+                console.print(f"upload {path}")
+            for path in report["deleted"]:
+                console.print(f"delete {path}")
+        console.print(
+            f"{'Would upload' if dry_run else 'Uploaded'} {len(report['uploaded'])} files, "
+            f"{'would delete' if dry_run else 'deleted'} {len(report['deleted'])}, "
+            f"{report['unchanged']} unchanged."
+        )
+    return report
+
+
+@task(
+    help={
+        "size_mb": "size of the test file to transfer, in MB.",
+        "profiles": "comma separated link profiles to compare, defaults to all.",
+        "remote_dir": "remote directory for the test file.",
+        "hide": "don't print the results table.",
+    }
+)
+def bench_link(
+    c,
+    size_mb: float = 16.0,
+    profiles: str = None,
+    remote_dir: str = "/tmp",
+    hide: bool = False,
+):
+    """Measure the transfer throughput to a host for each link tuning profile."""
+    import pandas as pd
+
+    candidates = dict(link.BENCH_PROFILES)
+    configured = link.settings_for(c.host)
+    if configured:
+        candidates["configured"] = configured
+    if profiles:
+        names = profiles.split(",")
+        unknown = [name for name in names if name not in candidates]
+        if unknown:
+            raise ValueError(
+                f"Unknown link profiles {unknown}, options are: {list(candidates)}"
+            )
+        candidates = {name: candidates[name] for name in names}
+
+    size = int(size_mb * 1e6)
+    remote_path = f"{remote_dir.rstrip('/')}/xefab_bench_{uuid.uuid4().hex[:8]}"
+    rows = []
+    for name, settings in candidates.items():
+        with console.status(f"Measuring {name} link to {c.host}"):
+            result = link.bench(c, settings, size, remote_path)
+        rows.append(dict(profile=name, **result, settings=settings))
+
+    df = pd.DataFrame(rows).round(2)
+    if not hide:
+        console.print(df_to_table(df, show_index=False))
+    return df
+
+
 def rsync(
     c,
     source,
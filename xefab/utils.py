@@ -4,23 +4,23 @@ import os
 import re
 import socket
 from collections import defaultdict
+from functools import partial
 from inspect import Parameter
-from typing import Iterable, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Optional, Union
 
-import fsspec
-import pandas as pd
-from decopatch import DECORATED, function_decorator
 from fabric.connection import Connection
 from invoke.context import Context
 from invoke.util import enable_logging
-from makefun import wraps
-from rich.console import Console, RenderableType
-from rich.panel import Panel
-from rich.progress import (Progress, ProgressColumn, SpinnerColumn, Task,
-                           TextColumn)
-from rich.table import Table
+from rich.console import Console
 from rich.theme import Theme
 
+# Heavy third-party imports are deferred to the functions using them
+# to keep the CLI startup fast, see tests/test_import_time.py
+if TYPE_CHECKING:
+    import fsspec
+    import pandas as pd
+    from rich.table import Table
+
 custom_theme = Theme({"info": "dim cyan", "warning": "magenta", "danger": "bold red"})
 
 console = Console(theme=custom_theme)
@@ -47,13 +47,23 @@ def camel_to_snake(name):
     return re.sub("([a-z0-9])([A-Z])", r"\1_\2", name).lower()
 
 
-@function_decorator
-def try_local(exception=Exception, f=DECORATED):
+def try_local(f=None, *, exception=Exception):
     """Try to run a task locally, if it fails, run it remotely.
     Can be used as a decorator or as a function.
     if the first argument after the function is a Connection
     the function is called immediately, otherwise a wrapper is returned.
+    The exception(s) to catch can be passed positionally,
+    as in `@try_local(SomeError)`.
     """
+    if isinstance(f, tuple) or (
+        isinstance(f, type) and issubclass(f, BaseException)
+    ):
+        f, exception = None, f
+    if f is None:
+        return partial(try_local, exception=exception)
+
+    from makefun import wraps
+
     extra = Parameter(
         "force_remote",
         kind=Parameter.POSITIONAL_OR_KEYWORD,
@@ -75,16 +85,22 @@ def try_local(exception=Exception, f=DECORATED):
     return wrapper
 
 
-def filesystem(c: Union[Connection, Context], local: bool = False) -> fsspec.AbstractFileSystem:
-    """Get a fsspec filesystem object from a fabric Connection/Invoke Context object."""
+def filesystem(
+    c: Union[Connection, Context], local: bool = False
+) -> "fsspec.AbstractFileSystem":
+    """Get a fsspec filesystem object from a fabric Connection/Invoke Context object.
+    Remote filesystems use the connection's SFTP session and are cached per connection.
+    """
+    import fsspec
+
     if c is not None:
         root = c.cwd
     else:
         root = os.getcwd()
     if isinstance(c, Connection) and not local:
-        return fsspec.filesystem(
-            "sftp", host=c.host, username=c.user, port=c.port, **c.connect_kwargs
-        )
+        from xefab.remote_fs import connection_filesystem
+
+        return connection_filesystem(c)
 
     return fsspec.filesystem("file", root=root)
 
@@ -113,11 +129,11 @@ def get_open_port(start=5000, end=None, bind_address="", *socket_args, **socket_
 
 
 def df_to_table(
-    pandas_dataframe: pd.DataFrame,
-    rich_table: Table = None,
+    pandas_dataframe: "pd.DataFrame",
+    rich_table: "Table" = None,
     show_index: bool = True,
     index_name: Optional[str] = None,
-) -> Table:
+) -> "Table":
     """Convert a pandas.DataFrame obj into a rich.Table obj.
     Args:
         pandas_dataframe (DataFrame): A Pandas DataFrame to be converted to a rich Table.
@@ -126,6 +142,8 @@ def df_to_table(
         index_name (str, optional): The column name to give to the index column. Defaults to None, showing no value.
     Returns:
         Table: The rich Table instance passed, populated with the DataFrame values."""
+    from rich.table import Table
+
     if rich_table is None:
         rich_table = Table(show_header=True, header_style="bold magenta")
     if show_index:
@@ -143,77 +161,16 @@ def df_to_table(
     return rich_table
 
 
-class SuccessSpinnerColumn(SpinnerColumn):
-    """A spinner column that shows a checkmark when the task
-    is completed successfully or a x if not.
-    """
-
-    def render(self, task: Task) -> RenderableType:
-        if task.finished:
-            if task.fields.get("exception", None) is None:
-                return "[bold green]✓[/bold green]"
-            else:
-                return "[bold red]✗[/bold red]"
-        else:
-            return super().render(task)
-
-
-class ProgressContext(Progress):
-    """A context manager for rich.progress.Progress.
-    Allows entering a task context and task will be completed when exiting
-    """
-
-    def __init__(self, *args, **kwargs):
-        self._live_display = None
-        super().__init__(*args, **kwargs)
-
-    @classmethod
-    def get_default_columns(cls) -> Tuple[ProgressColumn, ...]:
-        return (
-            SuccessSpinnerColumn(),
-            TextColumn("[progress.description]{task.description}"),
-            SpinnerColumn(spinner_name="simpleDots", finished_text=""),
-        )
-
-    def get_renderables(self) -> Iterable[RenderableType]:
-        yield from super().get_renderables()
-        if self._live_display is not None:
-            yield self._live_display
-
-    @contextlib.contextmanager
-    def enter_task(
-        self,
-        description,
-        total=1,
-        finished_description=None,
-        exception_description="Task failed to excecute.",
-        warn=False,
-        hide=False,
-    ):
-        """Start and end a task in a progress bar."""
-        task = self.add_task(description, total=total)
-        exception = None
-        try:
-            yield task
-        except Exception as e:
-            finished_description = exception_description.format(exception=e)
-            exception = e
-            self.update(task_id=task, exception=True)
-        finally:
-            description = finished_description or self.tasks[task].description
-            self.update(task_id=task, completed=total, description=description)
-            if exception is not None and not hide:
-                self.console.print_exception(show_locals=True)
-            if exception is not None and not warn:
-                exit(1)
-
-    def live_display(self, renderable):
-        """Display a renderable in a panel below the progress bar."""
-        with self._lock:
-            self._live_display = renderable
-        self.refresh()
-
-
 def tail(text, n=10):
     """Return the last n lines of a text string."""
     return "\n".join(text.splitlines()[-n:])
+
+
+def __getattr__(name):
+    # The progress classes moved to xefab.progress to avoid importing
+    # rich.progress on startup, keep them importable from here.
+    if name in ("ProgressContext", "SuccessSpinnerColumn"):
+        from xefab import progress
+
+        return getattr(progress, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")